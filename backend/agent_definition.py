@@ -1,4 +1,6 @@
 from datetime import datetime
+from functools import lru_cache
+import hashlib
 
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 
@@ -6,18 +8,19 @@ from agent_llm import get_llm
 from agent_tools import tools
 
 
-llm = get_llm(model_id="anthropic.claude-3-haiku-20240307-v1:0")
+CHATBOT_MODEL_ID = "anthropic.claude-3-haiku-20240307-v1:0"
+CHATBOT_SYSTEM_MESSAGE = "Edit this message."
 
-def create_agent(llm, tools, system_message: str):
-    """Create an agent
+
+def create_prompt(tools, system_message: str) -> ChatPromptTemplate:
+    """Create the prompt of an agent
 
     Args:
-        llm (ChatBedrock): The ChatBedrock instance to use.
-        tools (List[Callable]): The list of tools to bind to the agent.
+        tools (List[Callable]): The list of tools the agent can call.
         system_message (str): The system message to display to the agent.
 
     Returns:
-        ChatAgent: The created ChatAgent instance.
+        ChatPromptTemplate: The prompt, with the system message and tool names filled in.
     """
 
     prompt = ChatPromptTemplate.from_messages(
@@ -47,7 +50,7 @@ def create_agent(llm, tools, system_message: str):
                 '\n    "approval_guidance": {{"initial_reserve_threshold": 25000, "supplement_estimate_threshold": 10000}},'
                 '\n    "reserve_recommendations": {{"initial_reserve": 15000, "maximum_reserve": 50000}}'
                 "\n  }}"
-                "\n- approval_level: required approval tier based on policy thresholds"
+                "\n- approval_level: required approval tier based on policy thresholds, named by its key in the policy's approvalThresholds (e.g. supervisorApproval)"
                 "\n- estimated_reserves: dollar amounts based on policy guidelines"
                 "\n- priority: urgency level from policy decision tree"
                 "\n- timeline: expected resolution timeframe"
@@ -67,12 +70,41 @@ def create_agent(llm, tools, system_message: str):
     prompt = prompt.partial(time=lambda: str(datetime.now()))
     prompt = prompt.partial(tool_names=", ".join([tool.name for tool in tools]))
 
-    return prompt | llm.bind_tools(tools)
+    return prompt
+
+
+def create_agent(llm, tools, system_message: str):
+    """Create an agent
+
+    Args:
+        llm (ChatBedrock): The ChatBedrock instance to use.
+        tools (List[Callable]): The list of tools to bind to the agent.
+        system_message (str): The system message to display to the agent.
+
+    Returns:
+        ChatAgent: The created ChatAgent instance.
+    """
+
+    return create_prompt(tools, system_message) | llm.bind_tools(tools)
+
+
+@lru_cache(maxsize=None)
+def get_chatbot_llm():
+    """The LLM of the chatbot agent, created on first use."""
+    return get_llm(model_id=CHATBOT_MODEL_ID)
+
+
+@lru_cache(maxsize=None)
+def get_chatbot_agent():
+    """The chatbot agent, created on first use so that importing this module needs no Bedrock client."""
+    return create_agent(get_chatbot_llm(), tools, system_message=CHATBOT_SYSTEM_MESSAGE)
+
+
+def prompt_version(prompt: ChatPromptTemplate) -> str:
+    """Short hash of an agent's system prompt, so that claims can be compared across prompt changes."""
+    system_template = prompt.messages[0].prompt.template
+    system_message = prompt.partial_variables.get("system_message", "")
+    return hashlib.sha256(f"{system_template}\n{system_message}".encode("utf-8")).hexdigest()[:12]
 
 
-# Chatbot agent and node
-chatbot_agent = create_agent(
-    llm,
-    tools,
-    system_message="Edit this message.",
-)
\ No newline at end of file
+PROMPT_VERSION = prompt_version(create_prompt(tools, CHATBOT_SYSTEM_MESSAGE))
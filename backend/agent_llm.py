@@ -1,5 +1,7 @@
 from langchain_aws import ChatBedrock
 
+from backends import get_bedrock_runtime
+
 import os
 import logging
 from dotenv import load_dotenv
@@ -28,7 +30,8 @@ def get_llm(model_id: str = "anthropic.claude-3-haiku-20240307-v1:0",
         aws_region (str): The AWS region to use.
     """
 
-    return ChatBedrock(model=model_id,
+    return ChatBedrock(client=get_bedrock_runtime(aws_region, aws_access_key, aws_secret_key),
+                model=model_id,
                 region=aws_region, 
                 aws_access_key_id=aws_access_key, 
                 aws_secret_access_key=aws_secret_key,
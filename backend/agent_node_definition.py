@@ -1,38 +1,51 @@
-
-import functools
 from langchain_core.messages import AIMessage, ToolMessage
+from langchain_core.runnables import RunnableConfig
 
 from langgraph.prebuilt import ToolNode
-from agent_definition import chatbot_agent
+from agent_definition import CHATBOT_MODEL_ID, get_chatbot_agent
 from agent_tools import tools
+from tracing import start_span
+from metrics import LLM_TURN_LATENCY, PROMPT_CACHE_HITS
+from claim_usage import claim_usage
+from deadline import claim_deadline, deadline_scope
 
 import logging
-
-from bson import ObjectId
-
-def serialize_object(obj):
-    """Recursively serialize ObjectId in a dictionary or list."""
-    if isinstance(obj, dict):
-        return {key: serialize_object(value) for key, value in obj.items()}
-    elif isinstance(obj, list):
-        return [serialize_object(item) for item in obj]
-    elif isinstance(obj, ObjectId):
-        return str(obj)
-    return obj
+import time
 
 # Helper function to create a node for a given agent
-def agent_node(state, agent, name):
+def agent_node(state, agent, name, config: RunnableConfig = None):
     try: 
-        result = agent.invoke(state)
+        with start_span("graph.node.chatbot", agent=name, turn=len(state["messages"])) as span:
+            start = time.perf_counter()
+            # Pass the config through so that streaming callbacks see the LLM tokens
+            result = agent.invoke(state, config)
+            elapsed = time.perf_counter() - start
+            usage = getattr(result, "usage_metadata", None) or {}
+            cache = usage.get("input_token_details") or {}
+            # Streamed turns carry no model id in their metadata
+            model_id = result.response_metadata.get("model_id") or CHATBOT_MODEL_ID
+            LLM_TURN_LATENCY.labels(model_id=model_id).observe(elapsed)
+            if cache.get("cache_read"):
+                PROMPT_CACHE_HITS.labels(model_id=model_id).inc()
+            if claim_usage.get() is not None:
+                claim_usage.get().add_call(
+                    "agent", model_id,
+                    input_tokens=usage.get("input_tokens", 0),
+                    output_tokens=usage.get("output_tokens", 0),
+                    cache_read_tokens=cache.get("cache_read") or 0,
+                    cache_write_tokens=cache.get("cache_creation") or 0,
+                    latency_ms=elapsed * 1000,
+                )
+            span.set_attributes({
+                "gen_ai.request.model": model_id,
+                "gen_ai.usage.input_tokens": usage.get("input_tokens", 0),
+                "gen_ai.usage.output_tokens": usage.get("output_tokens", 0),
+                "tool_calls": len(getattr(result, "tool_calls", None) or []),
+            })
     
-        # Serialize the result to handle ObjectId
-        result = serialize_object(result)
-        
         # Convert the agent output into a format suitable for the global state
-        if isinstance(result, ToolMessage):
-            pass
-        else:
-            result = AIMessage(**result.dict(exclude={"type", "name"}), name=name)
+        if not isinstance(result, ToolMessage):
+            result = AIMessage(**result.model_dump(exclude={"type", "name"}), name=name)
         
         return {
             "messages": [result],
@@ -47,5 +60,20 @@ def agent_node(state, agent, name):
         }
 
 
-chatbot_node = functools.partial(agent_node, agent=chatbot_agent, name="Claim adjuster helper")
-tool_node = ToolNode(tools, name="tools")
\ No newline at end of file
+def chatbot_node(state, config: RunnableConfig = None):
+    """Run one turn of the chatbot agent, which is created on the first turn."""
+    # No LLM turn starts once the request's deadline has passed
+    with deadline_scope(claim_deadline.get()):
+        return agent_node(state, get_chatbot_agent(), "Claim adjuster helper", config)
+
+
+tools_executor = ToolNode(tools, name="tools")
+
+
+def tool_node(state, config: RunnableConfig = None):
+    """Execute the tool calls of the last LLM turn."""
+    if claim_usage.get() is not None:
+        claim_usage.get().add_tool_round()
+    with start_span("graph.node.tools", tool_calls=len(getattr(state["messages"][-1], "tool_calls", []))), \
+            deadline_scope(claim_deadline.get()):
+        return tools_executor.invoke(state, config)
\ No newline at end of file
@@ -1,9 +1,21 @@
 from langchain.agents import tool
 from embeddings.bedrock.getters import get_embedding_model
-from agent_vector_store import create_vector_store
-from pymongo import MongoClient
+from agent_vector_store import create_vector_store, hybrid_search, infer_incident_type
+from embeddings.bson_vectors import embedding_field_name
+from mongo_client import get_collection
+from claim_schema import ClaimRecord, PersistDataInput
 from datetime import datetime
 from bson import ObjectId
+from contextvars import ContextVar
+from functools import lru_cache
+from typing import Optional
+from langchain_core.embeddings import Embeddings
+from langchain_mongodb import MongoDBAtlasVectorSearch
+from tracing import set_attributes, traced
+from metrics import TOOL_LATENCY, timed
+from claim_usage import claim_usage
+from policy_version import policy_reference
+from json_encoder import dumps
 
 import os
 import logging
@@ -20,101 +32,140 @@ logging.basicConfig(
 )
 
 INDEX_NAME = "description_index" 
+TEXT_INDEX_NAME = "policy_text_index"
+
+# Embedding type searched by $vectorSearch: "float", or Cohere "int8"/"ubinary" BSON vectors
+EMBEDDING_TYPE = os.getenv("EMBEDDING_TYPE", "float")
+# Atlas index-side quantisation of the float embeddings: "none", "scalar" or "binary"
+VECTOR_INDEX_QUANTIZATION = os.getenv("VECTOR_INDEX_QUANTIZATION", "none")
+# ANN candidates for $vectorSearch; tune with benchmarks/vector_search_sweep.py
+VECTOR_NUM_CANDIDATES = int(os.getenv("VECTOR_NUM_CANDIDATES", "50"))
+# Re-rank quantised search results with exact cosine similarity on the float embeddings
+VECTOR_RESCORE = os.getenv("VECTOR_RESCORE", "false").lower() == "true"
+
+# Idempotency key of the claim being processed, set by insurance_agent for the duration of a run
+claim_idempotency_key: ContextVar[str] = ContextVar("claim_idempotency_key", default=None)
+# Claims of a bulk run (see bulk_ingest.py): persist_data adds them here and the run inserts them with insert_many
+claim_sink: ContextVar[Optional[list]] = ContextVar("claim_sink", default=None)
+# Version of the policy retrieved by a run, filled in by fetch_guidelines; insurance_agent sets an empty dict per run
+claim_policy: ContextVar[Optional[dict]] = ContextVar("claim_policy", default=None)
 
 # Configure logging for debugging
 logger = logging.getLogger(__name__)
 
-embedding_model = get_embedding_model(model_id="cohere.embed-english-v3")
+EMBEDDING_MODEL_ID = "cohere.embed-english-v3"
+
+
+# Models and stores are created on first use, so that importing the tools needs no Bedrock or Atlas connection
+@lru_cache(maxsize=None)
+def get_document_embedding_model() -> Embeddings:
+    """Float embedding model of the policy documents, also used to rescore quantised results."""
+    return get_embedding_model(model_id=EMBEDDING_MODEL_ID)
+
 
-vector_store = create_vector_store(
+@lru_cache(maxsize=None)
+def get_query_embedding_model() -> Embeddings:
+    """Embedding model of the search queries, in the type searched by $vectorSearch."""
+    if EMBEDDING_TYPE == "float":
+        return get_document_embedding_model()
+    return get_embedding_model(model_id=EMBEDDING_MODEL_ID, embedding_type=EMBEDDING_TYPE)
+
+
+@lru_cache(maxsize=None)
+def get_vector_store() -> MongoDBAtlasVectorSearch:
+    """LangChain vector store over the policy collection."""
+    return create_vector_store(
         cluster_uri=os.getenv("MONGODB_URI"),
         database_name=os.getenv("DATABASE_NAME"),
-        collection_name=os.getenv("COLLECTION_NAME"),                       
+        collection_name=os.getenv("COLLECTION_NAME"),
         text_key="description",
         embedding_key="descriptionEmbedding",
         index_name=INDEX_NAME,
-        embedding_model=embedding_model
+        embedding_model=get_document_embedding_model()
     )
 
+
+def summarize_policy(full_policy: dict) -> dict:
+    """Sections of a policy document given to the agent, with defaults for the missing ones."""
+    return {
+        "name": full_policy.get("name", "Unknown Policy"),
+        "type": full_policy.get("type", "general"),
+        "description": full_policy.get("description", "No description available"),
+        "handlerActions": full_policy.get("handlerActions", {
+            "immediate": ["Contact insured to obtain statement", "Set initial reserves", "Log claim in system"],
+            "within24Hours": ["Schedule damage inspection", "Review coverage", "Contact other parties"],
+            "within72Hours": ["Review reports", "Adjust reserves", "Make coverage decision"]
+        }),
+        "approvalThresholds": full_policy.get("approvalThresholds", {
+            "autoApprove": {"maxAmount": 5000, "conditions": ["minor damage"]},
+            "supervisorApproval": {"maxAmount": 25000, "conditions": ["moderate damage"]},
+            "managerApproval": {"maxAmount": 100000, "conditions": ["major damage"]},
+            "executiveApproval": {"maxAmount": "unlimited", "conditions": ["catastrophic loss"]}
+        }),
+        "decisionTree": full_policy.get("decisionTree", {
+            "severity": {
+                "minor": {"priority": "standard", "timeline": "5-10 days"},
+                "major": {"priority": "high", "timeline": "1-3 days"}
+            }
+        }),
+        "reserveGuidelines": full_policy.get("reserveGuidelines", {
+            "property": {"minor": 5000, "major": 25000},
+            "bodily_injury": {"minor": 15000, "major": 75000}
+        }),
+        "documentationRequired": full_policy.get("documentationRequired", [
+            "Police report", "Photos of damage", "Repair estimates", "Medical records"
+        ])
+    }
+
+
 @tool
+@traced("tool.fetch_guidelines")
+@timed(TOOL_LATENCY, tool="fetch_guidelines")
 def fetch_guidelines(query: str, n=1) -> str:
-    """Runs semantic search on existing policies to find relevant ones based on the image description. 
+    """Runs hybrid (semantic and keyword) search on existing policies to find relevant ones based on the image description. 
     Returns complete policy information including handler actions, approval thresholds, and decision trees."""
     logger.info(f"fetch_guidelines called with query: {query}")
     
     try:
-        logger.info("Attempting vector search...")
-        result = vector_store.similarity_search_with_score(query=query, k=n) 
-        logger.info(f"Vector search completed. Result length: {len(result) if result else 0}")
+        incident_type = infer_incident_type(query)
+        set_attributes(k=n, incident_type=incident_type)
+        if claim_usage.get() is not None:
+            claim_usage.get().incident_type = incident_type
+        logger.info(f"Attempting hybrid search (inferred incident type: {incident_type})...")
+        collection = get_collection(os.getenv("COLLECTION_NAME"))
+        # Vector and full-text results are fused in one aggregation that returns the full policies,
+        # so no second lookup by description is needed
+        result = hybrid_search(
+            collection=collection,
+            embedding_model=get_query_embedding_model(),
+            query=query,
+            k=n,
+            vector_index_name=INDEX_NAME,
+            text_index_name=TEXT_INDEX_NAME,
+            incident_type=incident_type,
+            num_candidates=VECTOR_NUM_CANDIDATES,
+            embedding_type=EMBEDDING_TYPE,
+            rescore_model=get_document_embedding_model() if VECTOR_RESCORE else None,
+        )
+        logger.info(f"Hybrid search completed. Result length: {len(result) if result else 0}")
         
         # Check if we got any results
         if not result or len(result) == 0:
-            logger.warning("No results from vector search")
+            logger.warning("No results from hybrid search")
             return "No relevant policies found for the given query. Please ensure the vector database is properly populated with policy data."
         
-        # Get the full document from the database to include all fields
-        cluster_uri = os.getenv("MONGODB_URI")
-        database_name = os.getenv("DATABASE_NAME")
-        collection_name = os.getenv("COLLECTION_NAME")
-        
-        client = MongoClient(cluster_uri)
-        db = client[database_name]
-        collection = db[collection_name]
-        
-        # The result contains the document content, we need to find the full document
-        # by using the description to match against the database
-        policy_description = result[0][0].page_content
-        
-        # Find the complete document that matches this description
-        # Try exact match first, then partial match
-        full_policy = collection.find_one({"description": policy_description})
-        
-        if not full_policy:
-            # Try partial match if exact match fails
-            full_policy = collection.find_one({"description": {"$regex": policy_description[:100]}})
-        
-        if not full_policy:
-            # If still no match, get any policy document as fallback
-            full_policy = collection.find_one({})
-            if not full_policy:
-                return "No policy documents found in the database. Please ensure the database is properly populated."
-        
-        # Extract the relevant sections for the agent
-        policy_summary = {
-            "name": full_policy.get("name", "Unknown Policy"),
-            "type": full_policy.get("type", "general"),
-            "description": full_policy.get("description", "No description available"),
-            "handlerActions": full_policy.get("handlerActions", {
-                "immediate": ["Contact insured to obtain statement", "Set initial reserves", "Log claim in system"],
-                "within24Hours": ["Schedule damage inspection", "Review coverage", "Contact other parties"],
-                "within72Hours": ["Review reports", "Adjust reserves", "Make coverage decision"]
-            }),
-            "approvalThresholds": full_policy.get("approvalThresholds", {
-                "autoApprove": {"maxAmount": 5000, "conditions": ["minor damage"]},
-                "supervisorApproval": {"maxAmount": 25000, "conditions": ["moderate damage"]},
-                "managerApproval": {"maxAmount": 100000, "conditions": ["major damage"]},
-                "executiveApproval": {"maxAmount": "unlimited", "conditions": ["catastrophic loss"]}
-            }),
-            "decisionTree": full_policy.get("decisionTree", {
-                "severity": {
-                    "minor": {"priority": "standard", "timeline": "5-10 days"},
-                    "major": {"priority": "high", "timeline": "1-3 days"}
-                }
-            }),
-            "reserveGuidelines": full_policy.get("reserveGuidelines", {
-                "property": {"minor": 5000, "major": 25000},
-                "bodily_injury": {"minor": 15000, "major": 75000}
-            }),
-            "documentationRequired": full_policy.get("documentationRequired", [
-                "Police report", "Photos of damage", "Repair estimates", "Medical records"
-            ])
-        }
+        full_policy = result[0]
+        policy_summary = summarize_policy(full_policy)
+        # Recorded on the claim by persist_data, to re-evaluate it when the policy is edited
+        if claim_policy.get() is not None and "_id" in full_policy:
+            claim_policy.get().update(policy_reference(full_policy.get("_id"), policy_summary))
         
-        print("Vector store - Enhanced Policy Retrieved: ", policy_summary["name"])
-        return str(policy_summary)
+        logger.info(f"Vector store - Enhanced Policy Retrieved: {policy_summary['name']}")
+        # JSON, so that the policy defaults can be read back if the run falls back to them
+        return dumps(policy_summary).decode()
         
     except Exception as e:
-        print(f"Error in fetch_guidelines: {str(e)}")
+        logger.error(f"Error in fetch_guidelines: {str(e)}")
         # Return fallback policy information
         fallback_policy = {
             "name": "General Auto Insurance Policy",
@@ -143,60 +194,78 @@ def fetch_guidelines(query: str, n=1) -> str:
             },
             "documentationRequired": ["Police report", "Damage photos", "Repair estimates"]
         }
-        return str(fallback_policy)
+        return dumps(fallback_policy).decode()
 
 
-@tool
-def persist_data(data) -> dict:
-    """Persists the data in the database and returns the ObjectId."""
-    cluster_uri = os.getenv("MONGODB_URI")
-    database_name = os.getenv("DATABASE_NAME")
-    collection_name = os.getenv("COLLECTION_NAME_2")
+@tool(args_schema=PersistDataInput)
+@traced("tool.persist_data")
+@timed(TOOL_LATENCY, tool="persist_data")
+def persist_data(data: ClaimRecord) -> dict:
+    """Persists the claim in the database and returns the ObjectId."""
+    collection = get_collection(os.getenv("COLLECTION_NAME_2"))
+    idempotency_key = claim_idempotency_key.get()
 
-    client = MongoClient(cluster_uri)
-    db = client[database_name]
-    
-    # Persist data
-    collection = db[collection_name]
-    result = collection.insert_one(data)
+    # Store the claim in canonical form so that reads need no reshaping
+    record = data if isinstance(data, ClaimRecord) else ClaimRecord.model_validate(data)
+    data = record.model_dump()
+    if claim_policy.get():
+        data["policy"] = dict(claim_policy.get())
+    sink = claim_sink.get()
+
+    if sink is not None:
+        # Inserted later with the other claims of the bulk run; the unique idempotency key still dedupes
+        inserted_id = ObjectId()
+        sink.append({"_id": inserted_id, **data, **({"idempotency_key": idempotency_key} if idempotency_key else {})})
+    elif idempotency_key:
+        # A retried run for the same claim must not insert a second document
+        collection.update_one(
+            {"idempotency_key": idempotency_key},
+            {"$setOnInsert": {**data, "idempotency_key": idempotency_key}},
+            upsert=True,
+        )
+        inserted_id = collection.find_one({"idempotency_key": idempotency_key}, {"_id": 1})["_id"]
+    else:
+        # Persist data
+        result = collection.insert_one(data)
     
-    # Get the ObjectId of the inserted document
-    inserted_id = result.inserted_id
+        # Get the ObjectId of the inserted document
+        inserted_id = result.inserted_id
     
     return {
         "message": "Data persisted successfully.",
         "object_id": str(inserted_id)  # Convert ObjectId to string for easier handling
     }
 
+def pending_claim(object_id: str) -> Optional[dict]:
+    """The claim with this ObjectId if it waits in the claim sink to be inserted, else None."""
+    for document in claim_sink.get() or []:
+        if str(document["_id"]) == object_id:
+            return document
+    return None
+
 @tool
+@traced("tool.clean_chat_history")
+@timed(TOOL_LATENCY, tool="clean_chat_history")
 def clean_chat_history() -> dict:
     """Cleans the chat history in the database at the end of the workflow."""
-    cluster_uri = os.getenv("MONGODB_URI")
-    database_name = os.getenv("DATABASE_NAME")
-    chat_history_coll = os.getenv("CHAT_HISTORY_COLLECTION")
-
-    client = MongoClient(cluster_uri)
-    db = client[database_name]
-    
     # Persist data
-    collection = db[chat_history_coll]
+    collection = get_collection(os.getenv("CHAT_HISTORY_COLLECTION"))
     collection.delete_many({})
 
     return {"message": "Chat history cleaned successfully."}
 
 @tool
+@traced("tool.test_database_connection")
+@timed(TOOL_LATENCY, tool="test_database_connection")
 def test_database_connection() -> str:
     """Test tool to verify database connection and policy data availability."""
     try:
-        cluster_uri = os.getenv("MONGODB_URI")
         database_name = os.getenv("DATABASE_NAME")
         collection_name = os.getenv("COLLECTION_NAME")
         
         logger.info(f"Testing connection to: {database_name}.{collection_name}")
         
-        client = MongoClient(cluster_uri)
-        db = client[database_name]
-        collection = db[collection_name]
+        collection = get_collection(collection_name, database_name)
         
         # Count documents
         doc_count = collection.count_documents({})
@@ -215,37 +284,33 @@ def test_database_connection() -> str:
         return f"Database connection failed: {str(e)}"
 
 @tool
+@traced("tool.create_vector_search_index")
+@timed(TOOL_LATENCY, tool="create_vector_search_index")
 def create_vector_search_index() -> str:
-    """Create the vector search index for policy documents if it doesn't exist."""
+    """Create the vector search and full-text search indexes for policy documents if they don't exist."""
     try:
-        cluster_uri = os.getenv("MONGODB_URI")
-        database_name = os.getenv("DATABASE_NAME")
-        collection_name = os.getenv("COLLECTION_NAME")
-        
-        client = MongoClient(cluster_uri)
-        db = client[database_name]
-        collection = db[collection_name]
+        collection = get_collection(os.getenv("COLLECTION_NAME"))
         
-        # Check if index already exists
+        # Check which indexes already exist
         try:
-            indexes = list(collection.list_search_indexes())
-            existing_names = [idx.get('name') for idx in indexes]
-            
-            if INDEX_NAME in existing_names:
-                return f"Vector search index '{INDEX_NAME}' already exists."
+            existing_names = [idx.get('name') for idx in collection.list_search_indexes()]
         except:
             # If list_search_indexes doesn't work, continue with creation
-            pass
+            existing_names = []
         
-        # Create vector search index definition
-        index_definition = {
+        # Vector search index; "type" is a filter field so hybrid search can pre-filter on it
+        vector_field = {
+            "type": "vector",
+            "path": embedding_field_name("descriptionEmbedding", EMBEDDING_TYPE),
+            "numDimensions": 1024,
+            # Atlas only supports euclidean similarity on bit-packed (int1) vectors
+            "similarity": "euclidean" if EMBEDDING_TYPE == "ubinary" else "cosine"
+        }
+        if EMBEDDING_TYPE == "float" and VECTOR_INDEX_QUANTIZATION != "none":
+            vector_field["quantization"] = VECTOR_INDEX_QUANTIZATION
+        vector_index_definition = {
             "fields": [
-                {
-                    "type": "vector",
-                    "path": "descriptionEmbedding",
-                    "numDimensions": 1024,
-                    "similarity": "cosine"
-                },
+                vector_field,
                 {
                     "type": "filter", 
                     "path": "type"
@@ -253,21 +318,45 @@ def create_vector_search_index() -> str:
             ]
         }
         
-        # Create the vector search index
-        try:
-            result = collection.create_search_index(
-                model={
-                    "name": INDEX_NAME,
-                    "definition": index_definition
+        # Full-text index used by the lexical leg of hybrid search
+        text_index_definition = {
+            "mappings": {
+                "dynamic": False,
+                "fields": {
+                    "name": {"type": "string"},
+                    "tags": {"type": "string"},
+                    "keyProvisions": {"type": "string"}
                 }
-            )
-            logger.info(f"Vector search index creation initiated: {result}")
-            return f"Vector search index '{INDEX_NAME}' creation initiated. Result: {result}"
-        except Exception as create_error:
-            return f"Failed to create vector search index via API: {str(create_error)}. Please create it manually in MongoDB Atlas Console."
+            }
+        }
+        
+        messages = []
+        for name, index_type, definition in [
+            (INDEX_NAME, "vectorSearch", vector_index_definition),
+            (TEXT_INDEX_NAME, "search", text_index_definition),
+        ]:
+            if name in existing_names:
+                messages.append(f"Search index '{name}' already exists.")
+                continue
+            
+            # Create the search index
+            try:
+                result = collection.create_search_index(
+                    model={
+                        "name": name,
+                        "type": index_type,
+                        "definition": definition
+                    }
+                )
+                logger.info(f"Search index creation initiated: {result}")
+                messages.append(f"Search index '{name}' creation initiated. Result: {result}")
+            except Exception as create_error:
+                messages.append(f"Failed to create search index '{name}' via API: {str(create_error)}. Please create it manually in MongoDB Atlas Console.")
+        
+        return " ".join(messages)
         
     except Exception as e:
-        logger.error(f"Failed to create vector search index: {str(e)}")
-        return f"Failed to create vector search index: {str(e)}"
+        logger.error(f"Failed to create search indexes: {str(e)}")
+        return f"Failed to create search indexes: {str(e)}"
 
 tools = [fetch_guidelines, persist_data, clean_chat_history, test_database_connection, create_vector_search_index]
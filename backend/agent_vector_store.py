@@ -1,9 +1,19 @@
 from langchain_mongodb import MongoDBAtlasVectorSearch
 
 from langchain_aws import BedrockEmbeddings
+from langchain_core.embeddings import Embeddings
 from embeddings.bedrock.getters import get_embedding_model
+from embeddings.bson_vectors import EMBEDDING_FIELD_SUFFIXES, embedding_field_name, from_bson_vector, to_bson_vector
+from pymongo.collection import Collection
+from mongo_client import get_mongo_client
+from tracing import start_span
+from metrics import VECTOR_SEARCH_LATENCY
+import numpy as np
 
+from typing import List, Optional
 import os
+import re
+import time
 import logging
 from dotenv import load_dotenv
 
@@ -28,10 +38,9 @@ def create_vector_store(
 ) -> MongoDBAtlasVectorSearch:
    
 
-    # Vector Store Creation
-    vector_store = MongoDBAtlasVectorSearch.from_connection_string(
-        connection_string=cluster_uri,
-        namespace=database_name + "." + collection_name,
+    # Vector Store Creation, on the shared client rather than a new connection pool
+    vector_store = MongoDBAtlasVectorSearch(
+        collection=get_mongo_client(cluster_uri)[database_name][collection_name],
         embedding=embedding_model,
         embedding_key=embedding_key,
         index_name=index_name,
@@ -45,4 +54,200 @@ def lookup_collection(vector_store: MongoDBAtlasVectorSearch, query: str, n=1) -
     result = vector_store.similarity_search_with_score(query=query, k=n)
     #return str(result[0][0].page_content)
     return str(result)
-    
+
+
+# Keywords that identify the policy "type" an accident description belongs to.
+# Used to pre-filter $vectorSearch on the "type" filter field of the vector index, so each keyword
+# must point at one type only: a generic one such as "bus" would hide every other type from the vector leg.
+INCIDENT_TYPE_KEYWORDS = {
+    "vehicle_collision": ["school bus"],
+    "complex_accident": ["pile-up", "pile up", "pileup", "multi-vehicle", "multiple vehicles", "chain reaction"],
+    "environmental_damage": ["weather", "hail", "flood", "storm", "snow", "ice", "icy", "fallen tree", "wildfire"],
+    "personal_injury": ["pedestrian", "cyclist", "bicycle", "injured person", "struck a person"],
+    "technical_failure": ["tyre", "tire", "blowout", "brake failure", "mechanical", "engine", "road hazard", "pothole"],
+}
+
+# Keyword hits the inferred type needs over the runner-up before the vector leg is pre-filtered on it
+INCIDENT_TYPE_MIN_MARGIN = int(os.getenv("INCIDENT_TYPE_MIN_MARGIN", "1"))
+
+# Reciprocal-rank fusion constant; 60 is the value from the original RRF paper
+RRF_K = 60
+
+
+def infer_incident_type(query: str) -> Optional[str]:
+    """
+    Infer the policy type of an accident description from keywords.
+
+    Args:
+        query (str): The accident description.
+
+    Returns:
+        str: The policy type with the most keyword hits, or None if nothing matches or no type leads the
+        runner-up by INCIDENT_TYPE_MIN_MARGIN hits. The search then runs without the type pre-filter.
+    """
+    text = query.lower()
+    hits = {
+        incident_type: sum(1 for keyword in keywords if re.search(r"\b" + re.escape(keyword) + r"\b", text))
+        for incident_type, keywords in INCIDENT_TYPE_KEYWORDS.items()
+    }
+    (incident_type, count), (_, runner_up) = sorted(hits.items(), key=lambda item: item[1], reverse=True)[:2]
+    return incident_type if count and count - runner_up >= INCIDENT_TYPE_MIN_MARGIN else None
+
+
+def _rank_scores(score_field: str) -> List[dict]:
+    """Stages that turn the ordered results of a search stage into reciprocal-rank scores."""
+    return [
+        {"$group": {"_id": None, "docs": {"$push": "$$ROOT"}}},
+        {"$unwind": {"path": "$docs", "includeArrayIndex": "rank"}},
+        {"$replaceRoot": {"newRoot": {"$mergeObjects": [
+            "$docs", {score_field: {"$divide": [1.0, {"$add": ["$rank", RRF_K, 1]}]}}
+        ]}}},
+    ]
+
+
+def rescore_full_precision(documents: List[dict], query_vector: List[float], embedding_key: str, k: int) -> List[dict]:
+    """
+    Re-rank hybrid search candidates with exact cosine similarity on the full-precision embeddings.
+
+    The vector leg's reciprocal rank is recomputed from the exact ranking and fused again with the
+    full-text leg, which corrects ordering errors introduced by a quantised index.
+
+    Args:
+        documents (List[dict]): Candidates that still carry their full-precision embedding.
+        query_vector (List[float]): Full-precision query embedding.
+        embedding_key (str): Field holding the full-precision embeddings.
+        k (int): Number of documents to keep.
+
+    Returns:
+        List[dict]: The best k documents, without their embedding.
+    """
+    if not documents:
+        return documents
+
+    # Stored vectors are decoded as zero-copy views over their BSON payload
+    query = np.asarray(query_vector, dtype=np.float32)
+    missing = np.zeros_like(query)
+    matrix = np.stack([from_bson_vector(doc.pop(embedding_key, None) or missing) for doc in documents]).astype(np.float32)
+    norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(query)
+    similarities = np.divide(matrix @ query, norms, out=np.zeros(len(documents), dtype=np.float32), where=norms > 0)
+
+    for rank, index in enumerate(np.argsort(-similarities)):
+        doc = documents[index]
+        doc["vs_score"] = 1.0 / (rank + RRF_K + 1)
+        doc["score"] = doc["vs_score"] + doc.get("fts_score", 0)
+    return sorted(documents, key=lambda doc: doc["score"], reverse=True)[:k]
+
+
+def hybrid_search(
+    collection: Collection,
+    embedding_model: Embeddings,
+    query: str,
+    k: int = 1,
+    vector_index_name: str = "description_index",
+    text_index_name: str = "policy_text_index",
+    embedding_key: str = "descriptionEmbedding",
+    text_paths: Optional[List[str]] = None,
+    num_candidates: int = 50,
+    incident_type: Optional[str] = None,
+    embedding_type: str = "float",
+    rescore_model: Optional[Embeddings] = None,
+    rescore_factor: int = 4,
+) -> List[dict]:
+    """
+    Hybrid policy retrieval: $vectorSearch pre-filtered by incident type fused with an Atlas $search
+    full-text query, merged with reciprocal-rank fusion in a single aggregation.
+
+    Args:
+        collection (Collection): The policy collection.
+        embedding_model (Embeddings): Model used to embed the query.
+        query (str): The accident description.
+        k (int): Number of policies to return.
+        vector_index_name (str): Name of the vector search index.
+        text_index_name (str): Name of the Atlas Search full-text index.
+        embedding_key (str): Field holding the policy embeddings.
+        text_paths (List[str]): Fields searched by the full-text leg. Defaults to name, tags and keyProvisions.
+        num_candidates (int): ANN candidates considered by $vectorSearch.
+        incident_type (str): Policy type to pre-filter on. Inferred from the query if not given.
+        embedding_type (str): Type of the indexed embeddings: "float", or "int8"/"ubinary" for
+            quantised BSON vectors stored next to the float field. Must match embedding_model.
+        rescore_model (Embeddings): Full-precision embedding model. When given, rescore_factor * k
+            candidates are fetched and re-ranked with exact cosine similarity on embedding_key.
+        rescore_factor (int): Over-fetch factor used when rescoring.
+
+    Returns:
+        List[dict]: The full policy documents, best first, with "score", "vs_score" and "fts_score".
+    """
+    text_paths = text_paths or ["name", "tags", "keyProvisions"]
+    incident_type = incident_type or infer_incident_type(query)
+    with start_span("embedding.query", embedding_type=embedding_type):
+        query_vector = embedding_model.embed_query(query)
+    # Over-fetch when rescoring so that the exact ranking can promote quantisation misses
+    limit = k * rescore_factor if rescore_model else k
+    # Each leg contributes more than k candidates so that fusion has something to rerank
+    leg_limit = max(limit * 5, 10)
+
+    vector_search = {
+        "index": vector_index_name,
+        "path": embedding_field_name(embedding_key, embedding_type),
+        "queryVector": to_bson_vector(query_vector, embedding_type),
+        "numCandidates": max(num_candidates, leg_limit),
+        "limit": leg_limit,
+    }
+    if incident_type:
+        vector_search["filter"] = {"type": {"$eq": incident_type}}
+
+    # Quantised embeddings are never needed client side, the full-precision one only for rescoring.
+    # Dropped right after each search stage so they don't travel through the fusion stages.
+    excluded = [embedding_field_name(embedding_key, t) for t in EMBEDDING_FIELD_SUFFIXES if t != "float"]
+    if not rescore_model:
+        excluded.append(embedding_key)
+    project_embeddings = {"$project": {field: 0 for field in excluded}}
+
+    pipeline = [
+        {"$vectorSearch": vector_search},
+        project_embeddings,
+        *_rank_scores("vs_score"),
+        {"$unionWith": {
+            "coll": collection.name,
+            "pipeline": [
+                {"$search": {
+                    "index": text_index_name,
+                    "text": {"query": query, "path": text_paths},
+                }},
+                {"$limit": leg_limit},
+                project_embeddings,
+                *_rank_scores("fts_score"),
+            ],
+        }},
+        # Documents found by both legs are merged and their reciprocal ranks added up
+        {"$group": {
+            "_id": "$_id",
+            "doc": {"$first": "$$ROOT"},
+            "vs_score": {"$max": "$vs_score"},
+            "fts_score": {"$max": "$fts_score"},
+        }},
+        {"$replaceRoot": {"newRoot": {"$mergeObjects": [
+            "$doc",
+            {
+                "vs_score": {"$ifNull": ["$vs_score", 0]},
+                "fts_score": {"$ifNull": ["$fts_score", 0]},
+                "score": {"$add": [{"$ifNull": ["$vs_score", 0]}, {"$ifNull": ["$fts_score", 0]}]},
+            },
+        ]}}},
+        {"$sort": {"score": -1, "_id": 1}},
+        {"$limit": limit},
+    ]
+
+    with start_span("vector.hybrid_search", k=k, num_candidates=vector_search["numCandidates"],
+                    embedding_type=embedding_type, incident_type=incident_type, rescore=bool(rescore_model)) as span:
+        start = time.perf_counter()
+        documents = list(collection.aggregate(pipeline))
+        VECTOR_SEARCH_LATENCY.labels(embedding_type=embedding_type).observe(time.perf_counter() - start)
+        span.set_attribute("results", len(documents))
+
+    if rescore_model:
+        rescore_vector = query_vector if embedding_type == "float" else rescore_model.embed_query(query)
+        documents = rescore_full_precision(documents, rescore_vector, embedding_key, k)
+
+    return documents
+
@@ -0,0 +1,114 @@
+from embeddings.bedrock.client import BedrockClient
+from tracing import traced_bedrock_runtime
+from metrics import count_bedrock_throttles
+from rate_limiter import rate_limited_bedrock_runtime, rate_limiter_enabled
+from bedrock_router import bedrock_regions, routed_bedrock_runtime
+
+from functools import lru_cache
+import os
+import logging
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+logger = logging.getLogger(__name__)
+
+# "live" talks to AWS Bedrock and MongoDB Atlas, "fake" runs everything in process (see fakes/)
+BACKEND_MODE = os.getenv("BACKEND_MODE", "live")
+# Per-service overrides, e.g. fake Bedrock with a real MongoDB shared by the API and the workers
+BEDROCK_BACKEND = os.getenv("BEDROCK_BACKEND", BACKEND_MODE)
+MONGO_BACKEND = os.getenv("MONGO_BACKEND", BACKEND_MODE)
+# Socket timeouts of the Bedrock client; a request's deadline bounds each call further (see deadline.py)
+BEDROCK_READ_TIMEOUT_SECONDS = float(os.getenv("BEDROCK_READ_TIMEOUT_SECONDS", "30"))
+BEDROCK_CONNECT_TIMEOUT_SECONDS = float(os.getenv("BEDROCK_CONNECT_TIMEOUT_SECONDS", "5"))
+
+
+def use_fake_bedrock() -> bool:
+    """Whether Bedrock is replaced by the in-process fake runtime."""
+    return BEDROCK_BACKEND == "fake"
+
+
+def use_fake_mongo() -> bool:
+    """Whether MongoDB is replaced by the in-process fake store."""
+    return MONGO_BACKEND == "fake"
+
+
+@lru_cache(maxsize=None)
+def get_bedrock_runtime(region_name: str = None, aws_access_key: str = None, aws_secret_key: str = None):
+    """
+    Get the process-wide Bedrock runtime client.
+
+    Calls are routed across the regions of BEDROCK_REGIONS, with failover, circuit breakers and
+    hedging (see bedrock_router.py). With a single region this is that region's client.
+
+    Args:
+        region_name (str): Region preferred over the other BEDROCK_REGIONS. Defaults to the first of them.
+        aws_access_key (str): The AWS access key ID. Defaults to AWS_ACCESS_KEY_ID.
+        aws_secret_key (str): The AWS secret access key. Defaults to AWS_SECRET_ACCESS_KEY.
+
+    Returns:
+        The Bedrock runtime client.
+    """
+    return routed_bedrock_runtime([
+        (region, get_regional_bedrock_runtime(region, aws_access_key, aws_secret_key))
+        for region in bedrock_regions(region_name)
+    ])
+
+
+@lru_cache(maxsize=None)
+def get_regional_bedrock_runtime(region_name: str, aws_access_key: str = None, aws_secret_key: str = None):
+    """
+    Get the process-wide Bedrock runtime client of one region.
+
+    In fake mode this is a deterministic FakeBedrockRuntime, so callers never need to know
+    which backend they are talking to. Either way, model invocations go through the shared
+    rate limiter (see rate_limiter.py).
+
+    Args:
+        region_name (str): The AWS region.
+        aws_access_key (str): The AWS access key ID. Defaults to AWS_ACCESS_KEY_ID.
+        aws_secret_key (str): The AWS secret access key. Defaults to AWS_SECRET_ACCESS_KEY.
+
+    Returns:
+        The Bedrock runtime client.
+    """
+    if use_fake_bedrock():
+        from fakes.bedrock import FakeBedrockRuntime
+        logger.info(f"Using fake Bedrock runtime for region {region_name}")
+        return rate_limited_bedrock_runtime(traced_bedrock_runtime(FakeBedrockRuntime(region_name=region_name)))
+
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/guide/credentials.html
+    # The rate limiter retries throttled calls itself, after waiting for a token
+    return rate_limited_bedrock_runtime(traced_bedrock_runtime(count_bedrock_throttles(BedrockClient(
+        aws_access_key=aws_access_key or os.getenv("AWS_ACCESS_KEY_ID"),
+        aws_secret_key=aws_secret_key or os.getenv("AWS_SECRET_ACCESS_KEY"),
+        region_name=region_name,
+    )._get_bedrock_client(
+        max_attempts=1 if rate_limiter_enabled() else 10,
+        read_timeout=BEDROCK_READ_TIMEOUT_SECONDS,
+        connect_timeout=BEDROCK_CONNECT_TIMEOUT_SECONDS,
+    ))))
+
+
+@lru_cache(maxsize=None)
+def create_fake_mongo_client():
+    """
+    Create the in-process MongoDB stand-in, seeded with the sample policies.
+
+    There is one fake per process whatever the connection string, like a single cluster.
+
+    Returns:
+        FakeMongoClient: A client whose policy collection is ready for hybrid search.
+    """
+    from fakes.mongo import FakeMongoClient, seed_policies
+
+    client = FakeMongoClient()
+    seed_policies(client[os.getenv("DATABASE_NAME")][os.getenv("COLLECTION_NAME")])
+    return client
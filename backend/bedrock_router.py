@@ -0,0 +1,308 @@
+"""
+Multi-region routing of the Bedrock runtime calls.
+
+backends.get_bedrock_runtime builds one client per region of BEDROCK_REGIONS (each rate limited
+and traced on its own, see rate_limiter.py) and, when there is more than one region or hedging is
+on, puts a BedrockRouter in front of them:
+
+- Failover: a call goes to the first region whose circuit breaker lets it through. When it fails
+  with a throttling, server or connection error, after the retries of that region's rate limiter,
+  the next region is tried.
+- Circuit breakers: one per model and region. A breaker opens when, over its last BREAKER_WINDOW
+  calls, at least BEDROCK_BREAKER_FAILURE_RATE of them failed or were slower than
+  BEDROCK_BREAKER_SLOW_SECONDS. An open region is skipped for BEDROCK_BREAKER_OPEN_SECONDS, then a
+  single probe call decides whether it closes again.
+- Hedging: calls to the models of BEDROCK_HEDGED_MODELS (idempotent ones such as the Cohere
+  embeddings and the vision model) fire a second request to the next region when the first has
+  not answered within the model's recent p95 latency. The first answer wins and the other one is
+  dropped, so at most about 5% of the calls are sent twice. Streams count as answered once they
+  start.
+
+BEDROCK_INFERENCE_PROFILES maps model ids to cross-region inference profiles (e.g.
+"us.anthropic.claude-3-haiku-20240307-v1:0") so that Bedrock itself can also spread the load.
+"""
+
+from metrics import BEDROCK_BREAKER_STATE, BEDROCK_HEDGED_CALLS, BEDROCK_REGION_CALLS
+from rate_limiter import error_code, is_retryable_error
+from deadline import DeadlineExceeded
+
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait
+import contextvars
+import json
+import os
+import threading
+import time
+import logging
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Ordered list of regions, e.g. "us-east-1,us-west-2". Defaults to AWS_REGION
+BEDROCK_REGIONS = [region.strip() for region in os.getenv("BEDROCK_REGIONS", "").split(",") if region.strip()]
+# Model id -> inference profile id or ARN, e.g. {"anthropic.claude-3-haiku-20240307-v1:0": "us.anthropic.claude-3-haiku-20240307-v1:0"}
+INFERENCE_PROFILES = json.loads(os.getenv("BEDROCK_INFERENCE_PROFILES", "{}"))
+# Models whose calls are hedged, e.g. "cohere.embed-english-v3,anthropic.claude-3-sonnet-20240229-v1:0"
+HEDGED_MODELS = {model.strip() for model in os.getenv("BEDROCK_HEDGED_MODELS", "").split(",") if model.strip()}
+HEDGE_WORKERS = int(os.getenv("BEDROCK_HEDGE_WORKERS", "32"))
+
+BREAKER_FAILURE_RATE = float(os.getenv("BEDROCK_BREAKER_FAILURE_RATE", "0.5"))
+BREAKER_SLOW_SECONDS = float(os.getenv("BEDROCK_BREAKER_SLOW_SECONDS", "20"))
+BREAKER_OPEN_SECONDS = float(os.getenv("BEDROCK_BREAKER_OPEN_SECONDS", "30"))
+# Calls over which the failure rate is measured, and the fewest that can open a breaker
+BREAKER_WINDOW = 20
+BREAKER_MIN_CALLS = 5
+
+# Latencies kept per model for the hedging delay, and the fewest needed before hedging starts
+LATENCY_WINDOW = 200
+HEDGE_MIN_SAMPLES = 20
+HEDGE_PERCENTILE = 0.95
+
+# Circuit breaker states, as reported by BEDROCK_BREAKER_STATE
+CLOSED = 0
+HALF_OPEN = 1
+OPEN = 2
+
+
+def bedrock_regions(region_name: str = None) -> list:
+    """
+    Get the regions Bedrock calls are routed to, in order of preference.
+
+    Args:
+        region_name (str): Region to prefer over the others, e.g. one a caller was configured with.
+
+    Returns:
+        list: BEDROCK_REGIONS, or AWS_REGION when it is not set, with region_name first.
+    """
+    regions = BEDROCK_REGIONS or [os.getenv("AWS_REGION") or "us-east-1"]
+    if region_name:
+        regions = [region_name] + [region for region in regions if region != region_name]
+    return regions
+
+
+class CircuitBreaker:
+    """ Circuit breaker of one model in one region. """
+
+    def __init__(self, region: str, model_id: str) -> None:
+        self.region = region
+        self.model_id = model_id
+        self.state = CLOSED
+        self._outcomes = deque(maxlen=BREAKER_WINDOW)
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """Whether a call may go to this region now. Every allowed call must be recorded."""
+        with self._lock:
+            if self.state == OPEN and time.monotonic() - self._opened_at >= BREAKER_OPEN_SECONDS:
+                self._set_state(HALF_OPEN)
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and not self._probing:
+                # A single probe call at a time decides whether the region is healthy again
+                self._probing = True
+                return True
+            return False
+
+    def record(self, healthy: bool = None):
+        """
+        Record the outcome of an allowed call.
+
+        Args:
+            healthy (bool): Whether the region answered in time. None when the call never reached it.
+        """
+        with self._lock:
+            if self.state == HALF_OPEN and self._probing:
+                self._probing = False
+                if healthy:
+                    self._outcomes.clear()
+                    self._set_state(CLOSED)
+                    logger.info(f"Bedrock circuit for {self.model_id} in {self.region} closed")
+                elif healthy is not None:
+                    self._open()
+                return
+            if healthy is None or self.state != CLOSED:
+                return
+            self._outcomes.append(healthy)
+            failures = self._outcomes.count(False)
+            if len(self._outcomes) >= BREAKER_MIN_CALLS and failures / len(self._outcomes) >= BREAKER_FAILURE_RATE:
+                logger.warning(f"Bedrock circuit for {self.model_id} in {self.region} opened: "
+                               f"{failures} of the last {len(self._outcomes)} calls failed or were slow")
+                self._open()
+
+    def _open(self):
+        self._opened_at = time.monotonic()
+        self._set_state(OPEN)
+
+    def _set_state(self, state: int):
+        self.state = state
+        BEDROCK_BREAKER_STATE.labels(region=self.region, model_id=self.model_id).set(state)
+
+
+def _drop_response(future, stream_key: str = None):
+    """Close the response of a hedged call that lost the race, freeing its connection and slot."""
+    if future.cancelled() or future.exception() is not None:
+        return
+    body = future.result().get(stream_key or "body")
+    if hasattr(body, "close"):
+        body.close()
+
+
+class BedrockRouter:
+    """ Bedrock runtime client proxy that routes model invocations across regions. """
+
+    def __init__(self, clients: list) -> None:
+        """
+        Initialize the BedrockRouter class.
+
+        Args:
+            clients (list): (region, client) pairs in order of preference.
+        """
+        self._clients = clients
+        self._breakers = {}
+        self._latencies = defaultdict(lambda: deque(maxlen=LATENCY_WINDOW))
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        # Anything but the model invocations goes to the preferred region's client
+        return getattr(self._clients[0][1], name)
+
+    def invoke_model(self, **kwargs) -> dict:
+        return self._call("invoke_model", kwargs)
+
+    def converse(self, **kwargs) -> dict:
+        return self._call("converse", kwargs)
+
+    def invoke_model_with_response_stream(self, **kwargs) -> dict:
+        return self._call("invoke_model_with_response_stream", kwargs, stream_key="body")
+
+    def converse_stream(self, **kwargs) -> dict:
+        return self._call("converse_stream", kwargs, stream_key="stream")
+
+    def breaker(self, region: str, model_id: str) -> CircuitBreaker:
+        """Get the circuit breaker of a model in a region."""
+        with self._lock:
+            key = (region, model_id)
+            if key not in self._breakers:
+                self._breakers[key] = CircuitBreaker(region, model_id)
+            return self._breakers[key]
+
+    def hedge_delay(self, model_id: str) -> float:
+        """Seconds after which a call to the model is hedged: its recent p95 latency, or None if unknown."""
+        latencies = sorted(self._latencies[model_id])
+        if len(latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        return latencies[int(HEDGE_PERCENTILE * (len(latencies) - 1))]
+
+    def _call(self, operation: str, kwargs: dict, stream_key: str = None) -> dict:
+        model_id = kwargs.get("modelId", "unknown")
+        if model_id in INFERENCE_PROFILES:
+            kwargs = {**kwargs, "modelId": INFERENCE_PROFILES[model_id]}
+
+        delay = self.hedge_delay(model_id) if model_id in HEDGED_MODELS else None
+        if delay is None:
+            return self._failover(operation, kwargs, model_id)
+        return self._hedged(operation, kwargs, model_id, delay, stream_key)
+
+    def _failover(self, operation: str, kwargs: dict, model_id: str, first: int = 0) -> dict:
+        """Call the regions in order, starting at index first, until one answers."""
+        routes = self._clients[first:] + self._clients[:first]
+        error = None
+        attempted = False
+
+        for region, client in routes:
+            breaker = self.breaker(region, model_id)
+            if not breaker.allow():
+                continue
+            attempted = True
+            try:
+                return self._attempt(region, client, breaker, operation, kwargs, model_id)
+            except Exception as e:
+                if not is_retryable_error(e):
+                    raise
+                error = e
+                logger.warning(f"Bedrock call to {model_id} failed in {region} with {error_code(e)}, failing over")
+
+        if not attempted:
+            # Every circuit is open: try the preferred region rather than fail without a call
+            region, client = routes[0]
+            return self._attempt(region, client, None, operation, kwargs, model_id)
+        raise error
+
+    def _attempt(self, region: str, client, breaker: CircuitBreaker, operation: str, kwargs: dict,
+                 model_id: str) -> dict:
+        start = time.perf_counter()
+        try:
+            response = getattr(client, operation)(**kwargs)
+        except Exception as e:
+            failed = is_retryable_error(e)
+            if breaker:
+                # A refused deadline never reached the region; any other error is the region's answer
+                breaker.record(None if isinstance(e, DeadlineExceeded) else not failed)
+            BEDROCK_REGION_CALLS.labels(region=region, model_id=model_id, outcome="error" if failed else "rejected").inc()
+            raise
+
+        elapsed = time.perf_counter() - start
+        slow = elapsed > BREAKER_SLOW_SECONDS
+        if breaker:
+            breaker.record(not slow)
+        self._latencies[model_id].append(elapsed)
+        BEDROCK_REGION_CALLS.labels(region=region, model_id=model_id, outcome="slow" if slow else "ok").inc()
+        return response
+
+    def _hedged(self, operation: str, kwargs: dict, model_id: str, delay: float, stream_key: str = None) -> dict:
+        executor = _hedge_executor()
+        # Each request runs in a copy of the caller's context, so it sees the claim's deadline
+        primary = executor.submit(contextvars.copy_context().run, self._failover, operation, kwargs, model_id)
+        try:
+            return primary.result(timeout=delay)
+        except FutureTimeoutError:
+            pass
+
+        # The hedge starts at the next region; with a single region it goes to the same one
+        hedge = executor.submit(contextvars.copy_context().run, self._failover, operation, kwargs, model_id,
+                                1 % len(self._clients))
+        pending = {primary, hedge}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            # An answer wins over a failure that completed at the same time
+            for future in sorted(done, key=lambda f: f.exception() is not None):
+                if future.exception() is not None and pending:
+                    # The other request may still answer
+                    continue
+                winner = "primary" if future is primary else "hedge"
+                BEDROCK_HEDGED_CALLS.labels(model_id=model_id, winner=winner).inc()
+                for loser in pending:
+                    loser.add_done_callback(lambda f: _drop_response(f, stream_key))
+                return future.result()
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _hedge_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix="bedrock-hedge")
+        return _executor
+
+
+def routed_bedrock_runtime(clients: list):
+    """
+    Put a BedrockRouter in front of per-region Bedrock runtime clients.
+
+    Args:
+        clients (list): (region, client) pairs in order of preference.
+
+    Returns:
+        The router, or the only client when there is a single region and no model is hedged.
+    """
+    if len(clients) == 1 and not HEDGED_MODELS:
+        return clients[0][1]
+    return BedrockRouter(clients)
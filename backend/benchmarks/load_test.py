@@ -0,0 +1,355 @@
+"""
+Concurrent HTTP load test of the FastAPI app.
+
+Drives /imageDescriptor followed by /runAgent with the bundled test photos from N concurrent
+clients, for each requested concurrency level, and reports per level:
+
+- throughput in claims per second
+- p50 / p95 / p99 latency of each endpoint, and of the whole claim when --wait polls the job
+- error rate, by HTTP status or exception
+- loop lag: latency of GET / (an async no-op handler) probed during the run; it grows when
+  the event loop is blocked
+- average and peak CPU and peak RSS of the server processes (and claim workers, when spawned)
+
+The app can be started by the harness (--spawn) against any backend, including the fakes with
+injected latency, or an already running server can be targeted with --base-url and --server-pid.
+
+Usage (from the backend directory):
+
+    poetry run python -m benchmarks.load_test --spawn --bedrock fake --mongo fake --latency-ms 300 \\
+        --concurrency 1 10 50 200 --output load.json
+
+    # Whole claims through the queue: fake Bedrock, a MongoDB shared by the API and the workers
+    poetry run python -m benchmarks.load_test --spawn --spawn-workers 4 --bedrock fake --mongo live --wait
+"""
+
+import psutil
+import requests
+
+import numpy as np
+
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+import argparse
+import glob
+import itertools
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+BACKEND_DIR = os.path.join(os.path.dirname(__file__), "..")
+DEFAULT_PHOTOS = os.path.join(BACKEND_DIR, "test_photos")
+
+
+class LevelStats:
+    """ Thread-safe collection of latencies (ms) and errors for one concurrency level. """
+
+    def __init__(self) -> None:
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors = Counter()
+        self.claims = 0
+        self._lock = threading.Lock()
+
+    def record(self, name: str, milliseconds: float):
+        with self._lock:
+            self.latencies[name].append(milliseconds)
+
+    def error(self, name: str, kind: str):
+        with self._lock:
+            self.errors[f"{name}:{kind}"] += 1
+
+    def claim_done(self):
+        with self._lock:
+            self.claims += 1
+
+
+class ResourceSampler(threading.Thread):
+    """ Samples the CPU and RSS of a set of processes and their children. """
+
+    def __init__(self, pids: List[int], interval: float = 0.5) -> None:
+        super().__init__(daemon=True)
+        self.processes = [psutil.Process(pid) for pid in pids]
+        self.interval = interval
+        self.cpu: List[float] = []
+        self.rss: List[int] = []
+        self._stop_event = threading.Event()
+        self._tracked = {}
+
+    def _tree(self) -> List[psutil.Process]:
+        tree = []
+        for process in self.processes:
+            try:
+                tree.append(process)
+                tree.extend(process.children(recursive=True))
+            except psutil.NoSuchProcess:
+                pass
+        return tree
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            cpu, rss = 0.0, 0
+            for process in self._tree():
+                try:
+                    # cpu_percent compares with the previous call on the same Process object
+                    tracked = self._tracked.setdefault(process.pid, process)
+                    cpu += tracked.cpu_percent(None)
+                    rss += tracked.memory_info().rss
+                except psutil.NoSuchProcess:
+                    self._tracked.pop(process.pid, None)
+            self.cpu.append(cpu)
+            self.rss.append(rss)
+
+    def stop(self) -> dict:
+        self._stop_event.set()
+        self.join()
+        return {
+            "cpu_avg_percent": float(np.mean(self.cpu)) if self.cpu else None,
+            "cpu_max_percent": float(np.max(self.cpu)) if self.cpu else None,
+            "rss_max_mb": float(np.max(self.rss)) / 2 ** 20 if self.rss else None,
+        }
+
+
+def probe_loop_lag(base_url: str, stats: LevelStats, stop: threading.Event, interval: float = 0.1):
+    """Time GET / while the load runs; its latency rises when the event loop is blocked."""
+    session = requests.Session()
+    while not stop.wait(interval):
+        start = time.perf_counter()
+        try:
+            session.get(f"{base_url}/", timeout=30).raise_for_status()
+            stats.record("loop_lag", (time.perf_counter() - start) * 1000)
+        except requests.RequestException as e:
+            stats.error("loop_lag", type(e).__name__)
+
+
+def run_claim(session: requests.Session, base_url: str, photo: str, stats: LevelStats,
+              wait: bool, poll_interval: float, claim_timeout: float):
+    """Upload one photo, queue the agent run and optionally wait for the processed claim."""
+    claim_start = time.perf_counter()
+
+    # /imageDescriptor streams the description; time to first byte and full response
+    start = time.perf_counter()
+    try:
+        with open(photo, "rb") as f:
+            response = session.post(f"{base_url}/imageDescriptor",
+                                    files={"file": (os.path.basename(photo), f, "image/jpeg")},
+                                    stream=True, timeout=claim_timeout)
+        if response.status_code != 200:
+            stats.error("image_descriptor", str(response.status_code))
+            return
+        description_id = response.headers["X-Description-Id"]
+        first = True
+        for _ in response.iter_content(chunk_size=None):
+            if first:
+                stats.record("image_descriptor_ttfb", (time.perf_counter() - start) * 1000)
+                first = False
+        stats.record("image_descriptor", (time.perf_counter() - start) * 1000)
+    except requests.RequestException as e:
+        stats.error("image_descriptor", type(e).__name__)
+        return
+
+    # A fresh Idempotency-Key per claim, so that identical descriptions are not deduplicated
+    start = time.perf_counter()
+    try:
+        response = session.post(f"{base_url}/runAgent", params={"description_id": description_id},
+                                headers={"Idempotency-Key": str(uuid.uuid4())}, timeout=claim_timeout)
+        stats.record("run_agent", (time.perf_counter() - start) * 1000)
+        if response.status_code != 202:
+            stats.error("run_agent", str(response.status_code))
+            return
+        job_id = response.json()["job_id"]
+    except requests.RequestException as e:
+        stats.error("run_agent", type(e).__name__)
+        return
+
+    if wait:
+        deadline = time.perf_counter() + claim_timeout
+        while True:
+            try:
+                status = session.get(f"{base_url}/claims/{job_id}", timeout=claim_timeout).json().get("status")
+            except requests.RequestException as e:
+                stats.error("claim_status", type(e).__name__)
+                return
+            if status == "done":
+                break
+            if status == "failed":
+                stats.error("claim", "failed")
+                return
+            if time.perf_counter() > deadline:
+                stats.error("claim", "timeout")
+                return
+            time.sleep(poll_interval)
+
+    stats.record("claim", (time.perf_counter() - claim_start) * 1000)
+    stats.claim_done()
+
+
+def run_level(base_url: str, photos: List[str], concurrency: int, claims: int, pids: List[int],
+              wait: bool, poll_interval: float, claim_timeout: float) -> dict:
+    """Run `claims` claims from `concurrency` clients and summarise the level."""
+    stats = LevelStats()
+    photo_cycle = itertools.cycle(photos)
+    photo_lock = threading.Lock()
+    local = threading.local()
+
+    def client_task(_):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        with photo_lock:
+            photo = next(photo_cycle)
+        run_claim(local.session, base_url, photo, stats, wait, poll_interval, claim_timeout)
+
+    stop_probe = threading.Event()
+    probe = threading.Thread(target=probe_loop_lag, args=(base_url, stats, stop_probe), daemon=True)
+    sampler = ResourceSampler(pids) if pids else None
+
+    probe.start()
+    if sampler:
+        sampler.start()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(client_task, range(claims)))
+    elapsed = time.perf_counter() - start
+    stop_probe.set()
+    probe.join()
+    resources = sampler.stop() if sampler else {}
+
+    failed = sum(count for key, count in stats.errors.items() if not key.startswith("loop_lag"))
+    return {
+        "concurrency": concurrency,
+        "claims": claims,
+        "completed": stats.claims,
+        "duration_s": elapsed,
+        "throughput_per_s": stats.claims / elapsed if elapsed else 0.0,
+        "error_rate": failed / claims if claims else 0.0,
+        "errors": dict(stats.errors),
+        "latency_ms": {
+            name: {
+                "p50": float(np.percentile(values, 50)),
+                "p95": float(np.percentile(values, 95)),
+                "p99": float(np.percentile(values, 99)),
+                "max": float(np.max(values)),
+            }
+            for name, values in sorted(stats.latencies.items()) if values
+        },
+        **resources,
+    }
+
+
+def wait_until_up(base_url: str, timeout: float = 60.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if requests.get(f"{base_url}/", timeout=1).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"Server at {base_url} did not come up within {timeout}s")
+
+
+def spawn_app(args) -> List[subprocess.Popen]:
+    """Start the API (and optionally claim workers) with the requested backends."""
+    env = {
+        **os.environ,
+        "BEDROCK_BACKEND": args.bedrock,
+        "MONGO_BACKEND": args.mongo,
+        "FAKE_BEDROCK_LATENCY_MS": str(args.latency_ms),
+        "FAKE_BEDROCK_TOKEN_LATENCY_MS": str(args.token_latency_ms),
+        "FAKE_BEDROCK_JITTER": str(args.jitter),
+    }
+    processes = [subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(args.port),
+         "--workers", str(args.uvicorn_workers), "--log-level", "warning"],
+        cwd=BACKEND_DIR, env=env,
+    )]
+    if args.spawn_workers:
+        processes.append(subprocess.Popen(
+            [sys.executable, "claim_worker.py", "--workers", str(args.spawn_workers)],
+            cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL,
+        ))
+    return processes
+
+
+def print_table(levels: List[dict]):
+    header = (f"{'conc':>5} {'claims/s':>9} {'errors':>7} {'descr p50':>10} {'descr p99':>10} "
+              f"{'run p50':>8} {'run p99':>8} {'claim p95':>10} {'lag p99':>8} {'cpu avg':>8} {'rss MB':>7}")
+    print(header)
+    print("-" * len(header))
+    for level in levels:
+        latency = level["latency_ms"]
+
+        def get(name, q):
+            return latency.get(name, {}).get(q, float("nan"))
+
+        cpu = level.get("cpu_avg_percent")
+        rss = level.get("rss_max_mb")
+        print(f"{level['concurrency']:>5} {level['throughput_per_s']:>9.2f} {level['error_rate']:>7.1%} "
+              f"{get('image_descriptor', 'p50'):>10.0f} {get('image_descriptor', 'p99'):>10.0f} "
+              f"{get('run_agent', 'p50'):>8.0f} {get('run_agent', 'p99'):>8.0f} {get('claim', 'p95'):>10.0f} "
+              f"{get('loop_lag', 'p99'):>8.0f} {cpu if cpu is not None else float('nan'):>8.0f} "
+              f"{rss if rss is not None else float('nan'):>7.0f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load test /imageDescriptor + /runAgent at several concurrency levels.")
+    parser.add_argument("--base-url", default=None, help="Server to test. Defaults to the spawned one.")
+    parser.add_argument("--photos", default=DEFAULT_PHOTOS, help="Directory of accident photos.")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 50, 200])
+    parser.add_argument("--claims-per-client", type=int, default=3, help="Claims per concurrent client and level.")
+    parser.add_argument("--wait", action="store_true", help="Poll GET /claims/{job_id} until each claim is processed.")
+    parser.add_argument("--poll-interval", type=float, default=0.5)
+    parser.add_argument("--claim-timeout", type=float, default=300.0, help="Seconds before a request or claim counts as failed.")
+    parser.add_argument("--server-pid", type=int, nargs="*", default=[], help="Processes to sample CPU/RSS of.")
+    parser.add_argument("--output", help="Write the per-level results to this JSON file.")
+
+    spawn = parser.add_argument_group("spawned server")
+    spawn.add_argument("--spawn", action="store_true", help="Start uvicorn main:app for the test.")
+    spawn.add_argument("--port", type=int, default=8765)
+    spawn.add_argument("--uvicorn-workers", type=int, default=1)
+    spawn.add_argument("--spawn-workers", type=int, default=0, help="Claim worker processes to start.")
+    spawn.add_argument("--bedrock", choices=["live", "fake"], default="fake")
+    spawn.add_argument("--mongo", choices=["live", "fake"], default="fake")
+    spawn.add_argument("--latency-ms", type=float, default=0, help="Injected latency of each fake Bedrock call.")
+    spawn.add_argument("--token-latency-ms", type=float, default=0, help="Injected delay per fake streamed token.")
+    spawn.add_argument("--jitter", type=float, default=0, help="Relative jitter of the injected latencies.")
+    args = parser.parse_args()
+
+    photos = sorted(glob.glob(os.path.join(args.photos, "*")))
+    if not photos:
+        sys.exit(f"No photos found in {args.photos}")
+    if args.spawn and args.mongo == "fake" and (args.spawn_workers or args.uvicorn_workers > 1):
+        sys.exit("The fake MongoDB lives inside one process; use --mongo live to share it with workers.")
+
+    processes = spawn_app(args) if args.spawn else []
+    base_url = args.base_url or f"http://127.0.0.1:{args.port}"
+    pids = args.server_pid + [process.pid for process in processes]
+
+    try:
+        wait_until_up(base_url)
+        levels = []
+        for concurrency in args.concurrency:
+            level = run_level(base_url, photos, concurrency, concurrency * args.claims_per_client, pids,
+                              args.wait, args.poll_interval, args.claim_timeout)
+            levels.append(level)
+            print(f"concurrency {concurrency}: {level['completed']}/{level['claims']} claims, "
+                  f"{level['throughput_per_s']:.2f}/s, errors {level['errors'] or 'none'}")
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+    print()
+    print_table(levels)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"base_url": base_url, "wait": args.wait, "levels": levels}, f, indent=2)
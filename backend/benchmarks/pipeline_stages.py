@@ -0,0 +1,252 @@
+"""
+Per-stage latency benchmark of the claim pipeline.
+
+Runs the bundled test photos through every hop of one claim and times each one separately:
+
+- image_encode: reading the photo, resizing it if needed and base64 encoding it
+- vision_ttft / vision_total: time from the vision call to its first streamed token and to the full
+  description, for the photo encoded in the previous stage
+- query_embedding: embedding the description
+- vector_search: hybrid policy retrieval with a precomputed query embedding
+- chatbot_turn: every LLM turn of the agent graph (also per turn: chatbot_turn_1, chatbot_turn_2, ...)
+- tools_node and tool:<name>: every tool node execution and every tool, persist_data included
+- agent_total: the whole agent graph run
+- claim_read: the read and normalisation step behind GET /claims/{job_id}
+
+Results are written as JSON keyed by stage, so two runs can be compared with --baseline to
+catch a regression in any single hop. Each agent run persists a claim, so run it against the
+fake backends (BACKEND_MODE=fake) or a development cluster.
+
+Usage (from the backend directory):
+
+    BACKEND_MODE=fake poetry run python -m benchmarks.pipeline_stages --iterations 10 --output before.json
+    BACKEND_MODE=fake poetry run python -m benchmarks.pipeline_stages --iterations 10 --baseline before.json
+"""
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.embeddings import Embeddings
+
+from pic2textApi import _stream_description, _vision_request
+from image_batch import preprocess_image
+from vision_routing import choose_route, model_for
+from agent_tools import (EMBEDDING_TYPE, INDEX_NAME, TEXT_INDEX_NAME, VECTOR_NUM_CANDIDATES,
+                         claim_idempotency_key, get_query_embedding_model)
+from agent_vector_store import hybrid_search
+from insurance_agent import get_graph, initial_state, _tool_output_object_id
+from mongo_client import get_collection
+from backends import BACKEND_MODE, get_bedrock_runtime
+from claims_api import load_claim_document
+
+import numpy as np
+
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Dict, List
+import argparse
+import glob
+import json
+import os
+import subprocess
+import sys
+import time
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+DEFAULT_PHOTOS = os.path.join(os.path.dirname(__file__), "..", "test_photos")
+
+# Graph nodes timed as a whole
+GRAPH_NODES = {"chatbot": "chatbot_turn", "tools": "tools_node"}
+
+
+class StageTimer(BaseCallbackHandler):
+    """ Callback handler that times the graph nodes and tools of an agent run. """
+
+    def __init__(self, timings: Dict[str, List[float]]) -> None:
+        self.timings = timings
+        self.starts = {}
+        self.turns = 0
+        self.object_id = None
+
+    def on_chain_start(self, serialized, inputs, *, run_id, name: str = None, **kwargs):
+        if name in GRAPH_NODES:
+            self.starts[run_id] = (name, time.perf_counter())
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        if run_id not in self.starts:
+            return
+        name, start = self.starts.pop(run_id)
+        elapsed = (time.perf_counter() - start) * 1000
+        self.timings[GRAPH_NODES[name]].append(elapsed)
+        if name == "chatbot":
+            self.turns += 1
+            self.timings[f"chatbot_turn_{self.turns}"].append(elapsed)
+
+    def on_tool_start(self, serialized, input_str, *, run_id, name: str = None, **kwargs):
+        self.starts[run_id] = (name or serialized.get("name"), time.perf_counter())
+
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        if run_id not in self.starts:
+            return
+        name, start = self.starts.pop(run_id)
+        self.timings[f"tool:{name}"].append((time.perf_counter() - start) * 1000)
+        self.object_id = _tool_output_object_id(output) or self.object_id
+
+
+class FixedQueryEmbedding(Embeddings):
+    """ Returns an embedding computed beforehand, so that vector_search times only the search. """
+
+    def __init__(self, vector: List[float]) -> None:
+        self.vector = vector
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self.vector for _ in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.vector
+
+
+def run_claim(photo: str, graph, timings: Dict[str, List[float]]):
+    """Run one photo through every stage of the pipeline, appending the stage timings in ms."""
+    start = time.perf_counter()
+    image = preprocess_image(photo)
+    timings["image_encode"].append((time.perf_counter() - start) * 1000)
+
+    model_id, max_tokens = model_for(choose_route(image["source_bytes"])[0])
+    request_body = _vision_request([image], max_tokens)
+    start = time.perf_counter()
+    chunks = []
+    for chunk in _stream_description(get_bedrock_runtime(), model_id, request_body):
+        if not chunks:
+            timings["vision_ttft"].append((time.perf_counter() - start) * 1000)
+        chunks.append(chunk)
+    timings["vision_total"].append((time.perf_counter() - start) * 1000)
+    description = "".join(chunks)
+
+    start = time.perf_counter()
+    query_vector = get_query_embedding_model().embed_query(description)
+    timings["query_embedding"].append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    hybrid_search(
+        collection=get_collection(os.getenv("COLLECTION_NAME")),
+        embedding_model=FixedQueryEmbedding(query_vector),
+        query=description,
+        vector_index_name=INDEX_NAME,
+        text_index_name=TEXT_INDEX_NAME,
+        num_candidates=VECTOR_NUM_CANDIDATES,
+        embedding_type=EMBEDDING_TYPE,
+    )
+    timings["vector_search"].append((time.perf_counter() - start) * 1000)
+
+    timer = StageTimer(timings)
+    claim_idempotency_key.set(None)
+    start = time.perf_counter()
+    graph.invoke(initial_state(description), {"recursion_limit": 15, "callbacks": [timer]})
+    timings["agent_total"].append((time.perf_counter() - start) * 1000)
+
+    if timer.object_id:
+        start = time.perf_counter()
+        load_claim_document(timer.object_id)
+        timings["claim_read"].append((time.perf_counter() - start) * 1000)
+
+
+def summarize(timings: Dict[str, List[float]]) -> Dict[str, dict]:
+    """Summary statistics per stage, in milliseconds."""
+    return {
+        stage: {
+            "n": len(values),
+            "mean_ms": float(np.mean(values)),
+            "p50_ms": float(np.percentile(values, 50)),
+            "p95_ms": float(np.percentile(values, 95)),
+            "min_ms": float(np.min(values)),
+            "max_ms": float(np.max(values)),
+        }
+        for stage, values in sorted(timings.items()) if values
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def print_table(stages: Dict[str, dict], baseline: Dict[str, dict] = None, threshold: float = 0.2) -> List[str]:
+    """
+    Print the stage statistics, with the p50 change against a baseline when one is given.
+
+    Returns:
+        List[str]: Stages whose p50 regressed by more than threshold.
+    """
+    header = f"{'stage':<26} {'n':>4} {'p50 ms':>9} {'p95 ms':>9} {'mean ms':>9}"
+    if baseline:
+        header += f" {'base p50':>9} {'change':>8}"
+    print(header)
+    print("-" * len(header))
+
+    regressions = []
+    for stage, row in stages.items():
+        line = f"{stage:<26} {row['n']:>4} {row['p50_ms']:>9.2f} {row['p95_ms']:>9.2f} {row['mean_ms']:>9.2f}"
+        if baseline and stage in baseline:
+            base = baseline[stage]["p50_ms"]
+            change = (row["p50_ms"] - base) / base if base else 0.0
+            flag = " !" if change > threshold else ""
+            line += f" {base:>9.2f} {change:>+7.1%}{flag}"
+            if flag:
+                regressions.append(stage)
+        print(line)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time every stage of the claim pipeline.")
+    parser.add_argument("--photos", default=DEFAULT_PHOTOS, help="Directory of accident photos.")
+    parser.add_argument("--iterations", type=int, default=5, help="Timed claims; photos are used in turn.")
+    parser.add_argument("--warmup", type=int, default=1, help="Untimed claims run first.")
+    parser.add_argument("--output", help="JSON results file. Defaults to pipeline_stages_<commit>.json.")
+    parser.add_argument("--baseline", help="Earlier JSON results to compare against.")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="Relative p50 increase reported as a regression (exit code 1).")
+    args = parser.parse_args()
+
+    photos = sorted(glob.glob(os.path.join(args.photos, "*")))
+    if not photos:
+        sys.exit(f"No photos found in {args.photos}")
+
+    # The graph is compiled once, like in a long-running worker
+    graph = get_graph()
+
+    for i in range(args.warmup):
+        run_claim(photos[i % len(photos)], graph, defaultdict(list))
+
+    timings = defaultdict(list)
+    for i in range(args.iterations):
+        run_claim(photos[i % len(photos)], graph, timings)
+
+    commit = git_commit()
+    results = {
+        "commit": commit,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "backend_mode": BACKEND_MODE,
+        "iterations": args.iterations,
+        "stages": summarize(timings),
+    }
+
+    output = args.output or f"pipeline_stages_{commit}.json"
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)["stages"]
+
+    regressions = print_table(results["stages"], baseline, args.threshold)
+    print(f"\nResults written to {output}")
+    if regressions:
+        print(f"p50 regressions above {args.threshold:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
@@ -0,0 +1,143 @@
+"""
+Recall versus latency sweep of numCandidates and k on the policy vector index.
+
+Runs a labelled set of accident descriptions against Atlas $vectorSearch and against an exact
+in-process cosine baseline over the same embeddings, and reports for each (numCandidates, k):
+
+- recall@k: overlap of the Atlas top-k with the exact top-k
+- type@1: share of queries whose top result has the expected policy type
+- p50 / p95 latency of the $vectorSearch round trip
+- average BSON payload size of the returned documents
+
+Usage (from the backend directory):
+
+    poetry run python -m benchmarks.vector_search_sweep --num-candidates 10 20 50 100 --k 1 3 5
+"""
+
+from embeddings.bedrock.getters import get_embedding_model
+from embeddings.bson_vectors import from_bson_vector, to_bson_vector
+from mongo_client import get_collection
+
+import bson
+import numpy as np
+
+import argparse
+import json
+import os
+import time
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+DEFAULT_QUERIES = os.path.join(os.path.dirname(__file__), "..", "..", "data", "benchmark_queries.jsonl")
+
+
+def load_queries(path: str) -> list:
+    """Load the labelled queries: one JSON object with "query" and "expected_type" per line."""
+    with open(path, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def percentile(values: list, q: float) -> float:
+    return float(np.percentile(values, q)) if values else 0.0
+
+
+def exact_top_k(matrix: np.ndarray, ids: list, query_vector: np.ndarray, k: int) -> list:
+    """Exact cosine top-k over the in-process copy of the corpus."""
+    similarities = (matrix @ query_vector) / (np.linalg.norm(matrix, axis=1) * np.linalg.norm(query_vector))
+    return [ids[i] for i in np.argsort(-similarities)[:k]]
+
+
+def run_sweep(queries: list, num_candidates_values: list, k_values: list, repeats: int,
+              index_name: str, embedding_key: str, projection: dict) -> list:
+    """
+    Run every query for every (numCandidates, k) combination.
+
+    Returns:
+        list: One result row per combination.
+    """
+    collection = get_collection(os.getenv("COLLECTION_NAME"))
+    embedding_model = get_embedding_model(model_id="cohere.embed-english-v3")
+
+    # Exact baseline: the whole corpus decoded once into a matrix
+    corpus = list(collection.find({embedding_key: {"$exists": True}}, {embedding_key: 1, "type": 1}))
+    ids = [doc["_id"] for doc in corpus]
+    types = {doc["_id"]: doc.get("type") for doc in corpus}
+    matrix = np.stack([from_bson_vector(doc[embedding_key]) for doc in corpus]).astype(np.float32)
+
+    # Embeddings are computed once so that only the search itself is timed
+    query_vectors = [np.asarray(embedding_model.embed_query(q["query"]), dtype=np.float32) for q in queries]
+
+    rows = []
+    for num_candidates in num_candidates_values:
+        for k in k_values:
+            if num_candidates < k:
+                continue
+            latencies, recalls, type_hits, payloads = [], [], 0, []
+
+            for query, query_vector in zip(queries, query_vectors):
+                expected = exact_top_k(matrix, ids, query_vector, k)
+                pipeline = [
+                    {"$vectorSearch": {
+                        "index": index_name,
+                        "path": embedding_key,
+                        "queryVector": to_bson_vector(query_vector, "float"),
+                        "numCandidates": num_candidates,
+                        "limit": k,
+                    }},
+                    {"$project": projection},
+                ]
+
+                for _ in range(repeats):
+                    start = time.perf_counter()
+                    results = list(collection.aggregate(pipeline))
+                    latencies.append((time.perf_counter() - start) * 1000)
+
+                found = [doc["_id"] for doc in results]
+                recalls.append(len(set(found) & set(expected)) / len(expected) if expected else 0.0)
+                type_hits += int(bool(found) and types.get(found[0]) == query["expected_type"])
+                payloads.append(sum(len(bson.encode(doc)) for doc in results))
+
+            rows.append({
+                "num_candidates": num_candidates,
+                "k": k,
+                "recall_at_k": float(np.mean(recalls)),
+                "type_at_1": type_hits / len(queries),
+                "p50_ms": percentile(latencies, 50),
+                "p95_ms": percentile(latencies, 95),
+                "avg_payload_bytes": float(np.mean(payloads)),
+            })
+    return rows
+
+
+def print_table(rows: list):
+    header = f"{'numCandidates':>13} {'k':>3} {'recall@k':>9} {'type@1':>7} {'p50 ms':>8} {'p95 ms':>8} {'payload B':>10}"
+    print(header)
+    print("-" * len(header))
+    for row in rows:
+        print(f"{row['num_candidates']:>13} {row['k']:>3} {row['recall_at_k']:>9.3f} {row['type_at_1']:>7.3f} "
+              f"{row['p50_ms']:>8.1f} {row['p95_ms']:>8.1f} {row['avg_payload_bytes']:>10.0f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Sweep numCandidates and k on the policy vector index.")
+    parser.add_argument("--queries", default=DEFAULT_QUERIES, help="JSONL file of labelled queries.")
+    parser.add_argument("--num-candidates", type=int, nargs="+", default=[10, 20, 50, 100, 200])
+    parser.add_argument("--k", type=int, nargs="+", default=[1, 3, 5])
+    parser.add_argument("--repeats", type=int, default=5, help="Timed runs per query and configuration.")
+    parser.add_argument("--index", default="description_index")
+    parser.add_argument("--embedding-key", default="descriptionEmbedding")
+    parser.add_argument("--full-documents", action="store_true",
+                        help="Return full policies (minus embeddings) instead of _id and type, to measure payload.")
+    parser.add_argument("--output", help="Write the result rows to this JSON file.")
+    args = parser.parse_args()
+
+    projection = {args.embedding_key: 0} if args.full_documents else {"_id": 1, "type": 1}
+    rows = run_sweep(load_queries(args.queries), args.num_candidates, args.k, args.repeats,
+                     args.index, args.embedding_key, projection)
+    print_table(rows)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(rows, f, indent=2)
@@ -0,0 +1,285 @@
+"""
+Bulk ingestion of claim photos, e.g. to triage a catastrophe event.
+
+Reads a directory or a JSONL manifest of photos and runs every claim through vision, the agent
+and persistence, the same pipeline as /imageDescriptor followed by /runAgent:
+
+    python bulk_ingest.py test_photos
+    python bulk_ingest.py hail_2025.jsonl --concurrency 16 --checkpoint hail_2025.checkpoint.jsonl
+
+In a directory, each photo is a claim and each subdirectory is a claim with all the photos in it.
+Each manifest line is a claim: {"id": "...", "photos": ["a.jpg", "b.jpg"], "hint": "simple"}, with
+paths relative to the manifest; "photo" may replace "photos" and "hint" is optional.
+
+Claims run on a pool of --concurrency threads. Their Bedrock calls go through the shared rate
+limiter; with BEDROCK_RATE_LIMITER=mongo the run shares its budget with the API and the claim
+workers. Persisted claims are collected and written with insert_many, --batch-size at a time,
+and each written batch is appended to the checkpoint file. A rerun with the same checkpoint skips
+the claims already written, and retries the ones that failed.
+"""
+
+from agent_tools import claim_sink
+from claim_queue import ensure_job_indexes
+from claim_usage import ClaimUsage
+from deadline import VISION_DEADLINE_SECONDS, deadline_after
+from image_batch import VISION_MAX_PHOTOS
+from log_config import configure_logging
+from mongo_client import get_collection
+
+from pymongo.errors import BulkWriteError
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import argparse
+import json
+import os
+import sys
+import time
+import logging
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif", ".webp")
+DONE = "done"
+FAILED = "failed"
+# Seconds between two progress lines
+PROGRESS_INTERVAL_SECONDS = 10
+
+
+def _photos_in(directory: str) -> list:
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                  if name.lower().endswith(IMAGE_EXTENSIONS))
+
+
+def read_claims(source: str) -> list:
+    """
+    Read the claims of a directory or a JSONL manifest.
+
+    Args:
+        source (str): Path of the directory or the manifest.
+
+    Returns:
+        list: One dict per claim with its "id", its "photos" and an optional "hint".
+    """
+    if os.path.isdir(source):
+        claims = [{"id": os.path.abspath(photo), "photos": [photo]} for photo in _photos_in(source)]
+        for name in sorted(os.listdir(source)):
+            path = os.path.join(source, name)
+            if os.path.isdir(path) and _photos_in(path):
+                claims.append({"id": os.path.abspath(path), "photos": _photos_in(path)})
+        return claims
+
+    claims = []
+    base = os.path.dirname(os.path.abspath(source))
+    with open(source) as manifest:
+        for number, line in enumerate(manifest, start=1):
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            photos = entry.get("photos") or [entry["photo"]]
+            claims.append({
+                "id": str(entry.get("id") or f"{os.path.abspath(source)}:{number}"),
+                "photos": [os.path.join(base, photo) for photo in photos],
+                "hint": entry.get("hint"),
+            })
+    return claims
+
+
+def read_checkpoint(path: str) -> set:
+    """Ids of the claims a previous run has written, from its checkpoint file."""
+    done = set()
+    if path and os.path.exists(path):
+        with open(path) as checkpoint:
+            for line in checkpoint:
+                if line.strip():
+                    entry = json.loads(line)
+                    if entry["status"] == DONE:
+                        done.add(entry["id"])
+    return done
+
+
+def process_claim(claim: dict) -> tuple:
+    """
+    Describe the photos of a claim and run the agent on the description.
+
+    Returns:
+        tuple: The ObjectId of the claim and the claim documents to insert.
+    """
+    # Imported here so that reading the input and the checkpoint needs no Bedrock client
+    from insurance_agent import insurance_agent
+    from pic2textApi import stream_images_to_bedrock
+
+    if len(claim["photos"]) > VISION_MAX_PHOTOS:
+        raise ValueError(f"{len(claim['photos'])} photos, at most {VISION_MAX_PHOTOS} per claim")
+    usage = ClaimUsage()
+    description = "".join(stream_images_to_bedrock(claim["photos"], usage=usage, hint=claim.get("hint"),
+                                                    deadline=deadline_after(None, VISION_DEADLINE_SECONDS)))
+    if not description:
+        raise RuntimeError("No description")
+
+    # Claims persisted by this run are collected instead of inserted
+    documents = []
+    token = claim_sink.set(documents)
+    try:
+        object_id = insurance_agent(description, idempotency_key=f"bulk:{claim['id']}", usage=usage,
+                                    deadline=deadline_after(None))
+    finally:
+        claim_sink.reset(token)
+    return object_id, documents
+
+
+def write_claims(results: list) -> list:
+    """
+    Insert the claims of processed claims with one insert_many.
+
+    Claims already inserted by an earlier, interrupted run are skipped: their idempotency key is unique.
+
+    Args:
+        results (list): (claim, object_id, documents) of each processed claim.
+
+    Returns:
+        list: Checkpoint entries, one per claim.
+    """
+    documents = [document for _, _, claim_documents in results for document in claim_documents]
+    collection = get_collection(os.getenv("COLLECTION_NAME_2"))
+    failed, existing = {}, {}
+    if documents:
+        try:
+            collection.insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            duplicates = {}
+            for error in e.details["writeErrors"]:
+                document = documents[error["index"]]
+                # 11000: duplicate key, the claim is already there
+                if error["code"] == 11000 and document.get("idempotency_key"):
+                    duplicates[document["idempotency_key"]] = str(document["_id"])
+                else:
+                    failed[str(document["_id"])] = error["errmsg"]
+            for stored in collection.find({"idempotency_key": {"$in": list(duplicates)}}, {"idempotency_key": 1}):
+                existing[duplicates[stored["idempotency_key"]]] = str(stored["_id"])
+
+    entries = []
+    for claim, object_id, _ in results:
+        if object_id in failed:
+            entries.append({"id": claim["id"], "status": FAILED, "error": failed[object_id]})
+        else:
+            entries.append({"id": claim["id"], "status": DONE, "object_id": existing.get(object_id, object_id)})
+    return entries
+
+
+class Progress:
+    """ Throughput of a bulk run, printed every PROGRESS_INTERVAL_SECONDS and at the end. """
+
+    def __init__(self, total: int, skipped: int) -> None:
+        self.total = total
+        self.skipped = skipped
+        self.done = 0
+        self.failed = 0
+        self.photos = 0
+        self.start = time.perf_counter()
+        self._printed = self.start
+
+    def add(self, entries: list, photos: int):
+        self.done += sum(entry["status"] == DONE for entry in entries)
+        self.failed += sum(entry["status"] == FAILED for entry in entries)
+        self.photos += photos
+        if time.perf_counter() - self._printed >= PROGRESS_INTERVAL_SECONDS:
+            self.print()
+
+    def print(self, final: bool = False):
+        self._printed = time.perf_counter()
+        elapsed = max(self._printed - self.start, 1e-9)
+        print(f"{'Finished' if final else 'Progress'}: {self.done + self.failed}/{self.total} claims "
+              f"({self.done} written, {self.failed} failed, {self.skipped} skipped) in {elapsed:.1f}s, "
+              f"{self.done / elapsed * 60:.1f} claims/min, {self.photos / elapsed:.2f} photos/s", flush=True)
+
+
+def run_bulk_ingest(source: str, checkpoint_path: str = None, concurrency: int = 8, batch_size: int = 50) -> dict:
+    """
+    Run every claim of a directory or manifest that the checkpoint does not list as written.
+
+    Args:
+        source (str): Path of the directory or the JSONL manifest.
+        checkpoint_path (str): JSONL file of written and failed claims, appended to as the run goes.
+        concurrency (int): Claims processed at the same time.
+        batch_size (int): Claims written per insert_many.
+
+    Returns:
+        dict: Counts of "written", "failed" and "skipped" claims, and the "seconds" taken.
+    """
+    claims = read_claims(source)
+    done = read_checkpoint(checkpoint_path)
+    todo = [claim for claim in claims if claim["id"] not in done]
+    progress = Progress(len(todo), len(claims) - len(todo))
+    print(f"{len(claims)} claims in {source}, {len(claims) - len(todo)} already written", flush=True)
+    ensure_job_indexes()
+
+    checkpoint = open(checkpoint_path, "a") if checkpoint_path else None
+    results, photos = [], 0
+
+    def flush():
+        nonlocal results, photos
+        entries = write_claims([result for result in results if result[1]])
+        entries += [{"id": claim["id"], "status": FAILED, "error": error}
+                    for claim, object_id, error in results if object_id is None]
+        if checkpoint:
+            checkpoint.writelines(json.dumps(entry) + "\n" for entry in entries)
+            checkpoint.flush()
+            os.fsync(checkpoint.fileno())
+        progress.add(entries, photos)
+        results, photos = [], 0
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="bulk-claim") as executor:
+            pending = {}
+            claim_iter = iter(todo)
+            while True:
+                # Keep the pool busy without queueing every claim of the run at once
+                for claim in claim_iter:
+                    pending[executor.submit(process_claim, claim)] = claim
+                    if len(pending) >= concurrency * 2:
+                        break
+                if not pending:
+                    break
+
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    claim = pending.pop(future)
+                    photos += len(claim["photos"])
+                    try:
+                        object_id, documents = future.result()
+                        results.append((claim, object_id, documents))
+                    except Exception as e:
+                        logger.error(f"Claim {claim['id']} failed: {str(e)}")
+                        # No object id: the error takes its place
+                        results.append((claim, None, str(e)))
+                if len(results) >= batch_size:
+                    flush()
+        flush()
+    finally:
+        if checkpoint:
+            checkpoint.close()
+
+    progress.print(final=True)
+    return {"written": progress.done, "failed": progress.failed, "skipped": progress.skipped,
+            "seconds": time.perf_counter() - progress.start}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the claim pipeline on a directory or JSONL manifest of photos.")
+    parser.add_argument("source", help="Directory of photos, or JSONL manifest of claims.")
+    parser.add_argument("--checkpoint", default=None,
+                        help="Checkpoint file, to resume an interrupted run. Defaults to <source>.checkpoint.jsonl.")
+    parser.add_argument("--concurrency", type=int, default=int(os.getenv("BULK_CONCURRENCY", "8")),
+                        help="Claims processed at the same time.")
+    parser.add_argument("--batch-size", type=int, default=int(os.getenv("BULK_BATCH_SIZE", "50")),
+                        help="Claims written per insert_many.")
+    args = parser.parse_args()
+
+    configure_logging()
+    checkpoint_path = args.checkpoint or os.path.abspath(args.source).rstrip(os.sep) + ".checkpoint.jsonl"
+    summary = run_bulk_ingest(args.source, checkpoint_path, args.concurrency, args.batch_size)
+    sys.exit(1 if summary["failed"] else 0)
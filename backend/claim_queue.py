@@ -0,0 +1,334 @@
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from bson import ObjectId
+
+from mongo_client import get_collection
+from deadline import deadline_datetime
+
+from datetime import datetime, timedelta, timezone
+import hashlib
+import os
+import threading
+import logging
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+logger = logging.getLogger(__name__)
+
+JOBS_COLLECTION = os.getenv("JOBS_COLLECTION", "claim_jobs")
+LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "300"))
+MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+# A running job's lease is extended this often, so that only a dead worker's job expires
+HEARTBEAT_SECONDS = float(os.getenv("JOB_HEARTBEAT_SECONDS", str(LEASE_SECONDS / 3)))
+
+# Job lifecycle: queued -> running -> done | failed
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def get_jobs_collection():
+    """Get the collection that backs the claim job queue."""
+    return get_collection(JOBS_COLLECTION)
+
+
+def ensure_job_indexes():
+    """Create the indexes the claim queue relies on for claiming, lease recovery and deduplication."""
+    collection = get_jobs_collection()
+    collection.create_index([("status", ASCENDING), ("created_at", ASCENDING)])
+    collection.create_index([("status", ASCENDING), ("lease_expires_at", ASCENDING)])
+    collection.create_index("idempotency_key", unique=True)
+
+    # Claims written by persist_data during a queued run carry the job's key
+    get_collection(os.getenv("COLLECTION_NAME_2")).create_index(
+        "idempotency_key", unique=True,
+        partialFilterExpression={"idempotency_key": {"$exists": True}},
+    )
+
+
+def derive_idempotency_key(image_description: str) -> str:
+    """Derive an idempotency key from the accident description when the client sends none."""
+    return "sha256:" + hashlib.sha256(image_description.strip().encode("utf-8")).hexdigest()
+
+
+def enqueue_claim(image_description: str, idempotency_key: str = None, usage=None, profile: bool = False,
+                  deadline: float = None) -> tuple:
+    """
+    Enqueue an agent run for the given image description, at most once per idempotency key.
+
+    Concurrent and repeated requests with the same key share a single job: the first one
+    inserts it, the others get the queued, running or finished job back. Only a job that
+    failed permanently is put back on the queue, with the deadline of the new request.
+
+    Args:
+        image_description (str): The accident description produced by the vision step.
+        idempotency_key (str): Client supplied key. Derived from the description if not given.
+        usage (ClaimUsage): Token counts of the vision call, carried over to the claim.
+        profile (bool): Whether the worker runs the agent under the profiler.
+        deadline (float): Deadline set by the client in seconds since the epoch; time spent queued counts.
+            Without one, each attempt gets CLAIM_DEADLINE_SECONDS from when a worker leases the job.
+
+    Returns:
+        tuple: The job document and whether it was newly created by this call.
+    """
+    key = idempotency_key or derive_idempotency_key(image_description)
+    collection = get_jobs_collection()
+    now = _now()
+    deadline = deadline_datetime(deadline) if deadline else None
+
+    try:
+        result = collection.update_one(
+            {"idempotency_key": key},
+            {"$setOnInsert": {
+                "idempotency_key": key,
+                "status": QUEUED,
+                "image_description": image_description,
+                "usage": usage.model_dump() if usage else None,
+                "profile": profile,
+                "deadline": deadline,
+                "attempts": 0,
+                "created_at": now,
+                "updated_at": now,
+            }},
+            upsert=True,
+        )
+        created = result.upserted_id is not None
+    except DuplicateKeyError:
+        # Another request upserted the same key concurrently; share its job
+        created = False
+
+    job = collection.find_one({"idempotency_key": key})
+
+    if job["status"] == FAILED:
+        requeued = collection.find_one_and_update(
+            {"_id": job["_id"], "status": FAILED},
+            {"$set": {"status": QUEUED, "attempts": 0, "deadline": deadline, "updated_at": now}, "$unset": {"error": ""}},
+            return_document=ReturnDocument.AFTER,
+        )
+        # A concurrent request may have put the job back on the queue first
+        created = requeued is not None
+        job = requeued or collection.find_one({"_id": job["_id"]})
+
+    if created:
+        logger.info(f"Enqueued claim job {job['_id']}")
+    else:
+        logger.info(f"Reusing claim job {job['_id']} ({job['status']}) for idempotency key {key}")
+    return job, created
+
+
+def start_job(image_description: str, idempotency_key: str, worker_id: str, usage=None, deadline: float = None,
+              lease_seconds: int = LEASE_SECONDS) -> tuple:
+    """
+    Create a job that the caller runs itself, already leased to it, at most once per idempotency key.
+
+    Used by /runAgent/stream, which runs the agent inline: a retry with the same key finds the job
+    and follows it instead of running the agent again. The caller renews the lease with LeaseHeartbeat
+    and completes or fails the job; if it dies, the lease expires and a claim worker takes the job over.
+    A job that failed permanently is taken over by the caller.
+
+    Args:
+        image_description (str): The accident description produced by the vision step.
+        idempotency_key (str): The key of the run.
+        worker_id (str): Identifier of the calling process.
+        usage (ClaimUsage): Token counts of the vision call, carried over to the claim.
+        deadline (float): Deadline of the request in seconds since the epoch.
+        lease_seconds (int): How long the caller owns the job between two renewals.
+
+    Returns:
+        tuple: The job document and whether the caller must run it. If not, the job is queued,
+        running elsewhere or done.
+    """
+    collection = get_jobs_collection()
+    now = _now()
+    lease = {
+        "status": RUNNING,
+        "worker_id": worker_id,
+        "lease_id": ObjectId(),
+        "lease_expires_at": now + timedelta(seconds=lease_seconds),
+        "deadline": deadline_datetime(deadline) if deadline else None,
+        "attempts": 1,
+        "updated_at": now,
+    }
+
+    try:
+        result = collection.update_one(
+            {"idempotency_key": idempotency_key},
+            {"$setOnInsert": {
+                **lease,
+                "idempotency_key": idempotency_key,
+                "image_description": image_description,
+                "usage": usage.model_dump() if usage else None,
+                "profile": False,
+                "created_at": now,
+            }},
+            upsert=True,
+        )
+        created = result.upserted_id is not None
+    except DuplicateKeyError:
+        created = False
+
+    job = collection.find_one({"idempotency_key": idempotency_key})
+    if not created and job["status"] == FAILED:
+        taken_over = collection.find_one_and_update(
+            {"_id": job["_id"], "status": FAILED}, {"$set": lease, "$unset": {"error": ""}},
+            return_document=ReturnDocument.AFTER,
+        )
+        created = taken_over is not None
+        job = taken_over or collection.find_one({"_id": job["_id"]})
+    return job, created
+
+
+def find_claim_id(idempotency_key: str) -> str:
+    """Id of the claim persisted with an idempotency key, e.g. by a run that had no job, or None."""
+    claim = get_collection(os.getenv("COLLECTION_NAME_2")).find_one({"idempotency_key": idempotency_key}, {"_id": 1})
+    return str(claim["_id"]) if claim else None
+
+
+def claim_next_job(worker_id: str, lease_seconds: int = LEASE_SECONDS) -> dict:
+    """
+    Atomically claim the oldest runnable job and lease it to the given worker.
+
+    A job is runnable when it is queued, or when it is running but its lease has expired
+    (the worker that held it died). The claim is a single find_one_and_update, so two
+    workers can never lease the same job. Each lease gets its own lease_id: the worker
+    extends it with LeaseHeartbeat while the job runs, and completes or fails the job with it.
+
+    Args:
+        worker_id (str): Identifier of the worker claiming the job.
+        lease_seconds (int): How long the worker owns the job before it can be reclaimed.
+
+    Returns:
+        dict: The claimed job, with its lease_id, or None if the queue is empty.
+    """
+    now = _now()
+    return get_jobs_collection().find_one_and_update(
+        {
+            "$or": [
+                {"status": QUEUED},
+                {"status": RUNNING, "lease_expires_at": {"$lt": now}},
+            ],
+            "attempts": {"$lt": MAX_ATTEMPTS},
+        },
+        {
+            "$set": {
+                "status": RUNNING,
+                "worker_id": worker_id,
+                "lease_id": ObjectId(),
+                "lease_expires_at": now + timedelta(seconds=lease_seconds),
+                "updated_at": now,
+            },
+            "$inc": {"attempts": 1},
+        },
+        sort=[("created_at", ASCENDING)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+def _leased(job: dict) -> dict:
+    """Filter matching a job only while the lease it was claimed with is held."""
+    return {"_id": job["_id"], "lease_id": job["lease_id"], "status": RUNNING}
+
+
+def renew_lease(job: dict, lease_seconds: int = LEASE_SECONDS) -> bool:
+    """
+    Extend the lease of a running job.
+
+    Returns:
+        bool: False if the lease was lost, i.e. the job expired and was reclaimed or reaped.
+    """
+    now = _now()
+    result = get_jobs_collection().update_one(
+        _leased(job), {"$set": {"lease_expires_at": now + timedelta(seconds=lease_seconds), "updated_at": now}})
+    return result.modified_count == 1
+
+
+class LeaseHeartbeat:
+    """ Context manager that renews the lease of a job every HEARTBEAT_SECONDS from a background thread. """
+
+    def __init__(self, job: dict, interval: float = HEARTBEAT_SECONDS, lease_seconds: int = LEASE_SECONDS) -> None:
+        self.job = job
+        self.interval = interval
+        self.lease_seconds = lease_seconds
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"lease-{job['_id']}", daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                if not renew_lease(self.job, self.lease_seconds):
+                    self.lost = True
+                    logger.warning(f"Lost the lease of job {self.job['_id']}")
+                    return
+            except Exception as e:
+                # The lease still runs until lease_expires_at; the next beat tries again
+                logger.warning(f"Could not renew the lease of job {self.job['_id']}: {str(e)}")
+
+    def __enter__(self) -> "LeaseHeartbeat":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+
+def complete_job(job: dict, claim_id: str) -> bool:
+    """
+    Mark a leased job as done and record the id of the persisted claim.
+
+    Returns:
+        bool: False if the lease was lost; the job then belongs to another attempt.
+    """
+    result = get_jobs_collection().update_one(
+        _leased(job),
+        {"$set": {"status": DONE, "claim_id": claim_id, "updated_at": _now()},
+         "$unset": {"lease_expires_at": "", "lease_id": ""}},
+    )
+    return result.modified_count == 1
+
+
+def fail_job(job: dict, error: str) -> bool:
+    """
+    Record a failed attempt. The job goes back to the queue until MAX_ATTEMPTS is reached.
+
+    Returns:
+        bool: False if the lease was lost; the job then belongs to another attempt.
+    """
+    status = FAILED if job.get("attempts", 0) >= MAX_ATTEMPTS else QUEUED
+    result = get_jobs_collection().update_one(
+        _leased(job),
+        {"$set": {"status": status, "error": error, "updated_at": _now()},
+         "$unset": {"lease_expires_at": "", "lease_id": ""}},
+    )
+    return result.modified_count == 1
+
+
+def reap_expired_jobs() -> int:
+    """Fail running jobs whose lease expired after their last allowed attempt."""
+    result = get_jobs_collection().update_many(
+        {"status": RUNNING, "lease_expires_at": {"$lt": _now()}, "attempts": {"$gte": MAX_ATTEMPTS}},
+        {"$set": {"status": FAILED, "error": "Lease expired on final attempt", "updated_at": _now()},
+         "$unset": {"lease_expires_at": "", "lease_id": ""}},
+    )
+    return result.modified_count
+
+
+def get_job(job_id: str) -> dict:
+    """Get a job by its string id, or None if it does not exist."""
+    if not ObjectId.is_valid(job_id):
+        return None
+    return get_jobs_collection().find_one({"_id": ObjectId(job_id)})
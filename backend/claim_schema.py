@@ -0,0 +1,218 @@
+from pydantic import BaseModel, Field, ValidationInfo, field_validator, model_validator
+from pymongo.errors import CollectionInvalid, OperationFailure
+
+from mongo_client import get_collection
+
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Union
+import json
+import os
+import re
+import logging
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_MAP = {1: "Low", 2: "Medium", 3: "High", 4: "Critical"}
+
+
+def approval_level_label(tier: str) -> str:
+    """
+    Canonical approval level of a claim, from a key of the policy's approvalThresholds or its spelled-out form.
+
+    "supervisorApproval", "supervisor approval" and "Supervisor Approval" all give "Supervisor Approval",
+    so that the levels written by the agent and by the policy re-evaluation job compare equal.
+    """
+    words = re.sub(r"(?<=[a-z0-9])(?=[A-Z])", " ", tier).replace("_", " ").split()
+    return " ".join(word[:1].upper() + word[1:] for word in words)
+
+
+def _split_actions(text: str) -> List[str]:
+    """Split a free-text list of actions on new lines, bullets or dashes."""
+    for separator in ("\n", "•", "-"):
+        if separator in text:
+            return [line.strip() for line in text.split(separator) if line.strip()]
+    return [text]
+
+
+class ClaimRecommendation(BaseModel):
+    """Structured recommendation for the claim handler."""
+
+    immediate_actions: List[str] = Field(default_factory=list, description="3-5 specific tasks for the next 4 hours")
+    short_term_actions: List[str] = Field(default_factory=list, description="2-4 tasks for the next 24-72 hours")
+    approval_guidance: Dict[str, Any] = Field(default_factory=dict, description="Threshold amounts from the policy")
+    reserve_recommendations: Dict[str, Any] = Field(default_factory=dict, description="Initial and maximum reserve amounts")
+
+    @model_validator(mode="before")
+    @classmethod
+    def coerce_recommendation(cls, value):
+        """Accept the shapes the LLM produces (JSON strings, plain text, lists) and reshape them once."""
+        if isinstance(value, str):
+            try:
+                value = json.loads(value)
+            except ValueError:
+                return {"immediate_actions": _split_actions(value)}
+        if isinstance(value, list):
+            return {"immediate_actions": [str(action) for action in value]}
+        if value is None:
+            return {"immediate_actions": ["No specific recommendations generated"]}
+        if not isinstance(value, dict):
+            return {"immediate_actions": [str(value)]}
+        return value
+
+
+class ClaimRecord(BaseModel):
+    """Canonical claim document as stored in the claims collection."""
+
+    date: datetime = Field(default_factory=lambda: datetime.now(timezone.utc), description="ISO format timestamp")
+    description: str = Field(description="Concise accident summary")
+    recommendation: ClaimRecommendation = Field(
+        default_factory=lambda: ClaimRecommendation(immediate_actions=["No specific recommendations generated"]))
+    approval_level: str = Field(default="Unknown", description="Required approval tier based on policy thresholds")
+    estimated_reserves: Optional[Union[float, str, Dict[str, Any]]] = Field(
+        default=None, description="Dollar amounts based on policy guidelines")
+    priority: str = Field(default="Standard", description="Urgency level from the policy decision tree")
+    timeline: str = Field(default="Standard processing", description="Expected resolution timeframe")
+    claim_handler: str = Field(default="Not assigned", description="Name of the assigned claim handler")
+
+    @field_validator("priority", mode="before")
+    @classmethod
+    def coerce_priority(cls, value):
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return PRIORITY_MAP.get(value, "Standard")
+        return "Standard" if value is None else str(value)
+
+    @field_validator("approval_level", "timeline", "claim_handler", mode="before")
+    @classmethod
+    def coerce_text(cls, value, info: ValidationInfo):
+        if value is None:
+            return cls.model_fields[info.field_name].default
+        return value if isinstance(value, str) else str(value)
+
+    @field_validator("approval_level")
+    @classmethod
+    def normalize_approval_level(cls, value: str) -> str:
+        return approval_level_label(value)
+
+    @classmethod
+    def from_policy(cls, policy: Dict[str, Any], description: str) -> "ClaimRecord":
+        """
+        Claim built from a policy's default handler actions, thresholds and reserves, without the LLM.
+
+        Used when the deadline of a request runs out before the agent has answered.
+
+        Args:
+            policy (dict): The policy summary returned by fetch_guidelines.
+            description (str): The accident description.
+        """
+        actions = policy.get("handlerActions") or {}
+        return cls(
+            description=description,
+            recommendation=ClaimRecommendation(
+                immediate_actions=actions.get("immediate") or ["Log first notice of loss"],
+                short_term_actions=(actions.get("within24Hours") or []) + (actions.get("within72Hours") or []),
+                approval_guidance=policy.get("approvalThresholds") or {},
+                reserve_recommendations=policy.get("reserveGuidelines") or {},
+            ),
+            approval_level="Pending review",
+        )
+
+
+class PersistDataInput(BaseModel):
+    """Arguments of the persist_data tool."""
+
+    data: ClaimRecord
+
+
+# Fields returned to the frontend when a claim is read
+CLAIM_PROJECTION = {field: 1 for field in ClaimRecord.model_fields}
+
+# Server-side validator so that only canonical claim documents can be written
+CLAIM_JSON_SCHEMA = {
+    "bsonType": "object",
+    "required": ["date", "description", "recommendation", "approval_level", "priority", "timeline", "claim_handler"],
+    "properties": {
+        "date": {"bsonType": "date"},
+        "description": {"bsonType": "string"},
+        "recommendation": {
+            "bsonType": "object",
+            "required": ["immediate_actions", "short_term_actions", "approval_guidance", "reserve_recommendations"],
+            "properties": {
+                "immediate_actions": {"bsonType": "array", "items": {"bsonType": "string"}},
+                "short_term_actions": {"bsonType": "array", "items": {"bsonType": "string"}},
+                "approval_guidance": {"bsonType": "object"},
+                "reserve_recommendations": {"bsonType": "object"},
+            },
+        },
+        "approval_level": {"bsonType": "string"},
+        "estimated_reserves": {"bsonType": ["double", "int", "long", "decimal", "string", "object", "null"]},
+        "priority": {"bsonType": "string"},
+        "timeline": {"bsonType": "string"},
+        "claim_handler": {"bsonType": "string"},
+        # Token, cost and iteration totals, see claim_usage.ClaimUsage
+        "usage": {"bsonType": "object"},
+        # Version of the policy the claim is computed from, see policy_version.policy_reference
+        "policy": {
+            "bsonType": "object",
+            "required": ["id", "hash", "sections"],
+            "properties": {
+                "hash": {"bsonType": "string"},
+                "sections": {"bsonType": "object"},
+            },
+        },
+        # Last re-evaluation after an edit of the policy, see policy_reevaluation.py
+        "reevaluation": {"bsonType": "object"},
+    },
+}
+
+
+def ensure_claims_validator():
+    """Create the claims collection with the $jsonSchema validator, or apply it to the existing one."""
+    collection = get_collection(os.getenv("COLLECTION_NAME_2"))
+    db = collection.database
+
+    try:
+        db.create_collection(collection.name, validator={"$jsonSchema": CLAIM_JSON_SCHEMA},
+                             validationLevel="moderate")
+        logger.info(f"Created claims collection {collection.name} with schema validator")
+    except CollectionInvalid:
+        # Moderate validation leaves legacy documents readable until they are normalised
+        try:
+            db.command("collMod", collection.name, validator={"$jsonSchema": CLAIM_JSON_SCHEMA},
+                       validationLevel="moderate")
+        except OperationFailure as e:
+            logger.warning(f"Could not apply claims schema validator: {str(e)}")
+
+
+def normalize_existing_claims() -> int:
+    """
+    Rewrite claims stored before the schema existed into canonical form.
+
+    Returns:
+        int: Number of documents rewritten.
+    """
+    collection = get_collection(os.getenv("COLLECTION_NAME_2"))
+    normalized = 0
+
+    for document in collection.find({"$nor": [{"$jsonSchema": CLAIM_JSON_SCHEMA}]}):
+        record = ClaimRecord.model_validate(document)
+        collection.update_one({"_id": document["_id"]}, {"$set": record.model_dump()})
+        normalized += 1
+
+    logger.info(f"Normalized {normalized} legacy claim documents")
+    return normalized
+
+
+# One-off migration of legacy claim documents
+if __name__ == '__main__':
+    ensure_claims_validator()
+    normalize_existing_claims()
@@ -0,0 +1,145 @@
+from pydantic import BaseModel, Field
+from bson import ObjectId
+
+from mongo_client import get_collection
+from metrics import CLAIM_COST, CLAIM_GRAPH_ITERATIONS, LLM_COST, LLM_TOKENS
+
+from contextvars import ContextVar
+from typing import List, Optional
+import os
+import logging
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+logger = logging.getLogger(__name__)
+
+# On-demand Bedrock prices in USD per million tokens: input, output, cache read, cache write
+MODEL_PRICES = {
+    "anthropic.claude-3-haiku-20240307-v1:0": (0.25, 1.25, 0.03, 0.30),
+    "anthropic.claude-3-sonnet-20240229-v1:0": (3.00, 15.00, 0.30, 3.75),
+    "anthropic.claude-3-5-sonnet-20240620-v1:0": (3.00, 15.00, 0.30, 3.75),
+    "anthropic.claude-3-5-haiku-20241022-v1:0": (0.80, 4.00, 0.08, 1.00),
+}
+
+
+def model_cost(model_id: str, input_tokens: int, output_tokens: int,
+               cache_read_tokens: int = 0, cache_write_tokens: int = 0) -> float:
+    """
+    Cost of one model call in USD. Unknown models cost 0.
+
+    Args:
+        model_id (str): The Bedrock model id, with or without a cross-region prefix such as "us.".
+        input_tokens (int): All input tokens, cached ones included.
+        output_tokens (int): Output tokens.
+        cache_read_tokens (int): Input tokens read from the prompt cache.
+        cache_write_tokens (int): Input tokens written to the prompt cache.
+    """
+    prices = next((price for model, price in MODEL_PRICES.items() if model_id.endswith(model)), None)
+    if prices is None:
+        return 0.0
+    input_price, output_price, cache_read_price, cache_write_price = prices
+    uncached = max(input_tokens - cache_read_tokens - cache_write_tokens, 0)
+    return (uncached * input_price + output_tokens * output_price
+            + cache_read_tokens * cache_read_price + cache_write_tokens * cache_write_price) / 1_000_000
+
+
+class ModelCall(BaseModel):
+    """Token counts of one vision call or one LLM turn of the agent."""
+
+    stage: str = Field(description='"vision" or "agent"')
+    model_id: str
+    input_tokens: int = Field(default=0, description="All input tokens, cached ones included")
+    output_tokens: int = 0
+    cache_read_tokens: int = 0
+    cache_write_tokens: int = 0
+    latency_ms: float = 0.0
+    cost_usd: float = 0.0
+
+
+class ClaimUsage(BaseModel):
+    """Token, cost and iteration totals of one claim, stored on the claim document as "usage"."""
+
+    calls: List[ModelCall] = Field(default_factory=list)
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cache_read_tokens: int = 0
+    cache_write_tokens: int = 0
+    cost_usd: float = 0.0
+    llm_turns: int = 0
+    tool_rounds: int = 0
+    graph_iterations: int = Field(default=0, description="Graph node executions: LLM turns plus tool rounds")
+    incident_type: Optional[str] = None
+    prompt_version: Optional[str] = None
+    agent_latency_ms: Optional[float] = None
+    degraded: bool = Field(default=False, description="The agent did not persist a claim, e.g. the deadline ran out, and it was built from the policy defaults")
+    vision_route: Optional[str] = Field(default=None, description='"fast", "strong" or "escalated"; None for an explicit model')
+
+    def add_call(self, stage: str, model_id: str, input_tokens: int = 0, output_tokens: int = 0,
+                 cache_read_tokens: int = 0, cache_write_tokens: int = 0, latency_ms: float = 0.0) -> ModelCall:
+        """Record one model call, add it to the totals and to the token metrics."""
+        call = ModelCall(
+            stage=stage, model_id=model_id,
+            input_tokens=input_tokens, output_tokens=output_tokens,
+            cache_read_tokens=cache_read_tokens, cache_write_tokens=cache_write_tokens,
+            latency_ms=latency_ms,
+            cost_usd=model_cost(model_id, input_tokens, output_tokens, cache_read_tokens, cache_write_tokens),
+        )
+        self.calls.append(call)
+        self.input_tokens += input_tokens
+        self.output_tokens += output_tokens
+        self.cache_read_tokens += cache_read_tokens
+        self.cache_write_tokens += cache_write_tokens
+        self.cost_usd += call.cost_usd
+        if stage == "agent":
+            self.llm_turns += 1
+            self.graph_iterations += 1
+
+        for kind, count in (("input", input_tokens), ("output", output_tokens),
+                            ("cache_read", cache_read_tokens), ("cache_write", cache_write_tokens)):
+            if count:
+                LLM_TOKENS.labels(stage=stage, model_id=model_id, kind=kind).inc(count)
+        LLM_COST.labels(stage=stage, model_id=model_id).inc(call.cost_usd)
+        return call
+
+    def add_tool_round(self):
+        """Record one execution of the tools node."""
+        self.tool_rounds += 1
+        self.graph_iterations += 1
+
+
+# Usage of the claim being processed, set by insurance_agent for the duration of a run
+claim_usage: ContextVar[Optional[ClaimUsage]] = ContextVar("claim_usage", default=None)
+
+
+def record_claim_usage(object_id: str, usage: ClaimUsage, document: dict = None):
+    """
+    Store the usage of a finished agent run on its claim and export the per-claim metrics.
+
+    Args:
+        object_id (str): The ObjectId of the claim persisted by the run, if any.
+        usage (ClaimUsage): The usage collected during the run.
+        document (dict): The claim, if it is still to be inserted; the usage is set on it instead.
+    """
+    labels = {"incident_type": usage.incident_type or "unknown", "prompt_version": usage.prompt_version or "unknown"}
+    CLAIM_COST.labels(**labels).observe(usage.cost_usd)
+    CLAIM_GRAPH_ITERATIONS.labels(**labels).observe(usage.graph_iterations)
+
+    if not object_id:
+        return
+    if document is not None:
+        document["usage"] = usage.model_dump()
+        return
+    try:
+        get_collection(os.getenv("COLLECTION_NAME_2")).update_one(
+            {"_id": ObjectId(object_id)}, {"$set": {"usage": usage.model_dump()}})
+    except Exception as e:
+        # Accounting must never fail a claim that was persisted
+        logger.warning(f"Could not store usage on claim {object_id}: {str(e)}")
@@ -0,0 +1,112 @@
+from claim_queue import LeaseHeartbeat, claim_next_job, complete_job, fail_job, reap_expired_jobs, ensure_job_indexes
+from tracing import setup_tracing, start_span
+from profiling import profiled
+from deadline import deadline_after, deadline_timestamp
+from log_config import configure_logging
+from warmup import WORKER_WARMUP_STEPS, warm_up_until_ready
+from prometheus_client import start_http_server
+
+from contextlib import nullcontext
+from multiprocessing import Process
+import argparse
+import os
+import socket
+import time
+import logging
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL_SECONDS = float(os.getenv("JOB_POLL_INTERVAL_SECONDS", "1.0"))
+
+
+def run_worker(poll_interval: float = POLL_INTERVAL_SECONDS, metrics_port: int = None):
+    """
+    Claim jobs from the queue and run the insurance agent on them until interrupted.
+
+    Args:
+        poll_interval (float): Seconds to sleep when the queue is empty.
+        metrics_port (int): Port on which to serve Prometheus metrics, if any.
+    """
+    configure_logging()
+    if metrics_port:
+        start_http_server(metrics_port)
+    # Each worker process exports its own spans
+    setup_tracing()
+    # Imported here so that each worker process builds its own LLM, Bedrock and Mongo clients
+    from insurance_agent import insurance_agent
+    from claim_usage import ClaimUsage
+
+    worker_id = f"{socket.gethostname()}-{os.getpid()}"
+    # Connect, compile the graph and embed once before taking the first job
+    warm_up_until_ready(WORKER_WARMUP_STEPS)
+    logger.info(f"Claim worker {worker_id} started")
+
+    while True:
+        reap_expired_jobs()
+        job = claim_next_job(worker_id)
+        if job is None:
+            time.sleep(poll_interval)
+            continue
+
+        logger.info(f"Worker {worker_id} running job {job['_id']} (attempt {job['attempts']})")
+        with start_span("claim.job", job_id=str(job["_id"]), attempt=job["attempts"], worker_id=worker_id) as span:
+            # Keeps the job leased for as long as the agent runs, however long that is
+            with LeaseHeartbeat(job):
+                try:
+                    # Every attempt starts again from the vision usage recorded with the job
+                    usage = ClaimUsage.model_validate(job["usage"]) if job.get("usage") else None
+                    # The client's deadline, or CLAIM_DEADLINE_SECONDS from now: time spent queued under load
+                    # does not eat into a budget the client did not set
+                    deadline = deadline_timestamp(job.get("deadline")) or deadline_after(None)
+                    # Profiled runs are saved under the job id
+                    with profiled(str(job["_id"]), "runAgent") if job.get("profile") else nullcontext():
+                        object_id = insurance_agent(job["image_description"], idempotency_key=job["idempotency_key"],
+                                                    usage=usage, deadline=deadline)
+                    span.set_attribute("claim_id", object_id)
+                    if complete_job(job, object_id):
+                        logger.info(f"Job {job['_id']} done, claim {object_id}")
+                    else:
+                        # The claim is stored once anyway: persist_data dedupes it on the idempotency key
+                        logger.warning(f"Job {job['_id']} finished after its lease was lost, claim {object_id}")
+                except Exception as e:
+                    span.record_exception(e)
+                    logger.error(f"Job {job['_id']} failed: {str(e)}")
+                    if not fail_job(job, str(e)):
+                        logger.warning(f"Job {job['_id']} failed after its lease was lost")
+
+
+# Run a pool of worker processes
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run insurance agent workers against the claim job queue.")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("CLAIM_WORKERS", "2")),
+                        help="Number of worker processes to start.")
+    parser.add_argument("--metrics-port", type=int, default=int(os.getenv("WORKER_METRICS_PORT", "0")),
+                        help="Serve Prometheus metrics from worker i on this port + i. 0 disables them.")
+    args = parser.parse_args()
+
+    ensure_job_indexes()
+
+    processes = [
+        Process(target=run_worker, kwargs={"metrics_port": args.metrics_port + i if args.metrics_port else None}, daemon=True)
+        for i in range(args.workers)
+    ]
+    for process in processes:
+        process.start()
+
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        logger.info("Stopping claim workers")
+        for process in processes:
+            process.terminate()
@@ -0,0 +1,132 @@
+from fastapi import APIRouter, HTTPException, Query
+from pymongo import ASCENDING, DESCENDING
+from bson import ObjectId
+
+from mongo_client import get_collection
+from claim_schema import CLAIM_PROJECTION, ClaimRecord
+from claim_queue import DONE
+from json_encoder import BSONJSONResponse
+
+from datetime import datetime
+from typing import Optional
+import base64
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+MAX_PAGE_SIZE = 100
+
+# Filters that can be combined on the listing endpoint; each one leads a compound index
+EQUALITY_FILTERS = ["priority", "approval_level", "claim_handler"]
+
+# Listing returns a summary and the claim _id; GET /claims/by-id/{claim_id} sends the full claim
+SUMMARY_FIELDS = ["date", "description", "approval_level", "estimated_reserves", "priority", "timeline", "claim_handler"]
+
+
+def get_claims_collection():
+    """Get the collection where the agent persists processed claims."""
+    return get_collection(os.getenv("COLLECTION_NAME_2"))
+
+
+def ensure_claim_indexes():
+    """
+    Create the indexes used by the claims listing.
+
+    Every index ends with (date, _id) descending so that each filter combination is served
+    in sort order and the keyset cursor is a range scan on the same index.
+    """
+    collection = get_claims_collection()
+    collection.create_index([("date", DESCENDING), ("_id", DESCENDING)])
+    for field in EQUALITY_FILTERS:
+        collection.create_index([(field, ASCENDING), ("date", DESCENDING), ("_id", DESCENDING)])
+
+
+def encode_cursor(document: dict) -> str:
+    """Encode the sort key of the last claim of a page as an opaque cursor."""
+    key = f"{document['date'].isoformat()}|{document['_id']}"
+    return base64.urlsafe_b64encode(key.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> tuple:
+    """Decode a cursor produced by encode_cursor into its (date, _id) sort key."""
+    try:
+        date, object_id = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8").split("|")
+        return datetime.fromisoformat(date), ObjectId(object_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+@router.get("/claims")
+def list_claims(
+    priority: Optional[str] = None,
+    approval_level: Optional[str] = None,
+    claim_handler: Optional[str] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    fields: Optional[str] = Query(None, description="Comma separated claim fields to return"),
+    cursor: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=MAX_PAGE_SIZE),
+):
+    # Claims stored before the schema may have a string date; migrate them with claim_schema.py to list them
+    query = {"date": {"$type": "date"}}
+    for field, value in (("priority", priority), ("approval_level", approval_level), ("claim_handler", claim_handler)):
+        if value is not None:
+            query[field] = value
+
+    if date_from or date_to:
+        if date_from:
+            query["date"]["$gte"] = date_from
+        if date_to:
+            query["date"]["$lt"] = date_to
+
+    # Keyset pagination: continue strictly after the last (date, _id) of the previous page
+    if cursor:
+        last_date, last_id = decode_cursor(cursor)
+        query["$or"] = [
+            {"date": {"$lt": last_date}},
+            {"date": last_date, "_id": {"$lt": last_id}},
+        ]
+
+    if fields:
+        requested = [field.strip() for field in fields.split(",") if field.strip()]
+        unknown = [field for field in requested if field not in ClaimRecord.model_fields]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown claim fields: {', '.join(unknown)}")
+    else:
+        requested = SUMMARY_FIELDS
+
+    # date is always projected because the cursor is built from it
+    projection = {field: 1 for field in set(requested) | {"date"}}
+
+    documents = list(
+        get_claims_collection()
+        .find(query, projection)
+        .sort([("date", DESCENDING), ("_id", DESCENDING)])
+        .limit(limit + 1)
+    )
+
+    next_cursor = encode_cursor(documents[limit - 1]) if len(documents) > limit else None
+    # Encoded straight from the BSON documents, ObjectIds and dates included
+    return BSONJSONResponse({"claims": documents[:limit], "next_cursor": next_cursor})
+
+
+def load_claim_document(object_id: str) -> dict:
+    """Read a persisted claim. Claims are stored in canonical form, so only a projection is needed."""
+    document = None
+    if ObjectId.is_valid(object_id):
+        document = get_claims_collection().find_one({"_id": ObjectId(object_id)}, CLAIM_PROJECTION)
+
+    if document:
+        document["status"] = DONE
+        return document
+    else:
+        raise HTTPException(status_code=404, detail="Document not found")
+
+
+@router.get("/claims/by-id/{claim_id}")
+def get_claim_by_id(claim_id: str):
+    # The claim _id returned by the listing; GET /claims/{job_id} takes the id of the job instead
+    return BSONJSONResponse(load_claim_document(claim_id))
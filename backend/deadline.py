@@ -0,0 +1,133 @@
+"""
+Latency budgets of claim requests.
+
+/imageDescriptor, /runAgent and /runAgent/stream give each request a deadline: now plus the
+X-Request-Timeout header in seconds, or VISION_DEADLINE_SECONDS / CLAIM_DEADLINE_SECONDS by
+default. A queued run stores the client's deadline on the job, so the time spent in the queue
+counts against it; without X-Request-Timeout the default budget starts when a worker leases the job.
+
+During a run the deadline is the claim_deadline context variable, and it bounds every hop:
+
+- Graph nodes run inside deadline_scope: none starts past the deadline, and their MongoDB
+  operations run under pymongo.timeout, i.e. with timeoutMS set to the time left.
+- Each graph step is bounded by the time left when the run started (LangGraph's step_timeout).
+- The Bedrock rate limiter does not wait for a slot or a token, start a call or retry one past the
+  deadline, and stops reading a response stream when it passes.
+
+When the budget runs out before the agent has persisted its claim, insurance_agent persists one
+built from the retrieved policy's default handler actions instead, within DEADLINE_GRACE_SECONDS.
+"""
+
+import pymongo
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Optional
+import os
+import time
+import logging
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+CLAIM_DEADLINE_SECONDS = float(os.getenv("CLAIM_DEADLINE_SECONDS", "120"))
+VISION_DEADLINE_SECONDS = float(os.getenv("VISION_DEADLINE_SECONDS", "60"))
+# Time allowed after the deadline to persist a claim from the policy defaults
+DEADLINE_GRACE_SECONDS = float(os.getenv("DEADLINE_GRACE_SECONDS", "10"))
+
+# Deadline of the request being processed, in seconds since the epoch so that it can cross processes
+claim_deadline: ContextVar[Optional[float]] = ContextVar("claim_deadline", default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    """ Raised when the latency budget of a request has run out. """
+
+
+def deadline_after(timeout_seconds: float = None, default_seconds: float = CLAIM_DEADLINE_SECONDS) -> float:
+    """
+    Deadline of a request received now.
+
+    Args:
+        timeout_seconds (float): Budget sent by the client, e.g. in the X-Request-Timeout header.
+        default_seconds (float): Budget used when the client sends none.
+
+    Returns:
+        float: The deadline in seconds since the epoch.
+    """
+    return time.time() + (timeout_seconds if timeout_seconds and timeout_seconds > 0 else default_seconds)
+
+
+def deadline_datetime(deadline: float) -> datetime:
+    """The deadline as a UTC datetime, to store it in MongoDB."""
+    return datetime.fromtimestamp(deadline, timezone.utc)
+
+
+def deadline_timestamp(value: datetime) -> Optional[float]:
+    """The deadline stored in MongoDB as seconds since the epoch; pymongo returns naive UTC datetimes."""
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+def remaining() -> Optional[float]:
+    """Seconds left before the current deadline, or None when there is no deadline."""
+    deadline = claim_deadline.get()
+    return None if deadline is None else deadline - time.time()
+
+
+def check_deadline(stage: str):
+    """
+    Raise DeadlineExceeded if the current deadline has passed.
+
+    Args:
+        stage (str): What was about to start, for the error message.
+    """
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded(f"Deadline exceeded by {-left:.1f}s before {stage}")
+
+
+def _timed_out(error: Exception) -> bool:
+    # LangGraph's step timeout raises TimeoutError; pymongo errors caused by timeoutMS have .timeout set
+    return isinstance(error, TimeoutError) or getattr(error, "timeout", False) is True
+
+
+@contextmanager
+def deadline_scope(deadline: float = None):
+    """
+    Context manager that applies a deadline to its body.
+
+    Timeouts raised after the deadline has passed, by MongoDB or by a graph step, are raised as
+    DeadlineExceeded so that callers can tell a spent budget from a failure. Without a deadline
+    the body runs unbounded.
+
+    Args:
+        deadline (float): Seconds since the epoch.
+
+    Raises:
+        DeadlineExceeded: The deadline passed before or while the body ran.
+    """
+    if deadline is None:
+        yield
+        return
+
+    token = claim_deadline.set(deadline)
+    try:
+        check_deadline("start")
+        with pymongo.timeout(max(deadline - time.time(), 0.001)):
+            yield
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        # The graph's step timeout runs on the monotonic clock, which can end a hair before the deadline
+        if _timed_out(e) and time.time() >= deadline - 0.1:
+            raise DeadlineExceeded(f"Deadline exceeded: {str(e)}") from e
+        raise
+    finally:
+        claim_deadline.reset(token)
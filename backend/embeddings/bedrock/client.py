@@ -22,6 +22,9 @@ class BedrockClient:
     def _get_bedrock_client(
             self,
             runtime: Optional[bool] = True,
+            max_attempts: Optional[int] = 10,
+            read_timeout: Optional[float] = 60,
+            connect_timeout: Optional[float] = 60,
     ):
         """Create a boto3 client for Amazon Bedrock, with optional configuration overrides."""
         if self.region_name is None:
@@ -38,8 +41,10 @@ class BedrockClient:
         
         retry_config = Config(
             region_name=target_region,
+            read_timeout=read_timeout,
+            connect_timeout=connect_timeout,
             retries={
-                "max_attempts": 10,
+                "max_attempts": max_attempts,
                 "mode": "standard",
             },
         )
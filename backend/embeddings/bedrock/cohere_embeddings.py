@@ -3,12 +3,15 @@ import logging
 import os
 from typing import Optional, List, Union
 
-import boto3
 from botocore.exceptions import ClientError
 from dotenv import load_dotenv
+from langchain_core.embeddings import Embeddings
+
+from embeddings.bson_vectors import embedding_field_name, to_bson_vector
+from backends import get_bedrock_runtime
+from mongo_client import get_mongo_client
 
 # MongoDB dependencies
-from pymongo import MongoClient
 import pymongo
 
 load_dotenv()
@@ -48,12 +51,7 @@ class BedrockCohereEnglishEmbeddings:
         self.model_id = model_id
         
         # Create Bedrock client
-        self.bedrock_client = boto3.client(
-            'bedrock-runtime',
-            aws_access_key_id=self.aws_access_key,
-            aws_secret_access_key=self.aws_secret_key,
-            region_name=self.region_name
-        )
+        self.bedrock_client = get_bedrock_runtime(self.region_name, self.aws_access_key, self.aws_secret_key)
         
         # MongoDB setup
         self.mongodb_uri = mongodb_uri or os.getenv("MONGODB_URI")
@@ -65,7 +63,7 @@ class BedrockCohereEnglishEmbeddings:
         # Establish MongoDB connection
         if self.mongodb_uri and self.database_name:
             try:
-                self.client = MongoClient(self.mongodb_uri)
+                self.client = get_mongo_client(self.mongodb_uri)
                 self.db = self.client[self.database_name]
                 logger.info(f"Successfully connected to MongoDB database: {self.database_name}")
             except Exception as e:
@@ -92,18 +90,34 @@ class BedrockCohereEnglishEmbeddings:
 
         return response
 
-    def predict(self, text: str):
+    def predict(self, text: str, input_type: str = "search_document", embedding_type: str = "float"):
         """ 
         Predict text embeddings based on the input text. 
 
         Args:
             text (str): The input text to generate embeddings for.
+            input_type (str): "search_document" for stored documents, "search_query" for queries.
+            embedding_type (str): "float", "int8" or "ubinary" (bit-packed unsigned bytes).
 
         Returns:
             list: The text embeddings generated by the model.
         """
-        input_type = "search_document"
-        embedding_types = ["float"]
+        embeddings = self.predict_types(text, input_type=input_type, embedding_types=[embedding_type])
+        return embeddings[embedding_type] if embeddings else None
+
+    def predict_types(self, text: str, input_type: str = "search_document", embedding_types: Optional[List[str]] = None):
+        """ 
+        Predict embeddings of several types for the same text in a single model call.
+
+        Args:
+            text (str): The input text to generate embeddings for.
+            input_type (str): "search_document" for stored documents, "search_query" for queries.
+            embedding_types (list): Any of "float", "int8" and "ubinary". Defaults to ["float"].
+
+        Returns:
+            dict: The embedding of each requested type, keyed by type.
+        """
+        embedding_types = embedding_types or ["float"]
 
         try:
             body = json.dumps({
@@ -113,10 +127,9 @@ class BedrockCohereEnglishEmbeddings:
             )
             response = self.generate_text_embeddings(body=body)
             # Extract the response embeddings
-            response_embeddings = json.loads(response['body'].read())[
-                "embeddings"]["float"][0]
+            response_embeddings = json.loads(response['body'].read())["embeddings"]
 
-            return response_embeddings
+            return {embedding_type: response_embeddings[embedding_type][0] for embedding_type in embedding_types}
         except ClientError as err:
             message = err.response["Error"]["Message"]
             self.log.error("A client error occurred: %s", message)
@@ -127,7 +140,8 @@ class BedrockCohereEnglishEmbeddings:
                                  field_to_embed: str, 
                                  embedding_field: str = 'embedding',
                                  batch_size: int = 100,
-                                 query: Optional[dict] = None):
+                                 query: Optional[dict] = None,
+                                 embedding_types: Optional[List[str]] = None):
         """
         Generate embeddings for a specified field in a MongoDB collection.
         
@@ -139,6 +153,10 @@ class BedrockCohereEnglishEmbeddings:
             batch_size (int, optional): Number of documents to process in each batch. 
                                         Defaults to 100.
             query (dict, optional): Additional MongoDB query to filter documents.
+            embedding_types (list, optional): Embedding types to store, any of "float", "int8" and
+                                              "ubinary". Quantised types are stored as BSON binary
+                                              vectors in <embedding_field>Int8 / <embedding_field>Binary.
+                                              Defaults to ["float"].
         
         Returns:
             int: Number of documents processed and updated.
@@ -151,9 +169,13 @@ class BedrockCohereEnglishEmbeddings:
             # Get the collection
             collection = self.db[collection_name]
             
+            embedding_types = embedding_types or ["float"]
+            fields = {embedding_type: embedding_field_name(embedding_field, embedding_type)
+                      for embedding_type in embedding_types}
+            
             # Construct query to find documents without embeddings
             base_query = {
-                embedding_field: {'$exists': False},
+                '$or': [{field: {'$exists': False}} for field in fields.values()],
                 field_to_embed: {'$exists': True, '$ne': ''}
             }
             
@@ -177,14 +199,15 @@ class BedrockCohereEnglishEmbeddings:
                         if field_to_embed not in doc or not doc[field_to_embed]:
                             continue
                         
-                        # Generate embedding for the specified field
-                        embedding = self.predict(str(doc[field_to_embed]))
+                        # Generate all requested embedding types in one call
+                        embeddings = self.predict_types(str(doc[field_to_embed]), embedding_types=embedding_types)
                         
-                        if embedding:
-                            # Update the document with the embedding
+                        if embeddings:
+                            # Update the document with the embeddings
                             collection.update_one(
                                 {'_id': doc['_id']},
-                                {'$set': {embedding_field: embedding}}
+                                {'$set': {fields[embedding_type]: to_bson_vector(embedding, embedding_type)
+                                          for embedding_type, embedding in embeddings.items()}}
                             )
                             processed_count += 1
                             
@@ -207,6 +230,38 @@ class BedrockCohereEnglishEmbeddings:
             self.client.close()
             self.log.info("MongoDB connection closed.")
 
+class BedrockCohereQuantizedEmbeddings(Embeddings):
+    """ LangChain embeddings that return Cohere int8 or ubinary (bit-packed) embeddings. """
+
+    def __init__(self, client, model_id: str = "cohere.embed-english-v3", embedding_type: str = "int8") -> None:
+        """
+        Initialize the BedrockCohereQuantizedEmbeddings class.
+
+        Args:
+            client: The Bedrock runtime client.
+            model_id (str): The model ID to use. Only accepts Cohere Embed models.
+            embedding_type (str): "int8" or "ubinary".
+        """
+        self.client = client
+        self.model_id = model_id
+        self.embedding_type = embedding_type
+
+    def _embed(self, texts: List[str], input_type: str) -> List[List[int]]:
+        response = self.client.invoke_model(
+            body=json.dumps({"texts": texts, "input_type": input_type, "embedding_types": [self.embedding_type]}),
+            modelId=self.model_id,
+            accept="*/*",
+            contentType="application/json"
+        )
+        return json.loads(response["body"].read())["embeddings"][self.embedding_type]
+
+    def embed_documents(self, texts: List[str]) -> List[List[int]]:
+        return self._embed(texts, "search_document")
+
+    def embed_query(self, text: str) -> List[int]:
+        return self._embed([text], "search_query")[0]
+
+
 # Example usage
 if __name__ == '__main__':
     # Initialize the embeddings generator
@@ -1,5 +1,7 @@
-from embeddings.bedrock.client import BedrockClient
+from backends import get_bedrock_runtime
+from embeddings.bedrock.cohere_embeddings import BedrockCohereQuantizedEmbeddings
 from langchain_aws import BedrockEmbeddings
+from langchain_core.embeddings import Embeddings
 
 from dotenv import load_dotenv
 import os
@@ -17,20 +19,26 @@ logging.basicConfig(
 # Load environment variables from .env file
 load_dotenv()
 
-# Getting Bedrock Client
-# https://boto3.amazonaws.com/v1/documentation/api/latest/guide/credentials.html
-bedrock_client = BedrockClient(
-    aws_access_key=os.getenv("AWS_ACCESS_KEY_ID"),
-    aws_secret_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
-    region_name=os.getenv("AWS_REGION"),
-)._get_bedrock_client()
 
 
-def get_embedding_model(model_id: str) -> BedrockEmbeddings:
+def get_embedding_model(model_id: str, embedding_type: str = "float") -> Embeddings:
+    """Get the embedding model for the given model ID.
+
+    Args:
+        model_id (str): The Bedrock embedding model ID.
+        embedding_type (str): "float", or "int8"/"ubinary" for quantised Cohere embeddings.
+    """
+
+    if embedding_type != "float":
+        return BedrockCohereQuantizedEmbeddings(
+            client=get_bedrock_runtime(),
+            model_id=model_id,
+            embedding_type=embedding_type
+        )
 
     # Initialize BedrockEmbeddings with AWS credentials and region
     embedding_model = BedrockEmbeddings(
-        client=bedrock_client,
+        client=get_bedrock_runtime(),
         model_id=model_id
     )
 
@@ -47,7 +55,7 @@ def get_embedding(text: str, model_id: str) -> BedrockEmbeddings:
 
     # Initialize BedrockEmbeddings with AWS credentials and region
     embeddings = BedrockEmbeddings(
-        client=bedrock_client,
+        client=get_bedrock_runtime(),
         model_id=model_id
     )
 
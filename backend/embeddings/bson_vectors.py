@@ -0,0 +1,95 @@
+from bson.binary import Binary, BinaryVectorDtype, VECTOR_SUBTYPE
+import numpy as np
+
+from typing import List, Union
+
+# Cohere embedding types and how they are stored as BSON binary vectors.
+# "float" is packed as little-endian float32 (4 bytes per dimension instead of a keyed 8-byte
+# double per element), "int8" keeps one signed byte per dimension, and "ubinary" packs one bit
+# per dimension into unsigned bytes.
+EMBEDDING_DTYPES = {
+    "float": BinaryVectorDtype.FLOAT32,
+    "int8": BinaryVectorDtype.INT8,
+    "ubinary": BinaryVectorDtype.PACKED_BIT,
+}
+
+# NumPy layout of the payload of each BSON vector dtype
+_NUMPY_DTYPES = {
+    BinaryVectorDtype.FLOAT32: np.dtype("<f4"),
+    BinaryVectorDtype.INT8: np.dtype("i1"),
+    BinaryVectorDtype.PACKED_BIT: np.dtype("u1"),
+}
+
+# A BSON binary vector starts with a dtype byte and a padding byte
+_HEADER_SIZE = 2
+
+# Suffix of the document field that holds each quantised embedding next to the float one
+EMBEDDING_FIELD_SUFFIXES = {
+    "float": "",
+    "int8": "Int8",
+    "ubinary": "Binary",
+}
+
+
+def embedding_field_name(embedding_field: str, embedding_type: str) -> str:
+    """
+    Name of the field that stores the embedding of the given type.
+
+    Args:
+        embedding_field (str): Field that holds the full-precision embedding, e.g. descriptionEmbedding.
+        embedding_type (str): One of "float", "int8" or "ubinary".
+
+    Returns:
+        str: The field name, e.g. descriptionEmbeddingInt8.
+    """
+    if embedding_type not in EMBEDDING_FIELD_SUFFIXES:
+        raise ValueError(f"Unsupported embedding type: {embedding_type}")
+    return embedding_field + EMBEDDING_FIELD_SUFFIXES[embedding_type]
+
+
+def to_bson_vector(vector: Union[List[Union[int, float]], np.ndarray], embedding_type: str) -> Binary:
+    """
+    Encode an embedding as a BSON binary vector, for storage or as a $vectorSearch queryVector.
+
+    The payload is written straight from a NumPy buffer, which is much cheaper than encoding
+    one BSON element per dimension.
+
+    Args:
+        vector (list | np.ndarray): The embedding as returned by Cohere.
+        embedding_type (str): One of "float", "int8" or "ubinary".
+
+    Returns:
+        Binary: A BSON binary vector (subtype 9).
+    """
+    if embedding_type not in EMBEDDING_DTYPES:
+        raise ValueError(f"Unsupported embedding type: {embedding_type}")
+    dtype = EMBEDDING_DTYPES[embedding_type]
+    payload = np.asarray(vector, dtype=_NUMPY_DTYPES[dtype]).tobytes()
+    # dtype.value is the single header byte, followed by a zero padding byte
+    return Binary(dtype.value + b"\x00" + payload, subtype=VECTOR_SUBTYPE)
+
+
+def from_bson_vector(value: Union[Binary, bytes, List[float]]) -> np.ndarray:
+    """
+    Decode a stored embedding into a NumPy array without copying the payload.
+
+    Accepts BSON binary vectors as well as embeddings still stored as arrays of doubles.
+    Bit-packed vectors are unpacked to one 0/1 value per dimension.
+
+    Args:
+        value (Binary | bytes | list): The stored embedding.
+
+    Returns:
+        np.ndarray: The embedding. Read-only when it is a view over the BSON payload.
+    """
+    if not isinstance(value, (bytes, bytearray)):
+        return np.asarray(value, dtype=np.float32)
+
+    dtype = BinaryVectorDtype(bytes(value[:1]))
+    padding = value[1]
+    vector = np.frombuffer(value, dtype=_NUMPY_DTYPES[dtype], offset=_HEADER_SIZE)
+
+    if dtype == BinaryVectorDtype.PACKED_BIT:
+        bits = np.unpackbits(vector)
+        return bits[:len(bits) - padding] if padding else bits
+    return vector
@@ -0,0 +1,67 @@
+from pymongo import UpdateOne
+
+from embeddings.bson_vectors import to_bson_vector
+from mongo_client import get_collection
+
+import argparse
+import os
+import logging
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+logger = logging.getLogger(__name__)
+
+
+def pack_embedding_field(collection_name: str, embedding_field: str = "descriptionEmbedding", batch_size: int = 500) -> int:
+    """
+    Rewrite embeddings stored as arrays of doubles into packed BSON float32 binary vectors.
+
+    Only documents whose field is still an array are touched, so the migration can be
+    interrupted and re-run.
+
+    Args:
+        collection_name (str): Name of the MongoDB collection.
+        embedding_field (str): Field holding the embeddings.
+        batch_size (int): Number of documents rewritten per bulk write.
+
+    Returns:
+        int: Number of documents rewritten.
+    """
+    collection = get_collection(collection_name)
+    cursor = collection.find({embedding_field: {"$type": "array"}}, {embedding_field: 1}, batch_size=batch_size)
+
+    migrated = 0
+    operations = []
+    for doc in cursor:
+        operations.append(UpdateOne(
+            {"_id": doc["_id"]},
+            {"$set": {embedding_field: to_bson_vector(doc[embedding_field], "float")}}
+        ))
+        if len(operations) == batch_size:
+            migrated += collection.bulk_write(operations, ordered=False).modified_count
+            operations = []
+
+    if operations:
+        migrated += collection.bulk_write(operations, ordered=False).modified_count
+
+    logger.info(f"Packed {migrated} embeddings in {collection_name}.{embedding_field}")
+    return migrated
+
+
+# Example usage
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Pack array embeddings into BSON float32 binary vectors.")
+    parser.add_argument("--collection", default=os.getenv("COLLECTION_NAME"), help="Collection to migrate.")
+    parser.add_argument("--field", default="descriptionEmbedding", help="Embedding field to migrate.")
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+
+    pack_embedding_field(args.collection, args.field, args.batch_size)
@@ -0,0 +1,349 @@
+"""
+Deterministic stand-in for the Bedrock runtime client.
+
+Implements the two calls the backend makes, invoke_model and invoke_model_with_response_stream,
+for the three model families it uses:
+
+- Cohere Embed: bag-of-words feature hashing into a normalised 1024-d vector, so descriptions that
+  share words are close to each other. Supports the float, int8 and ubinary embedding types.
+- Claude with images (vision): streams a canned accident description picked from the image bytes.
+- Claude with tools (agent): scripted turns. The first turn calls fetch_guidelines, the second
+  calls persist_data with a claim built from the retrieved policy, and the third answers
+  FINAL ANSWER.
+
+Latency is injected per call and per streamed token so that load tests see realistic timing, and
+FAKE_BEDROCK_THROTTLE_RATE rejects that fraction of calls with a ThrottlingException.
+"""
+
+from botocore.exceptions import ClientError
+
+from types import SimpleNamespace
+from typing import List
+import hashlib
+import io
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+import uuid
+
+EMBEDDING_DIMENSIONS = 1024
+
+# Canned vision descriptions, one per bundled test photo scenario
+VISION_DESCRIPTIONS = [
+    "A yellow school bus has collided with a silver sedan at an intersection. The front of the car is "
+    "crushed against the side of the bus and emergency services are helping children off the bus.",
+    "A car has slid off an icy road during heavy snow and hit a guardrail. Visibility is poor and the "
+    "front bumper and headlights are damaged.",
+    "A multi-vehicle pile-up on a foggy highway involving several cars and a truck. Vehicles are "
+    "wedged together with heavy front and rear damage.",
+    "A pedestrian has been struck by a car at a crosswalk. The windshield is cracked and an ambulance "
+    "is attending to the injured person.",
+    "A car suffered a front tyre blowout at speed and veered into the median barrier. The wheel rim is "
+    "bent and the front wing is scraped.",
+]
+
+
+def _env_float(name: str, default: float) -> float:
+    return float(os.getenv(name, default))
+
+
+class _StreamingBody(io.BytesIO):
+    """Minimal botocore StreamingBody: read() returns the whole payload."""
+
+
+class FakeBedrockRuntime:
+    """ Deterministic Bedrock runtime client for offline runs and load tests. """
+
+    def __init__(self, region_name: str = "us-east-1", latency_ms: float = None, token_latency_ms: float = None,
+                 jitter: float = None, throttle_rate: float = None, seed: int = 0) -> None:
+        """
+        Initialize the FakeBedrockRuntime class.
+
+        Args:
+            region_name (str): Reported region, so region-aware callers can tell fakes apart.
+            latency_ms (float): Base latency of every call. Defaults to FAKE_BEDROCK_LATENCY_MS or 0.
+            token_latency_ms (float): Delay between streamed tokens. Defaults to FAKE_BEDROCK_TOKEN_LATENCY_MS or 0.
+            jitter (float): Relative random jitter applied to latencies. Defaults to FAKE_BEDROCK_JITTER or 0.
+            throttle_rate (float): Fraction of calls rejected as throttled. Defaults to FAKE_BEDROCK_THROTTLE_RATE or 0.
+            seed (int): Seed of the jitter generator.
+        """
+        self.meta = SimpleNamespace(region_name=region_name)
+        self.latency_ms = _env_float("FAKE_BEDROCK_LATENCY_MS", 0) if latency_ms is None else latency_ms
+        self.token_latency_ms = _env_float("FAKE_BEDROCK_TOKEN_LATENCY_MS", 0) if token_latency_ms is None else token_latency_ms
+        self.jitter = _env_float("FAKE_BEDROCK_JITTER", 0) if jitter is None else jitter
+        self.throttle_rate = _env_float("FAKE_BEDROCK_THROTTLE_RATE", 0) if throttle_rate is None else throttle_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    # -- timing -----------------------------------------------------------------------------
+
+    def _sleep(self, milliseconds: float):
+        if milliseconds <= 0:
+            return
+        with self._lock:
+            factor = 1 + self._random.uniform(-self.jitter, self.jitter) if self.jitter else 1
+        time.sleep(milliseconds * factor / 1000)
+
+    def _maybe_throttle(self, operation: str):
+        if not self.throttle_rate:
+            return
+        with self._lock:
+            throttled = self._random.random() < self.throttle_rate
+        if throttled:
+            raise ClientError({
+                "Error": {"Code": "ThrottlingException", "Message": "Too many requests, please wait before trying again."},
+                "ResponseMetadata": {"HTTPStatusCode": 429},
+            }, operation)
+
+    # -- public client API --------------------------------------------------------------------
+
+    def invoke_model(self, body, modelId: str, accept: str = "application/json",
+                     contentType: str = "application/json", **kwargs) -> dict:
+        request = json.loads(body)
+        self._sleep(self.latency_ms)
+        self._maybe_throttle("InvokeModel")
+
+        if modelId.startswith("cohere.embed"):
+            payload = self._embed(request)
+            input_tokens, output_tokens = sum(len(text.split()) for text in request["texts"]), 0
+        elif "anthropic" in modelId:
+            payload = self._claude_message(request, modelId)
+            input_tokens, output_tokens = payload["usage"]["input_tokens"], payload["usage"]["output_tokens"]
+        else:
+            raise ValueError(f"FakeBedrockRuntime does not support model {modelId}")
+
+        return {
+            "body": _StreamingBody(json.dumps(payload).encode("utf-8")),
+            "contentType": "application/json",
+            "ResponseMetadata": {"HTTPStatusCode": 200, "HTTPHeaders": {
+                "x-amzn-bedrock-input-token-count": str(input_tokens),
+                "x-amzn-bedrock-output-token-count": str(output_tokens),
+            }},
+        }
+
+    def invoke_model_with_response_stream(self, body, modelId: str, accept: str = "application/json",
+                                          contentType: str = "application/json", **kwargs) -> dict:
+        request = json.loads(body)
+        if "anthropic" not in modelId:
+            raise ValueError(f"FakeBedrockRuntime does not stream model {modelId}")
+
+        # Time to first byte is the call latency; tokens then trickle in
+        self._sleep(self.latency_ms)
+        self._maybe_throttle("InvokeModelWithResponseStream")
+        message = self._claude_message(request, modelId)
+        return {"body": self._stream_events(message), "ResponseMetadata": {"HTTPStatusCode": 200}}
+
+    def close(self):
+        pass
+
+    # -- Cohere embeddings --------------------------------------------------------------------
+
+    @staticmethod
+    def embed_text(text: str) -> List[float]:
+        """Feature-hashed, L2-normalised bag-of-words embedding of the text."""
+        vector = [0.0] * EMBEDDING_DIMENSIONS
+        for token in re.findall(r"[a-z0-9]+", text.lower()):
+            digest = hashlib.md5(token.encode("utf-8")).digest()
+            index = int.from_bytes(digest[:4], "little") % EMBEDDING_DIMENSIONS
+            vector[index] += 1.0 if digest[4] & 1 else -1.0
+        norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+        return [x / norm for x in vector]
+
+    def _embed(self, request: dict) -> dict:
+        floats = [self.embed_text(text) for text in request["texts"]]
+        embedding_types = request.get("embedding_types")
+        if not embedding_types:
+            return {"id": str(uuid.uuid4()), "texts": request["texts"], "embeddings": floats,
+                    "response_type": "embeddings_floats"}
+
+        embeddings = {}
+        for embedding_type in embedding_types:
+            if embedding_type == "float":
+                embeddings["float"] = floats
+            elif embedding_type == "int8":
+                embeddings["int8"] = [[max(-128, min(127, round(x * 127 * 8))) for x in vector] for vector in floats]
+            elif embedding_type == "ubinary":
+                embeddings["ubinary"] = [self._pack_bits(vector) for vector in floats]
+            else:
+                raise ValueError(f"Unsupported embedding type: {embedding_type}")
+        return {"id": str(uuid.uuid4()), "texts": request["texts"], "embeddings": embeddings,
+                "response_type": "embeddings_by_type"}
+
+    @staticmethod
+    def _pack_bits(vector: List[float]) -> List[int]:
+        packed = []
+        for start in range(0, len(vector), 8):
+            byte = 0
+            for x in vector[start:start + 8]:
+                byte = (byte << 1) | (1 if x > 0 else 0)
+            packed.append(byte)
+        return packed
+
+    # -- Claude messages ----------------------------------------------------------------------
+
+    def _claude_message(self, request: dict, model_id: str) -> dict:
+        messages = request.get("messages", [])
+        content = self._vision_turn(messages) if self._has_image(messages) else self._agent_turn(request, messages)
+        stop_reason = "tool_use" if any(block["type"] == "tool_use" for block in content) else "end_turn"
+        input_tokens = len(json.dumps(messages)) // 4 + len(request.get("system", "")) // 4
+        output_tokens = max(1, len(json.dumps(content)) // 4)
+
+        return {
+            "id": f"msg_{uuid.uuid4().hex[:24]}",
+            "type": "message",
+            "role": "assistant",
+            "model": model_id,
+            "content": content,
+            "stop_reason": stop_reason,
+            "stop_sequence": None,
+            "usage": {"input_tokens": input_tokens, "output_tokens": output_tokens},
+        }
+
+    @staticmethod
+    def _has_image(messages: list) -> bool:
+        return any(isinstance(message.get("content"), list) and
+                   any(block.get("type") == "image" for block in message["content"])
+                   for message in messages)
+
+    @staticmethod
+    def _vision_turn(messages: list) -> list:
+        images = [block["source"]["data"] for message in messages for block in message["content"]
+                  if isinstance(block, dict) and block.get("type") == "image"]
+        descriptions = []
+        for data in images:
+            index = int(hashlib.md5(data.encode("ascii")).hexdigest(), 16) % len(VISION_DESCRIPTIONS)
+            descriptions.append(VISION_DESCRIPTIONS[index])
+        return [{"type": "text", "text": " ".join(dict.fromkeys(descriptions))}]
+
+    @staticmethod
+    def _tool_results(messages: list) -> dict:
+        """Map tool_use ids of earlier turns to (tool name, result text)."""
+        names = {}
+        results = {}
+        for message in messages:
+            if not isinstance(message.get("content"), list):
+                continue
+            for block in message["content"]:
+                if block.get("type") == "tool_use":
+                    names[block["id"]] = block["name"]
+                elif block.get("type") == "tool_result":
+                    result = block.get("content")
+                    if isinstance(result, list):
+                        result = "".join(part.get("text", "") for part in result if isinstance(part, dict))
+                    results[names.get(block["tool_use_id"])] = result
+        return results
+
+    def _agent_turn(self, request: dict, messages: list) -> list:
+        results = self._tool_results(messages)
+        tool_names = {tool["name"] for tool in request.get("tools", [])}
+
+        if "fetch_guidelines" in tool_names and "fetch_guidelines" not in results:
+            description = self._first_user_text(messages)
+            return [
+                {"type": "text", "text": "I'll look up the most relevant policy for this accident."},
+                {"type": "tool_use", "id": f"toolu_{uuid.uuid4().hex[:24]}", "name": "fetch_guidelines",
+                 "input": {"query": description}},
+            ]
+
+        if "persist_data" in tool_names and "persist_data" not in results:
+            claim = self._claim_from_policy(results.get("fetch_guidelines"), self._first_user_text(messages))
+            return [
+                {"type": "text", "text": "Based on the policy, here is the claim summary. Persisting it now."},
+                {"type": "tool_use", "id": f"toolu_{uuid.uuid4().hex[:24]}", "name": "persist_data",
+                 "input": {"data": claim}},
+            ]
+
+        return [{"type": "text", "text": "FINAL ANSWER: The claim has been processed and persisted."}]
+
+    @staticmethod
+    def _first_user_text(messages: list) -> str:
+        for message in messages:
+            if message.get("role") != "user":
+                continue
+            content = message.get("content")
+            if isinstance(content, str):
+                return content.replace("This is the description of the accident: ", "")
+            for block in content:
+                if block.get("type") == "text":
+                    return block["text"].replace("This is the description of the accident: ", "")
+        return ""
+
+    @staticmethod
+    def _claim_from_policy(policy_text: str, description: str) -> dict:
+        """Build the persist_data payload the way the prompt asks, from the retrieved policy."""
+        try:
+            policy = json.loads(policy_text) if policy_text else {}
+        except ValueError:
+            policy = {}
+        actions = policy.get("handlerActions", {})
+        thresholds = policy.get("approvalThresholds", {})
+        supervisor = thresholds.get("supervisorApproval", {}).get("maxAmount", 25000)
+        auto = thresholds.get("autoApprove", {}).get("maxAmount", 5000)
+
+        def max_amount(tier) -> float:
+            amount = tier.get("maxAmount") if isinstance(tier, dict) else None
+            return amount if isinstance(amount, (int, float)) else math.inf
+
+        # The lowest tier covering the reserves, named by its approvalThresholds key as the prompt asks
+        tiers = sorted((max_amount(tier), name) for name, tier in thresholds.items() if max_amount(tier) >= auto * 3)
+
+        return {
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "description": description[:200],
+            "recommendation": {
+                "immediate_actions": actions.get("immediate", ["Log first notice of loss"])[:5],
+                "short_term_actions": actions.get("within24Hours", ["Schedule vehicle inspection"])[:4],
+                "approval_guidance": {"initial_reserve_threshold": supervisor, "supplement_estimate_threshold": auto},
+                "reserve_recommendations": {"initial_reserve": auto * 3, "maximum_reserve": supervisor * 2},
+            },
+            "approval_level": tiers[0][1] if tiers else "supervisorApproval",
+            "estimated_reserves": f"${auto * 3:,}",
+            "priority": "High",
+            "timeline": "1-3 days",
+            "claim_handler": "Alex Morgan",
+        }
+
+    # -- streaming ----------------------------------------------------------------------------
+
+    @staticmethod
+    def _event(payload: dict) -> dict:
+        return {"chunk": {"bytes": json.dumps(payload).encode("utf-8")}}
+
+    def _stream_events(self, message: dict):
+        """Yield the Anthropic messages streaming events for a complete message."""
+        usage = message["usage"]
+        yield self._event({"type": "message_start", "message": {
+            **{key: value for key, value in message.items() if key not in ("content", "stop_reason")},
+            "content": [], "stop_reason": None, "usage": {"input_tokens": usage["input_tokens"], "output_tokens": 1},
+        }})
+
+        for index, block in enumerate(message["content"]):
+            if block["type"] == "text":
+                yield self._event({"type": "content_block_start", "index": index,
+                                   "content_block": {"type": "text", "text": ""}})
+                for token in re.findall(r"\S+\s*", block["text"]):
+                    self._sleep(self.token_latency_ms)
+                    yield self._event({"type": "content_block_delta", "index": index,
+                                       "delta": {"type": "text_delta", "text": token}})
+            else:
+                yield self._event({"type": "content_block_start", "index": index,
+                                   "content_block": {"type": "tool_use", "id": block["id"], "name": block["name"], "input": {}}})
+                arguments = json.dumps(block["input"])
+                for start in range(0, len(arguments), 64):
+                    self._sleep(self.token_latency_ms)
+                    yield self._event({"type": "content_block_delta", "index": index,
+                                       "delta": {"type": "input_json_delta", "partial_json": arguments[start:start + 64]}})
+            yield self._event({"type": "content_block_stop", "index": index})
+
+        yield self._event({"type": "message_delta", "delta": {"stop_reason": message["stop_reason"], "stop_sequence": None},
+                           "usage": {"output_tokens": usage["output_tokens"]}})
+        yield self._event({"type": "message_stop", "amazon-bedrock-invocationMetrics": {
+            "inputTokenCount": usage["input_tokens"],
+            "outputTokenCount": usage["output_tokens"],
+            "invocationLatency": int(self.latency_ms),
+            "firstByteLatency": int(self.latency_ms),
+        }})
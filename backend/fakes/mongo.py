@@ -0,0 +1,337 @@
+"""
+In-process stand-in for MongoDB Atlas, built on mongomock.
+
+mongomock covers the CRUD and aggregation surface the backend uses. On top of it this module
+emulates the Atlas-only parts:
+
+- $vectorSearch: exact (brute-force) similarity over the stored embeddings, BSON binary vectors
+  included, with the index filter applied before ranking.
+- $search: term-match scoring of the "text" operator over the requested paths.
+- $unionWith, $mergeObjects in $replaceRoot, and {"$meta": "vectorSearchScore" | "searchScore"} in later stages.
+- Search index management (create_search_index / list_search_indexes), kept in memory.
+- bulk_write of UpdateOne operations, which mongomock cannot read from recent pymongo versions.
+- insert_many raising BulkWriteError with every failed write, as MongoDB does, where mongomock
+  raises the first DuplicateKeyError.
+- Unique indexes with an $exists partial filter on collections that already hold documents
+  without the field.
+"""
+
+from bson import json_util
+from mongomock import aggregate, filtering
+import mongomock
+import numpy as np
+
+from embeddings.bson_vectors import EMBEDDING_FIELD_SUFFIXES, embedding_field_name, from_bson_vector, to_bson_vector
+from fakes.bedrock import FakeBedrockRuntime
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from pymongo.results import BulkWriteResult, InsertManyResult
+
+from typing import List
+import os
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POLICY_DATA = os.path.join(os.path.dirname(__file__), "..", "..", "data", "insurance_agentic.policy.json")
+
+# Hidden field that carries the search score of each document through the rest of the pipeline
+_SCORE_FIELD = "__fake_search_score"
+_META_SCORES = ("vectorSearchScore", "searchScore")
+
+
+def _replace_meta_scores(value):
+    """Rewrite {"$meta": "vectorSearchScore"} style expressions into a reference to the hidden score field."""
+    if isinstance(value, dict):
+        if len(value) == 1 and value.get("$meta") in _META_SCORES:
+            return f"${_SCORE_FIELD}"
+        return {key: _replace_meta_scores(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_replace_meta_scores(item) for item in value]
+    return value
+
+
+def _field_text(value) -> str:
+    if isinstance(value, str):
+        return value
+    if isinstance(value, list):
+        return " ".join(_field_text(item) for item in value)
+    if isinstance(value, dict):
+        return " ".join(_field_text(item) for item in value.values())
+    return ""
+
+
+def _get_path(doc: dict, path: str):
+    for part in path.split("."):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(part)
+    return doc
+
+
+class FakeCollection:
+    """ mongomock collection with emulated Atlas Search and Vector Search stages. """
+
+    def __init__(self, collection: mongomock.Collection, search_indexes: dict) -> None:
+        self._collection = collection
+        self._search_indexes = search_indexes
+
+    def __getattr__(self, name):
+        return getattr(self._collection, name)
+
+    def __getitem__(self, name):
+        return FakeCollection(self._collection[name], self._search_indexes)
+
+    @property
+    def database(self):
+        return FakeDatabase(self._collection.database, self._search_indexes)
+
+    # -- search indexes -----------------------------------------------------------------------
+
+    def list_search_indexes(self, name: str = None, **kwargs) -> list:
+        indexes = self._search_indexes.get(self._collection.full_name, {})
+        return [index for index_name, index in indexes.items() if name is None or index_name == name]
+
+    def create_search_index(self, model: dict, **kwargs) -> str:
+        indexes = self._search_indexes.setdefault(self._collection.full_name, {})
+        indexes[model["name"]] = {**model, "status": "READY", "queryable": True}
+        return model["name"]
+
+    def drop_search_index(self, name: str, **kwargs):
+        self._search_indexes.get(self._collection.full_name, {}).pop(name, None)
+
+    # -- indexes ------------------------------------------------------------------------------
+
+    def create_index(self, keys, **kwargs) -> str:
+        partial = kwargs.get("partialFilterExpression") or {}
+        if kwargs.get("unique") and partial and all(value == {"$exists": True} for value in partial.values()):
+            # mongomock checks a new unique index against every document, ignoring its partial filter;
+            # for an $exists filter a sparse index covers the same documents
+            kwargs["sparse"] = True
+        return self._collection.create_index(keys, **kwargs)
+
+    # -- writes -------------------------------------------------------------------------------
+
+    def bulk_write(self, requests: list, ordered: bool = True, **kwargs) -> BulkWriteResult:
+        matched = modified = upserted = 0
+        for request in requests:
+            if not isinstance(request, UpdateOne):
+                raise NotImplementedError(f"Fake bulk_write does not support {type(request).__name__}")
+            result = self._collection.update_one(request._filter, request._doc, upsert=request._upsert)
+            matched += result.matched_count
+            modified += result.modified_count
+            upserted += result.upserted_id is not None
+        return BulkWriteResult({"nInserted": 0, "nMatched": matched, "nModified": modified, "nRemoved": 0,
+                                "nUpserted": upserted, "upserted": []}, acknowledged=True)
+
+    def insert_many(self, documents, ordered: bool = True, **kwargs) -> InsertManyResult:
+        documents = list(documents)
+        inserted, errors = [], []
+        for index, document in enumerate(documents):
+            try:
+                inserted.append(self._collection.insert_one(document).inserted_id)
+            except DuplicateKeyError as e:
+                errors.append({"index": index, "code": 11000, "errmsg": str(e), "op": document})
+                if ordered:
+                    break
+        if errors:
+            raise BulkWriteError({"writeErrors": errors, "writeConcernErrors": [], "nInserted": len(inserted),
+                                  "nUpserted": 0, "nMatched": 0, "nModified": 0, "nRemoved": 0, "upserted": []})
+        return InsertManyResult(inserted, acknowledged=True)
+
+    # -- aggregation --------------------------------------------------------------------------
+
+    def aggregate(self, pipeline: List[dict], session=None, **kwargs):
+        documents = self._run_pipeline(None, pipeline)
+        for doc in documents:
+            doc.pop(_SCORE_FIELD, None)
+        return mongomock.command_cursor.CommandCursor(documents)
+
+    def _run_pipeline(self, documents, pipeline: List[dict]) -> list:
+        """Run the stages in order; None means the pipeline has not read the collection yet."""
+        for stage in pipeline:
+            (operator, options), = stage.items()
+            if operator == "$vectorSearch":
+                documents = self._vector_search(options)
+            elif operator == "$search":
+                documents = self._text_search(options)
+            else:
+                if documents is None:
+                    documents = list(self._collection.find())
+                if operator == "$unionWith":
+                    documents = documents + self._union_with(options)
+                elif operator == "$replaceRoot" and "$mergeObjects" in options["newRoot"]:
+                    documents = [self._merge_objects(doc, options["newRoot"]["$mergeObjects"]) for doc in documents]
+                else:
+                    documents = list(aggregate.process_pipeline(
+                        documents, self._collection.database, [{operator: _replace_meta_scores(options)}], None))
+        return list(self._collection.find()) if documents is None else documents
+
+    @staticmethod
+    def _merge_objects(doc: dict, operands: list) -> dict:
+        """Evaluate {"$replaceRoot": {"newRoot": {"$mergeObjects": [...]}}}, which mongomock lacks."""
+        merged = {}
+        for operand in _replace_meta_scores(operands):
+            if isinstance(operand, dict) and not any(key.startswith("$") for key in operand):
+                value = {key: aggregate._parse_expression(item, doc) for key, item in operand.items()}
+            else:
+                value = aggregate._parse_expression(operand, doc)
+            merged.update(value or {})
+        return merged
+
+    def _union_with(self, options) -> list:
+        if isinstance(options, str):
+            options = {"coll": options}
+        other = FakeCollection(self._collection.database[options["coll"]], self._search_indexes)
+        return other._run_pipeline(None, options.get("pipeline", []))
+
+    def _vector_search(self, options: dict) -> list:
+        path = options["path"]
+        candidates = [doc for doc in self._collection.find({path: {"$exists": True}})
+                      if not options.get("filter") or filtering.filter_applies(options["filter"], doc)]
+        if not candidates:
+            return []
+
+        query = from_bson_vector(options["queryVector"]).astype(np.float32)
+        matrix = np.stack([from_bson_vector(doc[path]) for doc in candidates]).astype(np.float32)
+
+        if path.endswith(EMBEDDING_FIELD_SUFFIXES["ubinary"]):
+            # Bit vectors are compared with Hamming distance, mapped to a similarity like Atlas euclidean
+            scores = 1.0 / (1.0 + np.abs(matrix - query).sum(axis=1))
+        else:
+            norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(query)
+            cosine = np.divide(matrix @ query, norms, out=np.zeros(len(candidates), dtype=np.float32), where=norms > 0)
+            # Atlas normalises cosine similarity into [0, 1]
+            scores = (1.0 + cosine) / 2.0
+
+        results = []
+        for index in np.argsort(-scores)[:options.get("limit", len(candidates))]:
+            doc = candidates[index]
+            doc[_SCORE_FIELD] = float(scores[index])
+            results.append(doc)
+        return results
+
+    def _text_search(self, options: dict) -> list:
+        text = options.get("text")
+        if text is None:
+            raise NotImplementedError(f"Only the $search text operator is emulated, got: {list(options)}")
+        paths = text["path"] if isinstance(text["path"], list) else [text["path"]]
+        queries = text["query"] if isinstance(text["query"], list) else [text["query"]]
+        terms = set(re.findall(r"\w+", " ".join(queries).lower()))
+
+        results = []
+        for doc in self._collection.find():
+            words = re.findall(r"\w+", " ".join(_field_text(_get_path(doc, path)) for path in paths).lower())
+            score = float(sum(1 for word in words if word in terms))
+            if score > 0:
+                doc[_SCORE_FIELD] = score
+                results.append(doc)
+        return sorted(results, key=lambda doc: doc[_SCORE_FIELD], reverse=True)
+
+
+class FakeDatabase:
+    """ mongomock database whose collections are FakeCollections. """
+
+    def __init__(self, database: mongomock.Database, search_indexes: dict) -> None:
+        self._database = database
+        self._search_indexes = search_indexes
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    def __getitem__(self, name: str) -> FakeCollection:
+        return FakeCollection(self._database[name], self._search_indexes)
+
+    def get_collection(self, name: str, **kwargs) -> FakeCollection:
+        return FakeCollection(self._database.get_collection(name, **kwargs), self._search_indexes)
+
+    def create_collection(self, name: str, **kwargs) -> FakeCollection:
+        # Schema validators are accepted and ignored
+        kwargs.pop("validator", None)
+        kwargs.pop("validationLevel", None)
+        kwargs.pop("validationAction", None)
+        return FakeCollection(self._database.create_collection(name, **kwargs), self._search_indexes)
+
+    def command(self, command, *args, **kwargs) -> dict:
+        # Schema validators are accepted and ignored, however collMod is spelled
+        if command == "collMod" or isinstance(command, dict) and "collMod" in command:
+            return {"ok": 1.0}
+        if command in ("ping", {"ping": 1}):
+            return {"ok": 1.0}
+        return self._database.command(command, *args, **kwargs)
+
+    def list_collection_names(self, *args, **kwargs) -> list:
+        return self._database.list_collection_names(*args, **kwargs)
+
+    @property
+    def name(self) -> str:
+        return self._database.name
+
+    @property
+    def client(self):
+        return self._database.client
+
+
+class FakeMongoClient:
+    """ Drop-in replacement for MongoClient backed by an in-process mongomock store. """
+
+    def __init__(self, *args, **kwargs) -> None:
+        self._client = mongomock.MongoClient()
+        # Search index definitions per namespace, shared by every handle of this client
+        self._search_indexes = {}
+        self.admin = FakeDatabase(self._client["admin"], self._search_indexes)
+
+    def __getitem__(self, name: str) -> FakeDatabase:
+        return FakeDatabase(self._client[name], self._search_indexes)
+
+    def get_database(self, name: str = None, **kwargs) -> FakeDatabase:
+        return self[name or os.getenv("DATABASE_NAME")]
+
+    def list_database_names(self) -> list:
+        return self._client.list_database_names()
+
+    def start_session(self, *args, **kwargs):
+        return self._client.start_session(*args, **kwargs)
+
+    def close(self):
+        pass
+
+
+def seed_policies(collection: FakeCollection, path: str = None, embedding_types: List[str] = None) -> int:
+    """
+    Load the sample policies into the fake collection and embed them with the fake Cohere model.
+
+    The embeddings shipped in the data file come from the real model and would not match fake
+    query embeddings, so every embedding type is recomputed and stored as a BSON vector.
+
+    Args:
+        collection (FakeCollection): The policy collection.
+        path (str): Extended JSON export of the policies. Defaults to FAKE_POLICY_DATA or data/insurance_agentic.policy.json.
+        embedding_types (List[str]): Embedding types to store. Defaults to all of them.
+
+    Returns:
+        int: Number of policies loaded.
+    """
+    path = path or os.getenv("FAKE_POLICY_DATA", DEFAULT_POLICY_DATA)
+    if not os.path.exists(path):
+        logger.warning(f"No policy data at {path}, the fake policy collection is empty")
+        return 0
+
+    with open(path, "r") as f:
+        policies = json_util.loads(f.read())
+
+    embedding_types = embedding_types or list(EMBEDDING_FIELD_SUFFIXES)
+    runtime = FakeBedrockRuntime()
+    response = runtime._embed({"texts": [policy["description"] for policy in policies], "embedding_types": embedding_types})
+    for embedding_type in embedding_types:
+        for policy, embedding in zip(policies, response["embeddings"][embedding_type]):
+            policy[embedding_field_name("descriptionEmbedding", embedding_type)] = to_bson_vector(embedding, embedding_type)
+
+    collection.delete_many({})
+    collection.insert_many(policies)
+    logger.info(f"Seeded {len(policies)} policies into fake collection {collection.name}")
+    return len(policies)
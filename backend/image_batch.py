@@ -0,0 +1,163 @@
+"""
+Preprocessing and packing of the photos of a claim for multi-image Claude requests.
+
+A claim comes with up to 20 photos. Rather than describing them one call at a time, they are
+preprocessed in parallel on a process pool and packed into as few requests as Claude's limits on
+Bedrock allow: at most MAX_IMAGES_PER_REQUEST images, each under MAX_IMAGE_BYTES, and at most
+VISION_MAX_REQUEST_BYTES of encoded images per request.
+
+Preprocessing checks the image type from its bytes, not its file name. With Pillow installed
+(poetry install -E images) it also downscales photos whose long edge exceeds VISION_MAX_EDGE_PIXELS.
+Claude scales such images down before reading them anyway, so sending them at full size only
+costs upload time and image tokens. Without Pillow the photos are sent as they are.
+
+This module is imported by the pool's worker processes, so it imports no other backend module:
+only the standard library and, when installed, Pillow.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+import base64
+import io
+import multiprocessing
+import os
+import struct
+
+try:
+    from PIL import Image, ImageOps
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+
+# Claude on Bedrock: at most 20 images per request, each at most 3.75 MB and 8000 px per side
+MAX_IMAGES_PER_REQUEST = 20
+MAX_IMAGE_BYTES = 3_750_000
+MAX_EDGE_PIXELS = 8000
+VISION_MAX_REQUEST_BYTES = int(os.getenv("VISION_MAX_REQUEST_BYTES", str(15_000_000)))
+# Claude's recommended long edge; larger photos are downscaled when Pillow is available
+VISION_MAX_EDGE_PIXELS = int(os.getenv("VISION_MAX_EDGE_PIXELS", "1568"))
+VISION_MAX_PHOTOS = int(os.getenv("VISION_MAX_PHOTOS", "20"))
+# 0 preprocesses in the calling thread
+VISION_PREPROCESS_WORKERS = int(os.getenv("VISION_PREPROCESS_WORKERS", str(min(os.cpu_count() or 1, 4))))
+JPEG_QUALITY = 85
+
+MEDIA_TYPES = {b"\xff\xd8\xff": "image/jpeg", b"\x89PNG\r\n\x1a\n": "image/png", b"GIF87a": "image/gif",
+               b"GIF89a": "image/gif"}
+
+
+def _media_type(data: bytes) -> str:
+    for magic, media_type in MEDIA_TYPES.items():
+        if data.startswith(magic):
+            return media_type
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+
+def _dimensions(data: bytes, media_type: str) -> tuple:
+    """Width and height read from the image header, or (0, 0) if not found."""
+    if media_type == "image/png" and len(data) >= 24:
+        return struct.unpack(">II", data[16:24])
+    if media_type == "image/gif" and len(data) >= 10:
+        return struct.unpack("<HH", data[6:10])
+    if media_type == "image/jpeg":
+        # Walk the segments up to the start-of-frame marker
+        offset = 2
+        while offset + 9 < len(data):
+            if data[offset] != 0xFF:
+                break
+            marker = data[offset + 1]
+            length = struct.unpack(">H", data[offset + 2:offset + 4])[0]
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                height, width = struct.unpack(">HH", data[offset + 5:offset + 9])
+                return width, height
+            offset += 2 + length
+    return 0, 0
+
+
+def _downscale(data: bytes) -> tuple:
+    """Downscale an image to VISION_MAX_EDGE_PIXELS and re-encode it as JPEG."""
+    with Image.open(io.BytesIO(data)) as image:
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((VISION_MAX_EDGE_PIXELS, VISION_MAX_EDGE_PIXELS))
+        output = io.BytesIO()
+        image.convert("RGB").save(output, format="JPEG", quality=JPEG_QUALITY, optimize=True)
+        return output.getvalue(), "image/jpeg", image.size
+
+
+def preprocess_image(image_path: str) -> dict:
+    """
+    Read a photo and prepare it for a Claude vision request.
+
+    Args:
+        image_path (str): Path to the image file.
+
+    Returns:
+        dict: "name", "media_type", "data" (base64), "bytes" (encoded size), "source_bytes", "width" and "height".
+
+    Raises:
+        ValueError: If the file is not a JPEG, PNG, GIF or WebP image, or is too large to send.
+    """
+    with open(image_path, "rb") as image_file:
+        data = image_file.read()
+    source_bytes = len(data)
+
+    media_type = _media_type(data)
+    if media_type is None:
+        raise ValueError(f"{os.path.basename(image_path)} is not a JPEG, PNG, GIF or WebP image")
+    width, height = _dimensions(data, media_type)
+
+    too_large = len(data) > MAX_IMAGE_BYTES or max(width, height) > MAX_EDGE_PIXELS
+    if PIL_AVAILABLE and (too_large or max(width, height) > VISION_MAX_EDGE_PIXELS):
+        data, media_type, (width, height) = _downscale(data)
+    elif too_large:
+        raise ValueError(f"{os.path.basename(image_path)} is over {MAX_IMAGE_BYTES} bytes or {MAX_EDGE_PIXELS} px; "
+                         f"install Pillow to have it downscaled")
+
+    encoded = base64.b64encode(data).decode("utf-8")
+    return {"name": os.path.basename(image_path), "media_type": media_type, "data": encoded, "bytes": len(encoded),
+            "source_bytes": source_bytes, "width": width, "height": height}
+
+
+@lru_cache(maxsize=None)
+def get_preprocess_pool() -> ProcessPoolExecutor:
+    """Get the process pool that preprocesses photos. Spawned, so it never inherits the app's clients and threads."""
+    return ProcessPoolExecutor(max_workers=VISION_PREPROCESS_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+
+def preprocess_images(image_paths: list) -> list:
+    """
+    Preprocess the photos of a claim, in parallel when there are several.
+
+    Args:
+        image_paths (list): Paths of the image files.
+
+    Returns:
+        list: The preprocessed images (see preprocess_image), in the order of image_paths.
+    """
+    if len(image_paths) == 1 or VISION_PREPROCESS_WORKERS == 0:
+        return [preprocess_image(path) for path in image_paths]
+    return list(get_preprocess_pool().map(preprocess_image, image_paths))
+
+
+def pack_images(images: list) -> list:
+    """
+    Pack preprocessed images, in order, into as few requests as the per-request limits allow.
+
+    Args:
+        images (list): Preprocessed images.
+
+    Returns:
+        list: One list of images per request.
+    """
+    batches = []
+    batch, batch_bytes = [], 0
+    for image in images:
+        if batch and (len(batch) == MAX_IMAGES_PER_REQUEST or batch_bytes + image["bytes"] > VISION_MAX_REQUEST_BYTES):
+            batches.append(batch)
+            batch, batch_bytes = [], 0
+        batch.append(image)
+        batch_bytes += image["bytes"]
+    if batch:
+        batches.append(batch)
+    return batches
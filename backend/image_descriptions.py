@@ -0,0 +1,73 @@
+"""
+Image descriptions written by /imageDescriptor, kept until the claim is queued.
+
+/imageDescriptor streams the description of the photos and, once it is complete, stores it with the
+usage of the vision calls under a description id, sent back in the X-Description-Id header.
+/runAgent and /runAgent/stream take that id, so that concurrent users, and several API processes,
+never pick up each other's descriptions. When a vision call fails only the error is stored, so that
+no claim is queued for it. Descriptions expire DESCRIPTION_TTL_SECONDS after they were written.
+"""
+
+from bson import ObjectId
+
+from claim_usage import ClaimUsage
+from mongo_client import get_collection
+
+from datetime import datetime, timezone
+import os
+import logging
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+DESCRIPTIONS_COLLECTION = os.getenv("DESCRIPTIONS_COLLECTION", "image_descriptions")
+DESCRIPTION_TTL_SECONDS = int(os.getenv("DESCRIPTION_TTL_SECONDS", str(24 * 3600)))
+
+
+def ensure_description_indexes():
+    """Create the TTL index that expires old descriptions."""
+    get_collection(DESCRIPTIONS_COLLECTION).create_index("created_at", expireAfterSeconds=DESCRIPTION_TTL_SECONDS)
+
+
+def new_description_id() -> str:
+    """Id under which a description will be saved. Nothing is written until the description is complete."""
+    return str(ObjectId())
+
+
+def save_description(description_id: str, description: str, usage: ClaimUsage = None, error: str = None):
+    """
+    Store a complete description, or the error of a failed one.
+
+    Args:
+        description_id (str): The id returned by new_description_id.
+        description (str): The full description of the photos. None if the description failed.
+        usage (ClaimUsage): Token counts of the vision calls, carried over to the claim.
+        error (str): Why the description failed.
+    """
+    get_collection(DESCRIPTIONS_COLLECTION).replace_one(
+        {"_id": ObjectId(description_id)},
+        {"description": None if error else description, "error": error,
+         "usage": usage.model_dump() if usage else None, "created_at": datetime.now(timezone.utc)},
+        upsert=True,
+    )
+
+
+def load_description(description_id: str) -> tuple:
+    """
+    Read a stored description.
+
+    Returns:
+        tuple: The description, its vision usage (a ClaimUsage or None) and the error of a failed
+        description. All three are None if the id is unknown, has expired or its description is still
+        being written.
+    """
+    if not ObjectId.is_valid(description_id):
+        return None, None, None
+    document = get_collection(DESCRIPTIONS_COLLECTION).find_one({"_id": ObjectId(description_id)})
+    if not document:
+        return None, None, None
+    usage = ClaimUsage.model_validate(document["usage"]) if document.get("usage") else None
+    return document["description"], usage, document.get("error")
@@ -1,36 +1,42 @@
 import operator
 from collections.abc import Sequence
 from typing import Annotated, TypedDict
-from bson import ObjectId
-import json
+import logging
+import os
 
-from langchain_core.messages import BaseMessage, AIMessage
 from langgraph.graph import END, StateGraph
 from langgraph.prebuilt import tools_condition
 
 from agent_node_definition import chatbot_node, tool_node
+from agent_definition import PROMPT_VERSION
+from agent_tools import claim_idempotency_key, claim_policy, fetch_guidelines, pending_claim, persist_data
+from claim_schema import ClaimRecord
+from claim_usage import ClaimUsage, claim_usage, record_claim_usage
+from deadline import DEADLINE_GRACE_SECONDS, claim_deadline, deadline_scope
+from metrics import AGENT_DURATION, CLAIMS_DEGRADED, CLAIMS_IN_FLIGHT, LLM_TURNS
+from json_encoder import LazyJSON
 
-import pprint
-from typing import Dict, List
+from functools import lru_cache
+import orjson
+import asyncio
+import time
+from typing import AsyncIterator, Optional
 
 from langchain_core.messages import BaseMessage, HumanMessage, ToolMessage
 
-def serialize_object(obj):
-    """Recursively serialize ObjectId in a dictionary or list."""
-    if isinstance(obj, dict):
-        return {key: serialize_object(value) for key, value in obj.items()}
-    elif isinstance(obj, list):
-        return [serialize_object(item) for item in obj]
-    elif isinstance(obj, ObjectId):
-        return str(obj)
-    return obj
-
-def insurance_agent(image_description: str) -> List[BaseMessage]:
-    # State Definition
-    class AgentState(TypedDict):
-        messages: Annotated[Sequence[BaseMessage], operator.add]
-        sender: str
+logger = logging.getLogger(__name__)
 
+# Share of graph events written to the debug log
+EVENT_LOG_SAMPLE_RATE = float(os.getenv("AGENT_EVENT_LOG_SAMPLE_RATE", "1.0"))
+
+# State Definition
+class AgentState(TypedDict):
+    messages: Annotated[Sequence[BaseMessage], operator.add]
+    sender: str
+
+
+def build_graph():
+    """Build and compile the claim handling workflow graph."""
     # Agentic Workflow Definition
     workflow = StateGraph(AgentState)
 
@@ -43,72 +49,248 @@ def insurance_agent(image_description: str) -> List[BaseMessage]:
 
     workflow.add_edge("tools", "chatbot")
 
-    def process_event(event: Dict) -> List[BaseMessage]:
-        new_messages = []
-        for value in event.values():
-            if isinstance(value, dict) and "messages" in value:
-                for msg in value["messages"]:
-                    if isinstance(msg, BaseMessage):
-                        new_messages.append(msg)
-                    elif isinstance(msg, dict) and "content" in msg:
-                        # Serialize ObjectId in additional_kwargs
-                        additional_kwargs = serialize_object(msg.get("additional_kwargs", {}))
-                        new_messages.append(
-                            AIMessage(
-                                content=msg["content"],
-                                additional_kwargs=additional_kwargs,
-                            )
-                        )
-                    elif isinstance(msg, str):
-                        new_messages.append(ToolMessage(content=msg))
-        return new_messages
-
-    # Graph Compilation and visualization
-    graph = workflow.compile()
-    # Process and View Response
-    object_ids = []  # Collect ObjectIds here
-    events = graph.stream(
-        {
-            "messages": [
-                HumanMessage(
-                    content="This is the description of the accident: " + str(image_description),
-                )
-            ]
-        },
-        {"recursion_limit": 15},
-    )
-
-    new_messages = []  # Initialize new_messages to collect processed messages
-
-    for event in events:
+    return workflow.compile()
+
+
+@lru_cache(maxsize=None)
+def get_graph():
+    """The compiled claim handling graph, built once per process and shared by all runs."""
+    return build_graph()
+
+
+def bounded_graph(deadline: float = None):
+    """The compiled graph, with each step bounded by the time left before the deadline, if any."""
+    graph = get_graph()
+    if deadline is None:
+        return graph
+    return graph.copy(update={"step_timeout": max(deadline - time.time(), 0.001)})
+
+
+def initial_state(image_description: str) -> dict:
+    """Initial graph state for the given accident description."""
+    return {
+        "messages": [
+            HumanMessage(
+                content="This is the description of the accident: " + str(image_description),
+            )
+        ]
+    }
+
+
+def _policy_from_text(policy_text: str) -> dict:
+    """Policy summary returned by fetch_guidelines as JSON, or {} if it found no policy."""
+    try:
+        policy = orjson.loads(policy_text)
+    except orjson.JSONDecodeError:
+        return {}
+    return policy if isinstance(policy, dict) else {}
+
+
+def persist_policy_default_claim(image_description: str, policy_text: str = None) -> str:
+    """
+    Persist a claim built from the policy's default handler actions, without waiting for the LLM.
+
+    Used when a run ends without the agent persisting its claim: its deadline passed, or the graph
+    finished without calling persist_data. The policy
+    retrieved by the run is used if there is one, otherwise it is fetched now. Both steps get
+    DEADLINE_GRACE_SECONDS.
+
+    Args:
+        image_description (str): The accident description.
+        policy_text (str): The output of the run's fetch_guidelines call, if any.
+
+    Returns:
+        str: The ObjectId of the persisted claim.
+    """
+    with deadline_scope(time.time() + DEADLINE_GRACE_SECONDS):
+        if policy_text is None:
+            policy_text = fetch_guidelines.invoke({"query": image_description})
+        record = ClaimRecord.from_policy(_policy_from_text(policy_text), image_description)
+        return persist_data.invoke({"data": record.model_dump()})["object_id"]
+
+
+class AgentRun:
+    """
+    Context manager around one run of the agent graph, shared by insurance_agent and stream_insurance_agent.
+
+    On entry it sets the run's context variables (idempotency key, usage, policy and deadline) and
+    counts the run in flight; on exit it resets the deadline and records the run's duration and LLM
+    turns. In between, the caller feeds it the output of each tool, falls back to the policy defaults
+    if no claim was persisted, and finally records the usage on the claim.
+    """
+
+    def __init__(self, image_description: str, idempotency_key: str = None, usage: ClaimUsage = None,
+                 deadline: float = None, mode: str = "batch") -> None:
+        self.image_description = image_description
+        self.idempotency_key = idempotency_key
+        # Token counts of the vision call, if known, plus those of every LLM turn of this run
+        self.usage = usage or ClaimUsage()
+        self.usage.prompt_version = PROMPT_VERSION
+        self.deadline = deadline
+        self.mode = mode
+        self.object_id = None
+        self.policy_text = None
+        self.cause, self.reason = "The agent finished", "no_claim"
+        self._start = None
+        self._deadline_token = None
+
+    def __enter__(self) -> "AgentRun":
+        # Let persist_data dedupe the claim document if this run is a retry
+        claim_idempotency_key.set(self.idempotency_key)
+        claim_usage.set(self.usage)
+        # Filled in with the version of the policy the claim is computed from
+        claim_policy.set({})
+        # Seconds since the epoch; bounds the graph steps, the Bedrock calls and the MongoDB operations
+        self._deadline_token = claim_deadline.set(self.deadline)
+        self._start = time.perf_counter()
+        CLAIMS_IN_FLIGHT.inc()
+        return self
+
+    def __exit__(self, *exc_info):
+        # Later calls from this thread, e.g. the next job of a worker, must not inherit the deadline
+        claim_deadline.reset(self._deadline_token)
+        CLAIMS_IN_FLIGHT.dec()
+        AGENT_DURATION.labels(mode=self.mode).observe(time.perf_counter() - self._start)
+        LLM_TURNS.observe(self.usage.llm_turns)
+
+    def tool_output(self, name: str, output) -> Optional[str]:
+        """
+        Record the output of a tool call: the retrieved policy, or the claim stored by persist_data.
+
+        Returns:
+            str: The ObjectId of the claim if the tool persisted one, else None.
+        """
+        if name == "fetch_guidelines":
+            self.policy_text = getattr(output, "content", output)
+            return None
+        object_id = _tool_output_object_id(output) if name == "persist_data" else None
+        if object_id and self.object_id is None:
+            self.object_id = object_id
+        return object_id
+
+    def timed_out(self, error: TimeoutError):
+        """Record that the deadline passed, in a node (DeadlineExceeded) or during a graph step."""
+        self.cause, self.reason = f"Deadline exceeded ({str(error) or 'step timed out'})", "deadline"
+
+    def fall_back(self) -> str:
+        """Persist the claim from the policy defaults, because the run ended without one. Blocking."""
+        logger.warning(f"{self.cause} before a claim was persisted; using the policy's default handler actions")
+        self.object_id = persist_policy_default_claim(self.image_description, self.policy_text)
+        self.usage.degraded = True
+        CLAIMS_DEGRADED.labels(mode=self.mode).inc()
+        return self.object_id
+
+    def record_usage(self):
+        """Store the run's usage on its claim, or on the claim still waiting in the claim sink. Blocking."""
+        self.usage.agent_latency_ms = (time.perf_counter() - self._start) * 1000
+        record_claim_usage(self.object_id, self.usage, pending_claim(self.object_id))
+        logger.info(f"Agent run persisted claim {self.object_id} in {self.usage.agent_latency_ms:.0f} ms "
+                    f"({self.usage.llm_turns} LLM turns)")
+
+
+def insurance_agent(image_description: str, idempotency_key: str = None, usage: ClaimUsage = None,
+                    deadline: float = None) -> str:
+    """
+    Run the insurance agent to completion and return the ObjectId of the claim it persisted.
+
+    Used by the claim workers and the bulk ingestion. When the deadline passes before the claim is
+    stored, or the agent finishes without storing one, the claim is built from the policy's default
+    handler actions and its usage is marked degraded.
+
+    Args:
+        image_description (str): The accident description produced by the vision step.
+        idempotency_key (str): Key used by persist_data to dedupe the claim document.
+        usage (ClaimUsage): Usage of the vision call, to which the agent run adds its own.
+        deadline (float): Deadline of the run in seconds since the epoch, if any.
+
+    Returns:
+        str: The ObjectId of the persisted claim.
+    """
+    run = AgentRun(image_description, idempotency_key, usage, deadline, mode="batch")
+    with run:
         try:
-            # Serialize the event to handle ObjectId
-            serialized_event = serialize_object(event)
-            
-            print("Event:")
-            pprint.pprint(serialized_event)
-            print("---")
-
-            # Process the event and extract messages
-            processed_messages = process_event(serialized_event)
-            new_messages.extend(processed_messages)
-
-            # Extract ObjectId from ToolMessage content if present
-            if "tools" in serialized_event and "messages" in serialized_event["tools"]:
-                for tool_message in serialized_event["tools"]["messages"]:
-                    if isinstance(tool_message, ToolMessage):
-                        try:
-                            # Parse the content as JSON to extract the ObjectId
-                            tool_content = json.loads(tool_message.content)
-                            if "object_id" in tool_content:
-                                object_ids.append(tool_content["object_id"])
-                        except json.JSONDecodeError:
-                            print("Failed to parse ToolMessage content as JSON.")
-
-        except TypeError as e:
-            # Log a warning and continue
-            print(f"Serialization warning: {e}. Skipping problematic event.")
-
-    print("ObjectId:")
-    print(str(object_ids[0]))
-    return str(object_ids[0])
\ No newline at end of file
+            for event in bounded_graph(deadline).stream(initial_state(image_description), {"recursion_limit": 15}):
+                # Encoded only if the record is emitted, i.e. at DEBUG level and sampled in
+                logger.debug("Agent event: %s", LazyJSON(event), extra={"sample_rate": EVENT_LOG_SAMPLE_RATE})
+
+                # The retrieved policy, and the ObjectId returned by persist_data
+                for tool_message in event.get("tools", {}).get("messages", []):
+                    run.tool_output(tool_message.name, tool_message)
+        except TimeoutError as e:
+            run.timed_out(e)
+        if run.object_id is None:
+            run.fall_back()
+
+    run.record_usage()
+    return str(run.object_id)
+
+def _chunk_text(chunk) -> str:
+    """Text of a streamed message chunk, whose content is a string or a list of content blocks."""
+    content = chunk.content
+    if isinstance(content, str):
+        return content
+    return "".join(block.get("text", "") for block in content if isinstance(block, dict))
+
+
+def _tool_output_object_id(output):
+    """ObjectId returned by persist_data, from either the raw dict or the ToolMessage wrapping it."""
+    if isinstance(output, ToolMessage):
+        output = output.content
+    if isinstance(output, str):
+        try:
+            output = orjson.loads(output)
+        except orjson.JSONDecodeError:
+            return None
+    return output.get("object_id") if isinstance(output, dict) else None
+
+
+async def stream_insurance_agent(image_description: str, idempotency_key: str = None,
+                                 usage: ClaimUsage = None, deadline: float = None) -> AsyncIterator[dict]:
+    """
+    Run the insurance agent and yield its progress as it happens.
+
+    Yields dictionaries with an "event" key: "token" for each LLM text delta, "tool_start" and
+    "tool_end" around every tool call, "claim" once persist_data has stored the claim, and a
+    final "done" with the claim ObjectId. When the deadline passes before the claim is stored, or
+    the agent finishes without storing one, "degraded" is sent and the claim is built from the
+    policy's default handler actions.
+
+    Args:
+        image_description (str): The accident description produced by the vision step.
+        idempotency_key (str): Key used by persist_data to dedupe the claim document.
+        usage (ClaimUsage): Usage of the vision call, to which the agent run adds its own.
+        deadline (float): Deadline of the request in seconds since the epoch, if any.
+    """
+    run = AgentRun(image_description, idempotency_key, usage, deadline, mode="stream")
+    with run:
+        try:
+            async for event in bounded_graph(deadline).astream_events(
+                initial_state(image_description),
+                {"recursion_limit": 15},
+                version="v2",
+            ):
+                kind = event["event"]
+
+                if kind == "on_chat_model_stream":
+                    text = _chunk_text(event["data"]["chunk"])
+                    if text:
+                        yield {"event": "token", "text": text}
+
+                elif kind == "on_tool_start":
+                    yield {"event": "tool_start", "name": event["name"], "run_id": event["run_id"]}
+
+                elif kind == "on_tool_end":
+                    yield {"event": "tool_end", "name": event["name"], "run_id": event["run_id"]}
+                    object_id = run.tool_output(event["name"], event["data"].get("output"))
+                    if object_id:
+                        yield {"event": "claim", "object_id": object_id}
+        except TimeoutError as e:
+            run.timed_out(e)
+        if run.object_id is None:
+            # Blocking Bedrock and MongoDB calls, kept off the event loop
+            await asyncio.to_thread(run.fall_back)
+            yield {"event": "degraded", "reason": run.reason}
+            yield {"event": "claim", "object_id": run.object_id}
+
+    await asyncio.to_thread(run.record_usage)
+    yield {"event": "done", "object_id": run.object_id}
@@ -0,0 +1,71 @@
+"""
+Fast JSON encoding shared by the API responses, the agent event stream and the logs.
+
+orjson encodes dicts, lists, strings, numbers and datetimes natively; the default hook only runs
+for the types it does not know: ObjectId and other BSON types, pydantic models (LangChain
+messages included) and sets. Documents read from MongoDB can therefore be encoded as they are,
+without first walking them to convert their ObjectIds.
+"""
+
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+from bson import Binary, Decimal128, ObjectId
+
+import base64
+import orjson
+
+OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+
+def _default(obj):
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    if isinstance(obj, BaseModel):
+        return obj.model_dump()
+    if isinstance(obj, Decimal128):
+        return str(obj.to_decimal())
+    if isinstance(obj, (Binary, bytes)):
+        return base64.b64encode(obj).decode("ascii")
+    if isinstance(obj, (set, frozenset, tuple)):
+        return list(obj)
+    # Anything else is logged or returned by its string form rather than failing the request
+    return str(obj)
+
+
+def dumps(obj) -> bytes:
+    """Encode an object, BSON types included, as UTF-8 JSON."""
+    return orjson.dumps(obj, default=_default, option=OPTIONS)
+
+
+def to_jsonable(obj):
+    """Plain JSON types for an object, e.g. to store or compare documents holding ObjectIds."""
+    return orjson.loads(dumps(obj))
+
+
+class LazyJSON:
+    """
+    Log argument that is only encoded when the record is actually emitted.
+
+    Usage:
+        logger.debug("Agent event: %s", LazyJSON(event))
+    """
+
+    __slots__ = ("obj",)
+
+    def __init__(self, obj) -> None:
+        self.obj = obj
+
+    def __str__(self) -> str:
+        return dumps(self.obj).decode("utf-8")
+
+
+class BSONJSONResponse(JSONResponse):
+    """
+    JSON response encoded with orjson.
+
+    Return it directly from an endpoint to skip FastAPI's jsonable_encoder pass; ObjectIds and
+    datetimes in the content are encoded by the default hook.
+    """
+
+    def render(self, content) -> bytes:
+        return dumps(content)
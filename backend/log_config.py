@@ -0,0 +1,98 @@
+"""
+Logging setup of the API and the claim workers.
+
+- LOG_LEVEL sets the root level (default INFO).
+- LOG_FORMAT=json writes one JSON object per record, with the fields passed as extra=... included,
+  for log shippers; the default "text" keeps the usual one-line format.
+- Records logged with extra={"sample_rate": r} are kept with probability r, so that per-event
+  debug logs of the agent can stay on in production at a fraction of their volume.
+- Records are handed to a background thread that formats and writes them, so a slow stdout or
+  log pipe never blocks a request or an agent run.
+"""
+
+from json_encoder import dumps
+
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+import atexit
+import logging
+import os
+import random
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+TEXT_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+
+# Attributes every LogRecord has; anything else was passed as extra=...
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "sample_rate"}
+
+_listener = None
+
+
+class JSONFormatter(logging.Formatter):
+    """ Formats a record as a single JSON line, extra fields included. """
+
+    def format(self, record) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update({key: value for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES})
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return dumps(entry).decode("utf-8")
+
+
+class DeferredQueueHandler(QueueHandler):
+    """ Queues records as they are, so that the listener thread, not the caller, formats them. """
+
+    def prepare(self, record) -> logging.LogRecord:
+        # QueueHandler.prepare formats the message and traceback on the calling thread; the queue
+        # never leaves the process, so the record itself can be handed over
+        return record
+
+
+class SamplingFilter(logging.Filter):
+    """ Keeps records logged with a sample_rate extra with that probability; other records always pass. """
+
+    def filter(self, record) -> bool:
+        rate = getattr(record, "sample_rate", None)
+        return rate is None or random.random() < rate
+
+
+def configure_logging():
+    """
+    Route the root logger through a background writer thread, once per process.
+
+    The handlers configured so far (e.g. by logging.basicConfig) keep writing the records, from the
+    writer thread and with the formatter chosen by LOG_FORMAT.
+    """
+    global _listener
+
+    if _listener is not None:
+        return
+
+    logging.basicConfig(level=LOG_LEVEL, format=TEXT_FORMAT)
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+
+    handlers = root.handlers[:]
+    for handler in handlers:
+        handler.setFormatter(JSONFormatter() if LOG_FORMAT == "json" else logging.Formatter(TEXT_FORMAT))
+        root.removeHandler(handler)
+
+    queue = SimpleQueue()
+    queue_handler = DeferredQueueHandler(queue)
+    # Sampled-out records are dropped before they are formatted or queued
+    queue_handler.addFilter(SamplingFilter())
+    root.addHandler(queue_handler)
+
+    _listener = QueueListener(queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
@@ -1,26 +1,52 @@
-from fastapi import FastAPI, Request, File, UploadFile, HTTPException
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, Request, File, UploadFile, HTTPException, Header
+from fastapi.responses import Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi import APIRouter
 from dotenv import load_dotenv
 import os
 from tempfile import NamedTemporaryFile
-from typing import Optional
-from pic2textApi import stream_image_to_bedrock
-from insurance_agent import insurance_agent
-from bson import ObjectId
+from typing import List, Optional
+from pic2textApi import stream_image_to_bedrock, stream_images_to_bedrock
+from image_batch import VISION_MAX_PHOTOS
+from insurance_agent import stream_insurance_agent
+from claim_queue import (LeaseHeartbeat, complete_job, enqueue_claim, fail_job, find_claim_id, get_job, start_job,
+                         DONE, FAILED)
+from image_descriptions import load_description, new_description_id, save_description
+from contextlib import asynccontextmanager
+from claims_api import load_claim_document, router as claims_router
+from tracing import setup_tracing
+from metrics import DEDUPLICATED_REQUESTS, render_metrics, update_threadpool_gauges
+from claim_usage import ClaimUsage
+from profiling import profiled_stream, profiling_requested, router as profiles_router
+from json_encoder import BSONJSONResponse, dumps
+from deadline import VISION_DEADLINE_SECONDS, deadline_after
+from log_config import configure_logging
+from warmup import readiness, warm_up_in_background
+import asyncio
 import logging
-import json
-from pymongo import MongoClient
+import socket
+import uuid
 
-logging.basicConfig(level=logging.INFO)
+configure_logging()
 logger = logging.getLogger(__name__)
 
 load_dotenv()
 
-app = FastAPI()
+# Owner of the agent runs this process streams, in the claim job queue
+STREAM_WORKER_ID = f"api-{socket.gethostname()}-{os.getpid()}"
+# Seconds between two reads of the job that a repeated stream request follows
+STREAM_FOLLOW_POLL_SECONDS = float(os.getenv("STREAM_FOLLOW_POLL_SECONDS", "1.0"))
 
-image_description = None  # Global variable to store the most recent description
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Warm up in the background: the server starts at once and /ready reports when it can take traffic
+    warmup_task = asyncio.create_task(warm_up_in_background())
+    yield
+    warmup_task.cancel()
+
+
+app = FastAPI(lifespan=lifespan)
+setup_tracing(app)
 
 app.add_middleware(
     CORSMiddleware,
@@ -28,25 +54,50 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Read by the frontend to queue the claim of the description it has just received
+    expose_headers=["X-Description-Id", "X-Profile-Id"],
 )
 
 router = APIRouter()
 
+app.include_router(claims_router)
+app.include_router(profiles_router)
+
 @app.get("/")
 async def read_root(request: Request):
     return {"message": "Server is running"}
 
 
+@app.get("/ready")
+async def ready():
+    # Readiness probe: 503 until the warm-up has finished
+    status = readiness()
+    return BSONJSONResponse(status, status_code=200 if status["ready"] else 503)
+
+
+@app.get("/metrics")
+async def metrics():
+    # Async so that it runs on the event loop, where the threadpool limiter can be sampled
+    update_threadpool_gauges()
+    payload, content_type = render_metrics()
+    return Response(content=payload, media_type=content_type)
+
+
 @app.post("/imageDescriptor")
 async def analyze_image(
+    request: Request,
     file: UploadFile = File(...),
-    model_id: Optional[str] = 'anthropic.claude-3-sonnet-20240229-v1:0',
-    prompt: Optional[str] = "What do you see in this image? Give a concise description and focus and what happened to vehicles."
+    model_id: Optional[str] = None,
+    hint: Optional[str] = None,
+    prompt: Optional[str] = "What do you see in this image? Give a concise description and focus and what happened to vehicles.",
+    x_request_timeout: Optional[float] = Header(None)
 ):
-    global image_description  # Use the global variable
-
     if not file.content_type or not file.content_type.startswith('image/'):
         raise HTTPException(status_code=400, detail="File must be an image")
+
+    profile_id = uuid.uuid4().hex if profiling_requested(request) else None
+    # Latency budget in seconds: X-Request-Timeout, or VISION_DEADLINE_SECONDS
+    deadline = deadline_after(x_request_timeout, VISION_DEADLINE_SECONDS)
     
     # Save the uploaded file to a temporary location
     with NamedTemporaryFile(delete=False, suffix=os.path.splitext(file.filename)[1]) as temp_file:
@@ -55,17 +106,29 @@ async def analyze_image(
         temp_file.write(content)
     
     try:
-        # Reset the current description
-        image_description = ""
+        # The description is stored under this id once complete; /runAgent takes the id
+        description_id = new_description_id()
+        usage = ClaimUsage()
         
         # Process the image and collect the full description before responding
         def process_with_insurance_agent():
-            global image_description
             try:
+                # Without a model_id the model is picked per image; hint may be "simple" or "complex"
+                chunks = stream_image_to_bedrock(temp_file_path, model_id, usage=usage, deadline=deadline, hint=hint)
+                if profile_id:
+                    chunks = profiled_stream(chunks, profile_id, "imageDescriptor")
                 # Collect the full description
-                for chunk in stream_image_to_bedrock(temp_file_path, model_id):
-                    image_description += chunk
-                    yield chunk
+                description = []
+                try:
+                    for chunk in chunks:
+                        description.append(chunk)
+                        yield chunk
+                except Exception as e:
+                    # Shown to the user; the id is kept with the error only, so no claim can be queued for it
+                    save_description(description_id, None, usage, error=str(e))
+                    yield f"Error: {str(e)}"
+                    return
+                save_description(description_id, "".join(description), usage)
                 
             finally:
                 # Clean up the temporary file
@@ -75,7 +138,8 @@ async def analyze_image(
         # Return a streaming response
         return StreamingResponse(
             process_with_insurance_agent(),
-            media_type="text/plain"
+            media_type="text/plain",
+            headers=description_headers(description_id, profile_id),
         )
     
     except Exception as e:
@@ -84,140 +148,192 @@ async def analyze_image(
             os.unlink(temp_file_path)
         raise HTTPException(status_code=500, detail=f"Error processing image: {str(e)}")
     
-@app.post("/runAgent")
-async def run_agent():
-    global image_description
+@app.post("/imageDescriptor/batch")
+async def analyze_images(
+    request: Request,
+    files: List[UploadFile] = File(...),
+    model_id: Optional[str] = None,
+    hint: Optional[str] = None,
+    x_request_timeout: Optional[float] = Header(None)
+):
+    if len(files) > VISION_MAX_PHOTOS:
+        raise HTTPException(status_code=400, detail=f"At most {VISION_MAX_PHOTOS} photos per claim")
+    if any(not file.content_type or not file.content_type.startswith('image/') for file in files):
+        raise HTTPException(status_code=400, detail="Every file must be an image")
+
+    profile_id = uuid.uuid4().hex if profiling_requested(request) else None
+    deadline = deadline_after(x_request_timeout, VISION_DEADLINE_SECONDS)
+
+    # Save the uploaded files to temporary locations
+    temp_file_paths = []
+    for file in files:
+        with NamedTemporaryFile(delete=False, suffix=os.path.splitext(file.filename)[1]) as temp_file:
+            temp_file_paths.append(temp_file.name)
+            temp_file.write(await file.read())
 
-    if not image_description:
-        raise HTTPException(status_code=400, detail="Image description not yet available")
+    def remove_temp_files():
+        for temp_file_path in temp_file_paths:
+            if os.path.exists(temp_file_path):
+                os.unlink(temp_file_path)
 
     try:
-        # Call the insurance agent with the current image description
-        logger.info(f"Running agent with description: {image_description[:100]}...")
-        object_id = insurance_agent(image_description)
-        logger.info(f"ObjectId: {object_id}")       
+        description_id = new_description_id()
+        usage = ClaimUsage()
+
+        # One consolidated description of all the photos, streamed as it is written
+        def process_with_insurance_agent():
+            try:
+                chunks = stream_images_to_bedrock(temp_file_paths, model_id, usage=usage, deadline=deadline, hint=hint)
+                if profile_id:
+                    chunks = profiled_stream(chunks, profile_id, "imageDescriptor")
+                description = []
+                try:
+                    for chunk in chunks:
+                        description.append(chunk)
+                        yield chunk
+                except Exception as e:
+                    save_description(description_id, None, usage, error=str(e))
+                    yield f"Error: {str(e)}"
+                    return
+                save_description(description_id, "".join(description), usage)
+            finally:
+                remove_temp_files()
+
+        return StreamingResponse(
+            process_with_insurance_agent(),
+            media_type="text/plain",
+            headers=description_headers(description_id, profile_id),
+        )
 
     except Exception as e:
-        logger.error(f"Error during agent processing: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Agent processing error: {str(e)}")
-    
-    cluster_uri = os.getenv("MONGODB_URI")
-    database_name = os.getenv("DATABASE_NAME")
-    collection_name = os.getenv("COLLECTION_NAME_2")
+        remove_temp_files()
+        raise HTTPException(status_code=500, detail=f"Error processing images: {str(e)}")
 
-    client = MongoClient(cluster_uri)
-    db = client[database_name]
-    collection = db[collection_name]
+def description_headers(description_id: str, profile_id: str = None) -> dict:
+    """Response headers of /imageDescriptor: the id to queue the claim with, and the profile id if profiled."""
+    headers = {"X-Description-Id": description_id}
+    if profile_id:
+        headers["X-Profile-Id"] = profile_id
+    return headers
 
-    document = collection.find_one({"_id": ObjectId(object_id)})
 
-    if document:
-        document["_id"] = str(document["_id"])  # Convert ObjectId to string
-        
-        # Debug logging to see what's in the document
-        logger.info(f"Document retrieved: {document}")
-        logger.info(f"Recommendation field: {document.get('recommendation', 'NOT FOUND')}")
-        logger.info(f"Recommendation type: {type(document.get('recommendation'))}")
-        
-        # Keep the original nested structure for the enhanced frontend UI
-        if 'recommendation' in document:
-            rec = document['recommendation']
-            if isinstance(rec, dict):
-                # Keep the nested object structure for the new enhanced UI
-                logger.info(f"Keeping nested recommendation structure: {rec}")
-                # Ensure all expected fields exist with defaults
-                if 'immediate_actions' not in rec:
-                    rec['immediate_actions'] = []
-                if 'short_term_actions' not in rec:
-                    rec['short_term_actions'] = []
-                if 'approval_guidance' not in rec:
-                    rec['approval_guidance'] = {}
-                if 'reserve_recommendations' not in rec:
-                    rec['reserve_recommendations'] = {}
-                
-                document['recommendation'] = rec
-                
-            elif isinstance(rec, str):
-                # If it's a string, try to parse it as JSON first
-                try:
-                    import json
-                    parsed_rec = json.loads(rec)
-                    if isinstance(parsed_rec, dict):
-                        # Keep as nested object for enhanced UI
-                        document['recommendation'] = parsed_rec
-                    elif isinstance(parsed_rec, list):
-                        # Convert array to basic structure
-                        document['recommendation'] = {
-                            'immediate_actions': parsed_rec,
-                            'short_term_actions': [],
-                            'approval_guidance': {},
-                            'reserve_recommendations': {}
-                        }
-                    else:
-                        # Fallback to basic structure
-                        document['recommendation'] = {
-                            'immediate_actions': [rec],
-                            'short_term_actions': [],
-                            'approval_guidance': {},
-                            'reserve_recommendations': {}
-                        }
-                except:
-                    # If JSON parsing fails, create basic structure
-                    actions = []
-                    if '\n' in rec:
-                        actions = [line.strip() for line in rec.split('\n') if line.strip()]
-                    elif '•' in rec:
-                        actions = [line.strip() for line in rec.split('•') if line.strip()]
-                    elif '-' in rec:
-                        actions = [line.strip() for line in rec.split('-') if line.strip()]
-                    else:
-                        actions = [rec]
-                    
-                    document['recommendation'] = {
-                        'immediate_actions': actions,
-                        'short_term_actions': [],
-                        'approval_guidance': {},
-                        'reserve_recommendations': {}
-                    }
-            elif isinstance(rec, list):
-                # Convert array to nested structure for enhanced UI
-                document['recommendation'] = {
-                    'immediate_actions': rec,
-                    'short_term_actions': [],
-                    'approval_guidance': {},
-                    'reserve_recommendations': {}
-                }
-            else:
-                # Fallback to basic structure
-                document['recommendation'] = {
-                    'immediate_actions': [str(rec)] if rec else [],
-                    'short_term_actions': [],
-                    'approval_guidance': {},
-                    'reserve_recommendations': {}
-                }
-        else:
-            document['recommendation'] = {
-                'immediate_actions': ["No specific recommendations generated"],
-                'short_term_actions': [],
-                'approval_guidance': {},
-                'reserve_recommendations': {}
-            }
-        
-        # Ensure priority is always a string for frontend compatibility
-        if 'priority' in document:
-            if isinstance(document['priority'], (int, float)):
-                priority_map = {1: "Low", 2: "Medium", 3: "High", 4: "Critical"}
-                document['priority'] = priority_map.get(document['priority'], "Standard")
-            elif not isinstance(document['priority'], str):
-                document['priority'] = str(document['priority'])
-        else:
-            document['priority'] = "Standard"
-        
-        logger.info(f"Final recommendation array: {document['recommendation']}")
-        logger.info(f"Final priority: {document['priority']}")
-        
-        return document
-    else:
-        raise HTTPException(status_code=404, detail="Document not found")
+def stored_description(description_id: str) -> tuple:
+    """The description and vision usage stored under an id returned by /imageDescriptor, or a 404 or 409."""
+    description, usage, error = load_description(description_id)
+    if error:
+        raise HTTPException(status_code=409, detail=f"Image description failed: {error}")
+    if not description:
+        raise HTTPException(status_code=404, detail="Image description not found or not yet available")
+    return description, usage
+
+
+@app.post("/runAgent", status_code=202)
+def run_agent(request: Request, description_id: str, idempotency_key: Optional[str] = Header(None),
+              x_request_timeout: Optional[float] = Header(None)):
+    image_description, image_usage = stored_description(description_id)
+
+    # The claim worker profiles the run and saves the profile under the job id
+    profile = profiling_requested(request)
+
+    try:
+        # Queue the agent run; a claim worker picks it up and persists the claim
+        logger.info(f"Queueing agent run with description: {image_description[:100]}...")
+        # Retries and double clicks share the job of the first request
+        # A client deadline covers the time in the queue; without one the budget starts when a worker leases the job
+        deadline = deadline_after(x_request_timeout) if x_request_timeout else None
+        job, created = enqueue_claim(image_description, idempotency_key or f"description:{description_id}",
+                                     usage=image_usage, profile=profile, deadline=deadline)
+        if not created:
+            DEDUPLICATED_REQUESTS.inc()
+
+    except Exception as e:
+        logger.error(f"Error while queueing agent run: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Agent queueing error: {str(e)}")
+
+    response = {"job_id": str(job["_id"]), "status": job["status"], "deduplicated": not created}
+    if job.get("profile"):
+        response["profile_id"] = str(job["_id"])
+    return response
+
+
+async def run_streamed_job(job: dict, description: str, key: str, usage: Optional[ClaimUsage], deadline: float):
+    """Run the agent of a job leased to this process, yielding its events, and record the outcome on the job."""
+    object_id = None
+    # If this process dies, the lease expires and a claim worker finishes the job
+    with LeaseHeartbeat(job):
+        try:
+            async for event in stream_insurance_agent(description, idempotency_key=key, usage=usage, deadline=deadline):
+                if event["event"] == "done":
+                    object_id = event["object_id"]
+                yield event
+        except Exception as e:
+            await asyncio.to_thread(fail_job, job, str(e))
+            raise
+    await asyncio.to_thread(complete_job, job, object_id)
+
+
+async def follow_job(job: Optional[dict], claim_id: str = None):
+    """Events of a repeated request: the claim of the first one, once its run is done."""
+    yield {"event": "deduplicated", **({"job_id": str(job["_id"])} if job else {})}
+    while claim_id is None:
+        if job["status"] == DONE:
+            claim_id = job["claim_id"]
+            break
+        if job["status"] == FAILED:
+            yield {"event": "error", "detail": job.get("error")}
+            return
+        await asyncio.sleep(STREAM_FOLLOW_POLL_SECONDS)
+        job = await asyncio.to_thread(get_job, str(job["_id"]))
+    yield {"event": "claim", "object_id": claim_id}
+    yield {"event": "done", "object_id": claim_id}
+
+
+@app.post("/runAgent/stream")
+async def run_agent_stream(description_id: str, idempotency_key: Optional[str] = Header(None),
+                           x_request_timeout: Optional[float] = Header(None)):
+    # The run adds its LLM turns to the vision usage read from the stored description
+    description, usage = await asyncio.to_thread(stored_description, description_id)
+    key = idempotency_key or f"description:{description_id}"
+    deadline = deadline_after(x_request_timeout)
+
+    # A retry or double click replays the claim of the first request, or follows its run, instead of
+    # running the agent again; the run is registered as a job so that /runAgent dedupes against it too
+    job, created = None, False
+    claim_id = await asyncio.to_thread(find_claim_id, key)
+    if claim_id is None:
+        job, created = await asyncio.to_thread(start_job, description, key, STREAM_WORKER_ID, usage, deadline)
+    if not created:
+        DEDUPLICATED_REQUESTS.inc()
+
+    async def agent_events():
+        # Server-Sent Events: one "event:" / "data:" pair per agent event
+        events = run_streamed_job(job, description, key, usage, deadline) if created else follow_job(job, claim_id)
+        try:
+            async for event in events:
+                yield b"event: %s\ndata: %s\n\n" % (event["event"].encode(), dumps(event))
+        except Exception as e:
+            logger.error(f"Error during streamed agent processing: {str(e)}")
+            yield b"event: error\ndata: %s\n\n" % dumps({"event": "error", "detail": str(e)})
+
+    return StreamingResponse(
+        agent_events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/claims/{job_id}")
+def get_claim(job_id: str):
+    job = get_job(job_id)
+
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    if job["status"] != DONE:
+        response = {"job_id": job_id, "status": job["status"]}
+        if job.get("error"):
+            response["error"] = job["error"]
+        return response
 
-   
+    # Encoded straight from the BSON document, ObjectId and dates included
+    return BSONJSONResponse(load_claim_document(job["claim_id"]))
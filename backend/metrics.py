@@ -0,0 +1,223 @@
+"""
+Prometheus metrics of the claim pipeline, exposed on GET /metrics by main.py.
+
+Claim workers run in their own processes; they serve the same metrics on a port of their own
+(see claim_worker.py --metrics-port). With several uvicorn workers, set PROMETHEUS_MULTIPROC_DIR
+so that /metrics aggregates all of them.
+"""
+
+from prometheus_client import (CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram,
+                               REGISTRY, generate_latest)
+from prometheus_client import multiprocess
+from pymongo import monitoring
+
+from functools import wraps
+from urllib.parse import unquote
+import os
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Bedrock calls take seconds, not milliseconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120)
+FAST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+VISION_LATENCY = Histogram(
+    "claim_vision_latency_seconds", "Time to stream the full image description.",
+    ["model_id"], buckets=LATENCY_BUCKETS)
+VISION_FIRST_TOKEN = Histogram(
+    "claim_vision_first_token_seconds", "Time to the first streamed token of the image description.",
+    ["model_id"], buckets=LATENCY_BUCKETS)
+VISION_ROUTE_LATENCY = Histogram(
+    "claim_vision_route_latency_seconds", "Time to the full image description per route, escalations included.",
+    ["route"], buckets=LATENCY_BUCKETS)
+VISION_DESCRIPTION_LENGTH = Histogram(
+    "claim_vision_description_chars", "Length of the image description per route.",
+    ["route"], buckets=(50, 100, 200, 400, 800, 1600, 3200))
+VISION_ROUTES = Counter(
+    "claim_vision_routes_total", "Images routed to the fast or the strong vision model, by deciding signal.",
+    ["route", "reason"])
+VISION_ESCALATIONS = Counter(
+    "claim_vision_escalations_total", "Fast image descriptions escalated to the strong model, by cause.", ["cause"])
+AGENT_DURATION = Histogram(
+    "claim_agent_duration_seconds", "Duration of one agent run, from description to persisted claim.",
+    ["mode"], buckets=LATENCY_BUCKETS)
+LLM_TURNS = Histogram(
+    "claim_llm_turns", "LLM turns of the agent graph per claim.",
+    buckets=(1, 2, 3, 4, 5, 6, 8, 10, 15))
+LLM_TURN_LATENCY = Histogram(
+    "claim_llm_turn_seconds", "Duration of one LLM turn of the agent.",
+    ["model_id"], buckets=LATENCY_BUCKETS)
+TOOL_LATENCY = Histogram(
+    "claim_tool_latency_seconds", "Duration of one agent tool call.",
+    ["tool"], buckets=FAST_BUCKETS + LATENCY_BUCKETS[6:])
+VECTOR_SEARCH_LATENCY = Histogram(
+    "claim_vector_search_latency_seconds", "Duration of the hybrid policy search aggregation.",
+    ["embedding_type"], buckets=FAST_BUCKETS)
+
+CLAIMS_IN_FLIGHT = Gauge(
+    "claims_in_flight", "Agent runs currently in progress.", multiprocess_mode="livesum")
+THREADPOOL_BUSY = Gauge(
+    "threadpool_busy_threads", "Threads of the FastAPI sync endpoint pool in use.", multiprocess_mode="livesum")
+THREADPOOL_QUEUE = Gauge(
+    "threadpool_queue_depth", "Sync endpoint calls waiting for a free thread.", multiprocess_mode="livesum")
+MONGO_CHECKOUTS = Gauge(
+    "mongo_pool_checked_out_connections", "MongoDB connections currently checked out of the pool.",
+    ["address"], multiprocess_mode="livesum")
+MONGO_CHECKOUT_WAIT = Histogram(
+    "mongo_pool_checkout_wait_seconds", "Time spent waiting for a pooled MongoDB connection.",
+    buckets=FAST_BUCKETS)
+MONGO_CHECKOUT_FAILURES = Counter(
+    "mongo_pool_checkout_failures_total", "Failed MongoDB connection checkouts.", ["reason"])
+
+BEDROCK_THROTTLES = Counter(
+    "bedrock_throttles_total", "Bedrock calls rejected with ThrottlingException, retries included.", ["model_id"])
+BEDROCK_RETRIES = Counter(
+    "bedrock_retries_total", "Bedrock calls retried by the rate limiter.", ["model_id", "reason"])
+BEDROCK_LIMITER_WAIT = Histogram(
+    "bedrock_limiter_wait_seconds", "Time a Bedrock call waited for a concurrency slot and a rate token.",
+    ["model_id"], buckets=FAST_BUCKETS + LATENCY_BUCKETS[6:])
+BEDROCK_CONCURRENCY_LIMIT = Gauge(
+    "bedrock_concurrency_limit", "Adaptive limit of concurrent Bedrock calls per model.",
+    ["model_id"], multiprocess_mode="livesum")
+BEDROCK_IN_FLIGHT = Gauge(
+    "bedrock_in_flight_calls", "Bedrock calls in progress per model, streams included.",
+    ["model_id"], multiprocess_mode="livesum")
+BEDROCK_REGION_CALLS = Counter(
+    "bedrock_region_calls_total", "Bedrock calls routed to each region, by outcome.", ["region", "model_id", "outcome"])
+BEDROCK_BREAKER_STATE = Gauge(
+    "bedrock_circuit_breaker_state", "Circuit breaker of a model in a region: 0 closed, 1 half-open, 2 open.",
+    ["region", "model_id"], multiprocess_mode="livemax")
+BEDROCK_HEDGED_CALLS = Counter(
+    "bedrock_hedged_calls_total", "Bedrock calls that fired a hedged request, by the request that answered first.",
+    ["model_id", "winner"])
+PROMPT_CACHE_HITS = Counter(
+    "llm_prompt_cache_hits_total", "LLM turns that read part of the prompt from the Bedrock prompt cache.", ["model_id"])
+CLAIMS_DEGRADED = Counter(
+    "claims_degraded_total", "Claims built from the policy defaults because the agent did not persist one (deadline or no persist_data call).", ["mode"])
+CLAIM_REEVALUATIONS = Counter(
+    "claim_reevaluations_total", "Claims re-evaluated after an edit of their policy, by mode.", ["mode"])
+DEDUPLICATED_REQUESTS = Counter(
+    "claim_requests_deduplicated_total", "Agent requests served by an existing job of the same idempotency key.")
+
+LLM_TOKENS = Counter(
+    "llm_tokens_total", "Tokens of vision calls and agent LLM turns.", ["stage", "model_id", "kind"])
+LLM_COST = Counter(
+    "llm_cost_usd_total", "Estimated on-demand cost of vision calls and agent LLM turns.", ["stage", "model_id"])
+CLAIM_COST = Histogram(
+    "claim_cost_usd", "Estimated model cost of one claim, vision included.",
+    ["incident_type", "prompt_version"], buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5))
+CLAIM_GRAPH_ITERATIONS = Histogram(
+    "claim_graph_iterations", "Agent graph node executions per claim.",
+    ["incident_type", "prompt_version"], buckets=(1, 2, 3, 4, 5, 6, 8, 10, 15))
+
+
+def timed(histogram: Histogram, **labels):
+    """
+    Decorator that observes the duration of every call in a histogram.
+
+    Args:
+        histogram (Histogram): The histogram to observe.
+        **labels: Label values of the histogram.
+    """
+    metric = histogram.labels(**labels) if labels else histogram
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                metric.observe(time.perf_counter() - start)
+        return wrapper
+
+    return decorator
+
+
+def update_threadpool_gauges():
+    """Sample the anyio thread limiter that runs FastAPI sync endpoints. Must run on the event loop."""
+    from anyio import to_thread
+
+    limiter = to_thread.current_default_thread_limiter()
+    THREADPOOL_BUSY.set(limiter.borrowed_tokens)
+    THREADPOOL_QUEUE.set(limiter.statistics().tasks_waiting)
+
+
+def render_metrics() -> tuple:
+    """
+    Render the metrics in the Prometheus text format.
+
+    Returns:
+        tuple: The payload and its content type.
+    """
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+class MongoPoolMetrics(monitoring.ConnectionPoolListener):
+    """ pymongo pool listener that tracks checkouts, checkout waits and checkout failures. """
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        MONGO_CHECKOUT_FAILURES.labels(reason=str(event.reason)).inc()
+
+    def connection_checked_out(self, event):
+        MONGO_CHECKOUTS.labels(address=f"{event.address[0]}:{event.address[1]}").inc()
+        # duration is the wait for the connection, reported by pymongo 4.7+
+        if getattr(event, "duration", None) is not None:
+            MONGO_CHECKOUT_WAIT.observe(event.duration)
+
+    def connection_checked_in(self, event):
+        MONGO_CHECKOUTS.labels(address=f"{event.address[0]}:{event.address[1]}").dec()
+
+
+THROTTLING_CODES = ("ThrottlingException", "TooManyRequestsException", "ServiceQuotaExceededException")
+
+
+def _count_throttles(request_dict=None, response=None, **kwargs):
+    # Called by botocore before each retry decision, so throttles absorbed by retries are counted too
+    if not response or not isinstance(response[1], dict):
+        return None
+    if response[1].get("Error", {}).get("Code") in THROTTLING_CODES:
+        # url_path is /model/<url-encoded model id>/invoke[-with-response-stream]
+        path = unquote((request_dict or {}).get("url_path", ""))
+        model_id = path.split("/")[2] if path.startswith("/model/") else "unknown"
+        BEDROCK_THROTTLES.labels(model_id=model_id).inc()
+    return None
+
+
+def count_bedrock_throttles(client):
+    """Register the throttle counter on a boto3 Bedrock runtime client. Other clients are returned unchanged."""
+    events = getattr(getattr(client, "meta", None), "events", None)
+    if events is not None:
+        events.register_first("needs-retry.bedrock-runtime", _count_throttles)
+    return client
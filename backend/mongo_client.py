@@ -0,0 +1,50 @@
+from pymongo import MongoClient
+from pymongo.collection import Collection
+
+from backends import create_fake_mongo_client, use_fake_mongo
+from tracing import mongo_event_listeners
+from metrics import MongoPoolMetrics
+
+from functools import lru_cache
+import os
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+
+@lru_cache(maxsize=None)
+def get_mongo_client(cluster_uri: str = None) -> MongoClient:
+    """
+    Get the process-wide MongoClient for the given cluster URI.
+
+    MongoClient is thread-safe and keeps its own connection pool, so it is built once
+    per process and shared instead of being created on every call.
+
+    In fake mode (BACKEND_MODE=fake or MONGO_BACKEND=fake) an in-process stand-in seeded
+    with the sample policies is returned instead.
+
+    Args:
+        cluster_uri (str): The MongoDB connection string. Defaults to MONGODB_URI.
+
+    Returns:
+        MongoClient: The shared MongoClient instance.
+    """
+    if use_fake_mongo():
+        return create_fake_mongo_client()
+    return MongoClient(cluster_uri or os.getenv("MONGODB_URI"), event_listeners=mongo_event_listeners() + [MongoPoolMetrics()])
+
+
+def get_collection(collection_name: str, database_name: str = None) -> Collection:
+    """
+    Get a collection from the shared MongoClient.
+
+    Args:
+        collection_name (str): The name of the collection.
+        database_name (str): The name of the database. Defaults to DATABASE_NAME.
+
+    Returns:
+        Collection: The requested collection.
+    """
+    client = get_mongo_client()
+    return client[database_name or os.getenv("DATABASE_NAME")][collection_name]
@@ -1,4 +1,4 @@
-import boto3
+from backends import get_bedrock_runtime
 import base64
 import json
 
@@ -10,11 +10,8 @@ def stream_image_to_bedrock(image_path, model_id='anthropic.claude-3-sonnet-2024
     :param model_id: ID of the Bedrock model to use (default is Claude 3 Sonnet)
     :yield: Streamed chunks of the response
     """
-    # Create a Bedrock Runtime client
-    bedrock_runtime = boto3.client(
-        service_name='bedrock-runtime', 
-        region_name='us-east-1'  # Replace with your preferred AWS region
-    )
+    # Bedrock Runtime client, routed across BEDROCK_REGIONS
+    bedrock_runtime = get_bedrock_runtime()
     
     # Read the image file and encode it to base64
     with open(image_path, 'rb') as image_file:
@@ -1,71 +1,106 @@
 from fastapi import FastAPI, File, UploadFile, HTTPException
 from fastapi.responses import StreamingResponse
-import boto3
-import base64
+from backends import get_bedrock_runtime
+from metrics import (VISION_DESCRIPTION_LENGTH, VISION_ESCALATIONS, VISION_FIRST_TOKEN, VISION_LATENCY,
+                     VISION_ROUTE_LATENCY)
+from vision_routing import ESCALATED, FAST, STRONG, VISION_ROUTING, choose_route, escalation_cause, model_for
+from deadline import DeadlineExceeded, deadline_scope
+from image_batch import pack_images, preprocess_image, preprocess_images
 import json
+import logging
 import os
+import time
 from tempfile import NamedTemporaryFile
 from typing import Optional
 
+logger = logging.getLogger(__name__)
 
-def stream_image_to_bedrock(image_path, model_id='anthropic.claude-3-sonnet-20240229-v1:0'):
+def encode_image(image_path):
     """
-    Send an image to Amazon Bedrock and stream the response
+    Read an image and prepare it for a Claude vision request
     
     :param image_path: Path to the image file
-    :param model_id: ID of the Bedrock model to use (default is Claude 3 Sonnet)
-    :yield: Streamed chunks of the response
+    :return: The base64 encoded image and its media type
     """
-    # Create a Bedrock Runtime client
-    bedrock_runtime = boto3.client(
-        service_name='bedrock-runtime', 
-        region_name='us-east-1'  # Replace with your preferred AWS region
-    )
-    
-    # Read the image file and encode it to base64
-    with open(image_path, 'rb') as image_file:
-        image_bytes = image_file.read()
-        base64_image = base64.b64encode(image_bytes).decode('utf-8')
-    
-    # Get file extension to determine media type
-    _, file_extension = os.path.splitext(image_path)
-    media_type = "image/jpeg"  # Default
-    if file_extension.lower() in ['.png']:
-        media_type = "image/png"
-    elif file_extension.lower() in ['.jpg', '.jpeg']:
-        media_type = "image/jpeg"
-    
-    # Prepare the request payload
-    request_body = json.dumps({
+    image = preprocess_image(image_path)
+    return image["data"], image["media_type"]
+
+
+def _vision_request(images, max_tokens=1000, description=None):
+    """
+    Build the body of a Claude vision request
+
+    :param images: Preprocessed images (see image_batch.py), at most MAX_IMAGES_PER_REQUEST
+    :param max_tokens: Maximum length of the description
+    :param description: Description of the claim's earlier photos, which this request extends
+    :return: The JSON request body
+    """
+    if len(images) == 1 and not description:
+        content = [
+            {
+                "type": "image",
+                "source": {
+                    "type": "base64",
+                    "media_type": images[0]["media_type"],
+                    "data": images[0]["data"]
+                }
+            },
+            {
+                "type": "text",
+                "text": "What do you see in this image? Give a concise description and focus and what happened to vehicles."
+            }
+        ]
+    else:
+        # Several photos of one claim: label each one and ask for a single account of the accident
+        content = []
+        for index, image in enumerate(images, start=1):
+            content.append({"type": "text", "text": f"Image {index}:"})
+            content.append({"type": "image", "source": {"type": "base64", "media_type": image["media_type"], "data": image["data"]}})
+        prompt = ("These photos all belong to one insurance claim. Give one concise, consolidated description "
+                  "of the accident, focused on what happened to the vehicles; do not describe the photos one by one.")
+        if description:
+            prompt = (f"These photos belong to an insurance claim already described as follows:\n\n{description}\n\n"
+                      "Concisely add what these further photos show about the accident and the vehicles, "
+                      "without repeating the description.")
+        content.append({"type": "text", "text": prompt})
+
+    return json.dumps({
         "anthropic_version": "bedrock-2023-05-31",
-        "max_tokens": 1000,
+        "max_tokens": max_tokens,
         "messages": [
             {
                 "role": "user",
-                "content": [
-                    {
-                        "type": "image",
-                        "source": {
-                            "type": "base64",
-                            "media_type": media_type,
-                            "data": base64_image
-                        }
-                    },
-                    {
-                        "type": "text",
-                        "text": "What do you see in this image? Give a concise description and focus and what happened to vehicles."
-                    }
-                ]
+                "content": content
             }
         ]
     })
-    
+
+
+def _stream_description(bedrock_runtime, model_id, request_body, usage=None, deadline=None, call=None):
+    """
+    Stream the text of one vision call
+
+    :param bedrock_runtime: The Bedrock runtime client
+    :param model_id: ID of the Bedrock model to use
+    :param request_body: The JSON request body
+    :param usage: Optional ClaimUsage to which the token counts of the call are added
+    :param deadline: Optional deadline in seconds since the epoch; the description stops there
+    :param call: Optional dict that receives the "stop_reason", and "deadline_exceeded" if the description was cut short
+    :yield: Streamed chunks of the response
+    """
+    call = {} if call is None else call
+    first_token = True
+    tokens = {"input_tokens": 0, "output_tokens": 0, "cache_read_tokens": 0, "cache_write_tokens": 0}
+
     try:
-        # Use invoke_model_with_response_stream for streaming
-        response = bedrock_runtime.invoke_model_with_response_stream(
-            modelId=model_id,
-            body=request_body
-        )
+        # Use invoke_model_with_response_stream for streaming; the stream keeps the deadline
+        with deadline_scope(deadline):
+            # Timed from the model call: the photos are already loaded, resized and encoded
+            start = time.perf_counter()
+            response = bedrock_runtime.invoke_model_with_response_stream(
+                modelId=model_id,
+                body=request_body
+            )
         
         # Stream the response
         for event in response['body']:
@@ -75,12 +110,137 @@ def stream_image_to_bedrock(image_path, model_id='anthropic.claude-3-sonnet-2024
                 
                 # Check for text in the streamed response
                 if decoded_chunk.get('type') == 'content_block_delta':
+                    if first_token:
+                        VISION_FIRST_TOKEN.labels(model_id=model_id).observe(time.perf_counter() - start)
+                        first_token = False
                     yield decoded_chunk['delta']['text']
+
+                # Token counts: input in message_start, output in message_delta
+                if decoded_chunk.get('type') == 'message_start':
+                    message_usage = decoded_chunk['message'].get('usage', {})
+                    tokens["cache_read_tokens"] = message_usage.get('cache_read_input_tokens') or 0
+                    tokens["cache_write_tokens"] = message_usage.get('cache_creation_input_tokens') or 0
+                    tokens["input_tokens"] = (message_usage.get('input_tokens', 0)
+                                              + tokens["cache_read_tokens"] + tokens["cache_write_tokens"])
+                elif decoded_chunk.get('type') == 'message_delta':
+                    tokens["output_tokens"] = decoded_chunk.get('usage', {}).get('output_tokens', tokens["output_tokens"])
+                    call["stop_reason"] = decoded_chunk.get('delta', {}).get('stop_reason')
                 
                 # Check for end of stream or completion
                 if decoded_chunk.get('type') == 'message_stop':
+                    # Bedrock's own counts, when present, take precedence
+                    metrics = decoded_chunk.get('amazon-bedrock-invocationMetrics') or {}
+                    tokens["output_tokens"] = metrics.get('outputTokenCount', tokens["output_tokens"])
                     break
+
+        elapsed = time.perf_counter() - start
+        VISION_LATENCY.labels(model_id=model_id).observe(elapsed)
+        if usage is not None:
+            usage.add_call("vision", model_id, latency_ms=elapsed * 1000, **tokens)
+    
+    except DeadlineExceeded as e:
+        # Keep what was described so far rather than failing the request
+        logger.warning(f"Image description cut short: {str(e)}")
+        call["deadline_exceeded"] = True
+
+
+def stream_image_to_bedrock(image_path, model_id=None, usage=None, deadline=None, hint=None):
+    """
+    Send an image to Amazon Bedrock and stream the response
+    
+    :param image_path: Path to the image file
+    :param model_id: ID of the Bedrock model to use; by default a model is picked per image (see vision_routing.py)
+    :param usage: Optional ClaimUsage to which the token counts of the call are added
+    :param deadline: Optional deadline in seconds since the epoch; the description stops there
+    :param hint: Optional routing hint of the caller, "simple" or "complex"
+    :yield: Streamed chunks of the response
+    :raises Exception: If the vision call fails
+    """
+    yield from stream_images_to_bedrock([image_path], model_id, usage=usage, deadline=deadline, hint=hint)
+
+
+def stream_images_to_bedrock(image_paths, model_id=None, usage=None, deadline=None, hint=None):
+    """
+    Send the photos of a claim to Amazon Bedrock and stream one consolidated description
+
+    The photos are preprocessed in parallel and packed into as few multi-image requests as the
+    model allows (see image_batch.py). Each further request extends the description so far.
+    
+    :param image_paths: Paths to the image files
+    :param model_id: ID of the Bedrock model to use; by default a model is picked per claim (see vision_routing.py)
+    :param usage: Optional ClaimUsage to which the token counts of the calls are added
+    :param deadline: Optional deadline in seconds since the epoch; the description stops there
+    :param hint: Optional routing hint of the caller, "simple" or "complex"
+    :yield: Streamed chunks of the response
+    :raises Exception: If a vision call fails; the chunks streamed so far are not a complete description
+    """
+    # Bedrock Runtime client, routed across BEDROCK_REGIONS
+    bedrock_runtime = get_bedrock_runtime()
+    
+    start = time.perf_counter()
+    route = None
+    description = ""
+
+    try:
+        images = preprocess_images(image_paths)
+        if model_id:
+            max_tokens = 1000
+        else:
+            # The largest photo decides: it carries the most detail
+            route, reason = choose_route(max(image["source_bytes"] for image in images), hint)
+            model_id, max_tokens = model_for(route)
+
+        for batch in pack_images(images):
+            separator = "\n\n" if description else ""
+            fallback = ""
+
+            if route == FAST and VISION_ROUTING == "adaptive":
+                # The fast description is held back until it is known to be good enough, so this mode does not stream
+                call = {}
+                try:
+                    text = "".join(_stream_description(
+                        bedrock_runtime, model_id, _vision_request(batch, max_tokens, description), usage, deadline, call))
+                    # No time is left to escalate a description cut short by the deadline
+                    cause = None if call.get("deadline_exceeded") else escalation_cause(text, call.get("stop_reason"))
+                except Exception as e:
+                    logger.warning(f"Fast image description failed: {str(e)}")
+                    VISION_ESCALATIONS.labels(cause="error").inc()
+                    text, cause = "", "error"
+
+                if not cause:
+                    if text:
+                        yield separator + text
+                    description += separator + text
+                    if call.get("deadline_exceeded"):
+                        break
+                    continue
+                # Every further request goes to the strong model too
+                route = ESCALATED
+                model_id, max_tokens = model_for(STRONG)
+                fallback = text
+
+            call = {}
+            text = ""
+            for chunk in _stream_description(bedrock_runtime, model_id, _vision_request(batch, max_tokens, description),
+                                             usage, deadline, call):
+                if not text:
+                    chunk = separator + chunk
+                text += chunk
+                yield chunk
+            if not text and fallback:
+                # The deadline ran out before the strong model said anything; the fast description is better than none
+                text = separator + fallback
+                yield text
+            description += text
+            if call.get("deadline_exceeded"):
+                break
     
     except Exception as e:
-        print(f"Error streaming image to Bedrock: {e}")
-        yield f"Error: {str(e)}"
\ No newline at end of file
+        logger.error(f"Error streaming image to Bedrock: {str(e)}")
+        raise
+    finally:
+        label = route or "explicit"
+        VISION_ROUTE_LATENCY.labels(route=label).observe(time.perf_counter() - start)
+        VISION_DESCRIPTION_LENGTH.labels(route=label).observe(len(description))
+        if usage is not None:
+            usage.vision_route = route
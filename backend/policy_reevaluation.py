@@ -0,0 +1,308 @@
+"""
+Incremental re-evaluation of stored claims when a policy is edited.
+
+Every claim records the version of the policy it was computed from (see policy_version.py). This
+job follows the change stream of the policy collection and, when the hash of a policy changes,
+re-evaluates only the claims that recorded an older one, instead of rerunning the whole corpus:
+
+    python policy_reevaluation.py                  # follow the change stream
+    python policy_reevaluation.py --once           # re-evaluate every out-of-date claim, then exit
+
+A claim is updated without the LLM when only the sections it copies changed. New approval
+thresholds are copied into its approval guidance, and its approval level is read off them for its
+estimated reserves. New reserve guidelines are copied into its reserve recommendations when the
+claim has no reserve estimate. Claims built from the policy defaults (usage.degraded) are
+rebuilt from the new version. In every other case, e.g. when the handler actions or the decision
+tree changed, the agent is rerun on the claim's description, --concurrency claims at a time,
+and its answer replaces the recommendation, approval level, reserves, priority and timeline.
+Claims stored before they recorded their policy are never re-evaluated.
+
+The resume token of the change stream is stored in POLICY_WATCH_COLLECTION, so a restarted job
+picks up where it stopped. Change streams need a replica set, such as Atlas; on a standalone
+server, or with BACKEND_MODE=fake, run with --once after editing policies.
+"""
+
+from agent_tools import claim_sink, summarize_policy
+from claim_schema import ClaimRecord, approval_level_label
+from deadline import deadline_after
+from log_config import configure_logging
+from metrics import CLAIM_REEVALUATIONS
+from mongo_client import get_collection
+from policy_version import POLICY_SECTIONS, changed_sections, policy_reference
+
+from pymongo import UpdateOne
+from pymongo.errors import OperationFailure
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+from typing import Optional
+import argparse
+import math
+import os
+import re
+import logging
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+POLICY_WATCH_COLLECTION = os.getenv("POLICY_WATCH_COLLECTION", "policy_watch_state")
+REEVALUATION_CONCURRENCY = int(os.getenv("REEVALUATION_CONCURRENCY", "4"))
+WATCH_STATE_ID = "policy_reevaluation"
+# The resume token is older than the oplog
+CHANGE_STREAM_HISTORY_LOST = 286
+
+DETERMINISTIC = "deterministic"
+LLM = "llm"
+FAILED = "failed"
+# Claim fields the agent's answer replaces; the date, description and handler are kept
+REEVALUATED_FIELDS = ("recommendation", "approval_level", "estimated_reserves", "priority", "timeline")
+# Fields summarize_policy reads, so that change events do not carry the embeddings
+POLICY_FIELDS = ("_id", "name", "type", "description", "documentationRequired") + POLICY_SECTIONS
+AMOUNT = re.compile(r"\$?\s*(\d[\d,]*(?:\.\d+)?)\s*")
+
+
+def ensure_policy_indexes():
+    """Create the index the job finds the out-of-date claims of a policy with."""
+    get_collection(os.getenv("COLLECTION_NAME_2")).create_index([("policy.id", 1), ("policy.hash", 1)])
+
+
+def reserve_amount(estimated_reserves) -> Optional[float]:
+    """
+    Total of a claim's estimated reserves.
+
+    Args:
+        estimated_reserves: A number, an amount such as "$25,000", or a dict of amounts with an optional "total".
+
+    Returns:
+        float: The total, or None if it cannot be read without the LLM.
+    """
+    if isinstance(estimated_reserves, bool):
+        return None
+    if isinstance(estimated_reserves, (int, float)):
+        return float(estimated_reserves)
+    if isinstance(estimated_reserves, str):
+        match = AMOUNT.fullmatch(estimated_reserves)
+        return float(match.group(1).replace(",", "")) if match else None
+    if isinstance(estimated_reserves, dict):
+        if "total" in estimated_reserves:
+            return reserve_amount(estimated_reserves["total"])
+        amounts = [reserve_amount(amount) for amount in estimated_reserves.values()]
+        if amounts and None not in amounts:
+            return sum(amounts)
+    return None
+
+
+def _max_amount(threshold) -> float:
+    amount = threshold.get("maxAmount") if isinstance(threshold, dict) else None
+    if isinstance(amount, (int, float)) and not isinstance(amount, bool):
+        return float(amount)
+    # "unlimited"
+    return math.inf
+
+
+def approval_tier(thresholds: dict, amount: float) -> Optional[str]:
+    """
+    Lowest approval tier of a policy whose maxAmount covers an amount.
+
+    Args:
+        thresholds (dict): The policy's approvalThresholds, e.g. {"supervisorApproval": {"maxAmount": 25000}}.
+        amount (float): The claim's reserves.
+
+    Returns:
+        str: The tier as the agent's claims name it, e.g. "Supervisor Approval", or None if no tier covers the amount.
+    """
+    for name, threshold in sorted(thresholds.items(), key=lambda item: _max_amount(item[1])):
+        if amount <= _max_amount(threshold):
+            return approval_level_label(name)
+    return None
+
+
+def deterministic_update(claim: dict, policy: dict, changed: list) -> Optional[dict]:
+    """
+    Update of a claim to the new version of its policy, computed without the LLM.
+
+    Args:
+        claim (dict): The stored claim.
+        policy (dict): The summary of the new policy version.
+        changed (list): The sections that changed since the claim was computed.
+
+    Returns:
+        dict: The $set of the update, or None if the agent must be rerun.
+    """
+    if (claim.get("usage") or {}).get("degraded"):
+        record = ClaimRecord.from_policy(policy, claim["description"])
+        return {"recommendation": record.recommendation.model_dump(), "approval_level": record.approval_level}
+    if not set(changed) <= {"approvalThresholds", "reserveGuidelines"}:
+        return None
+
+    update = {}
+    if "reserveGuidelines" in changed:
+        # The estimate was read off the old guidelines
+        if claim.get("estimated_reserves") is not None:
+            return None
+        update["recommendation.reserve_recommendations"] = policy["reserveGuidelines"]
+    if "approvalThresholds" in changed:
+        amount = reserve_amount(claim.get("estimated_reserves"))
+        tier = approval_tier(policy["approvalThresholds"], amount) if amount is not None else None
+        if tier is None:
+            return None
+        update["recommendation.approval_guidance"] = policy["approvalThresholds"]
+        update["approval_level"] = tier
+    return update
+
+
+def rerun_agent(claim: dict, reference: dict, changed: list) -> None:
+    """
+    Rerun the agent on a claim's description and replace the claim's evaluation with its answer.
+
+    Args:
+        claim (dict): The stored claim.
+        reference (dict): The new version of its policy, recorded if the run retrieved no policy.
+        changed (list): The sections that changed since the claim was computed.
+    """
+    # Imported here so that the deterministic updates need no Bedrock client
+    from insurance_agent import insurance_agent
+
+    # The claim the run persists is collected instead of inserted
+    documents = []
+    token = claim_sink.set(documents)
+    try:
+        insurance_agent(claim["description"], deadline=deadline_after(None))
+    finally:
+        claim_sink.reset(token)
+
+    answer = documents[0]
+    get_collection(os.getenv("COLLECTION_NAME_2")).update_one(
+        # Skipped if another re-evaluation got there first
+        {"_id": claim["_id"], "policy.hash": claim["policy"]["hash"]},
+        {"$set": {
+            **{field: answer[field] for field in REEVALUATED_FIELDS},
+            # A degraded claim the agent now answers is no longer degraded, and a rerun that fell back is
+            "usage.degraded": answer.get("usage", {}).get("degraded", False),
+            "policy": answer.get("policy") or reference,
+            "reevaluation": {"date": datetime.now(timezone.utc), "mode": LLM, "sections": changed,
+                             "cost_usd": answer.get("usage", {}).get("cost_usd", 0.0)},
+        }},
+    )
+
+
+def reevaluate_policy(policy: dict, concurrency: int = REEVALUATION_CONCURRENCY) -> dict:
+    """
+    Re-evaluate the claims computed from an older version of a policy.
+
+    Args:
+        policy (dict): The policy document, at least its POLICY_FIELDS.
+        concurrency (int): Agent reruns at the same time.
+
+    Returns:
+        dict: Counts of claims updated DETERMINISTIC-ally, by LLM and FAILED.
+    """
+    summary = summarize_policy(policy)
+    reference = policy_reference(policy["_id"], summary)
+    claims = get_collection(os.getenv("COLLECTION_NAME_2"))
+    stale = claims.find({"policy.id": policy["_id"], "policy.hash": {"$ne": reference["hash"]}},
+                        {"description": 1, "estimated_reserves": 1, "usage.degraded": 1, "policy": 1})
+
+    updates, reruns = [], []
+    now = datetime.now(timezone.utc)
+    for claim in stale:
+        changed = changed_sections(claim["policy"], reference)
+        update = deterministic_update(claim, summary, changed)
+        if update is None:
+            reruns.append((claim, changed))
+            continue
+        updates.append(UpdateOne(
+            {"_id": claim["_id"], "policy.hash": claim["policy"]["hash"]},
+            {"$set": {**update, "policy": reference,
+                      "reevaluation": {"date": now, "mode": DETERMINISTIC, "sections": changed}}},
+        ))
+    if updates:
+        claims.bulk_write(updates, ordered=False)
+
+    counts = {DETERMINISTIC: len(updates), LLM: 0, FAILED: 0}
+    if reruns:
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="reevaluate") as executor:
+            futures = {executor.submit(rerun_agent, claim, reference, changed): claim for claim, changed in reruns}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                    counts[LLM] += 1
+                except Exception as e:
+                    logger.error(f"Re-evaluation of claim {futures[future]['_id']} failed: {str(e)}")
+                    counts[FAILED] += 1
+
+    for mode, count in counts.items():
+        if count:
+            CLAIM_REEVALUATIONS.labels(mode=mode).inc(count)
+    if any(counts.values()):
+        logger.info(f"Policy {policy['_id']} ({summary['name']}): {counts[DETERMINISTIC]} claims updated "
+                    f"deterministically, {counts[LLM]} by the agent, {counts[FAILED]} failed")
+    return counts
+
+
+def reevaluate_all(concurrency: int = REEVALUATION_CONCURRENCY) -> dict:
+    """Re-evaluate the out-of-date claims of every policy. Returns the total counts."""
+    totals = {DETERMINISTIC: 0, LLM: 0, FAILED: 0}
+    policies = get_collection(os.getenv("COLLECTION_NAME"))
+    for policy in policies.find({}, {field: 1 for field in POLICY_FIELDS}):
+        for mode, count in reevaluate_policy(policy, concurrency).items():
+            totals[mode] += count
+    return totals
+
+
+def watch_policies(concurrency: int = REEVALUATION_CONCURRENCY):
+    """
+    Follow the change stream of the policy collection and re-evaluate the claims of every edited policy.
+
+    Without a stored resume token, e.g. on the first start, every policy is checked once the stream is open.
+    """
+    policies = get_collection(os.getenv("COLLECTION_NAME"))
+    state = get_collection(POLICY_WATCH_COLLECTION)
+    saved = state.find_one({"_id": WATCH_STATE_ID})
+    resume_token = saved["resume_token"] if saved else None
+    pipeline = [
+        {"$match": {"operationType": {"$in": ["update", "replace"]}}},
+        {"$project": {"operationType": 1, **{f"fullDocument.{field}": 1 for field in POLICY_FIELDS}}},
+    ]
+
+    while True:
+        try:
+            with policies.watch(pipeline, full_document="updateLookup", resume_after=resume_token) as stream:
+                logger.info(f"Watching {policies.name} for policy edits")
+                if resume_token is None:
+                    # Edits made while no job was watching; later ones are in the stream
+                    reevaluate_all(concurrency)
+                for change in stream:
+                    # None if the policy was deleted since
+                    if change.get("fullDocument"):
+                        reevaluate_policy(change["fullDocument"], concurrency)
+                    resume_token = stream.resume_token
+                    state.update_one({"_id": WATCH_STATE_ID},
+                                     {"$set": {"resume_token": resume_token, "date": datetime.now(timezone.utc)}},
+                                     upsert=True)
+        except OperationFailure as e:
+            if e.code != CHANGE_STREAM_HISTORY_LOST:
+                raise
+            logger.warning("The resume token has expired; checking every policy")
+            resume_token = None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Re-evaluate the stored claims of edited policies.")
+    parser.add_argument("--once", action="store_true",
+                        help="Re-evaluate every out-of-date claim and exit instead of following the change stream.")
+    parser.add_argument("--concurrency", type=int, default=REEVALUATION_CONCURRENCY,
+                        help="Agent reruns at the same time.")
+    args = parser.parse_args()
+
+    configure_logging()
+    ensure_policy_indexes()
+    if args.once:
+        totals = reevaluate_all(args.concurrency)
+        print(f"{totals[DETERMINISTIC]} claims updated deterministically, {totals[LLM]} by the agent, "
+              f"{totals[FAILED]} failed")
+    else:
+        watch_policies(args.concurrency)
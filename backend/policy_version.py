@@ -0,0 +1,43 @@
+"""
+Content hashes of the policy sections that claims are computed from.
+
+A persisted claim records the version of the policy it used as "policy": the policy's _id, a hash
+of its handler actions, approval thresholds, decision tree and reserve guidelines, and the hash of
+each of these sections. When a policy is edited, policy_reevaluation.py finds the claims whose
+hash is out of date, and for each the sections that changed.
+"""
+
+from typing import Any, Dict, List
+import hashlib
+import json
+
+# Sections of the policy summary (see agent_tools.summarize_policy) that claims are computed from
+POLICY_SECTIONS = ("handlerActions", "approvalThresholds", "decisionTree", "reserveGuidelines")
+
+
+def content_hash(value: Any) -> str:
+    """SHA-256 of the canonical JSON of a value: key order and whitespace do not change it."""
+    canonical = json.dumps(value, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def policy_reference(policy_id: Any, policy: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Version of a policy, as recorded on the claims computed from it.
+
+    Args:
+        policy_id: The _id of the policy document.
+        policy (dict): The policy summary.
+
+    Returns:
+        dict: The policy "id", the "hash" of its sections and the hash of each section in "sections".
+    """
+    sections = {section: content_hash(policy.get(section))[:16] for section in POLICY_SECTIONS}
+    return {"id": policy_id, "hash": content_hash(sections), "sections": sections}
+
+
+def changed_sections(recorded: Dict[str, Any], current: Dict[str, Any]) -> List[str]:
+    """Sections whose hash differs between the version recorded on a claim and the current one."""
+    recorded_sections = recorded.get("sections") or {}
+    return [section for section in POLICY_SECTIONS
+            if recorded_sections.get(section) != current["sections"][section]]
@@ -0,0 +1,253 @@
+"""
+On-demand profiling of single requests.
+
+Profiling is opt-in per request and guarded by a shared secret: set PROFILING_TOKEN and send it in
+the X-Profile-Token header to run one /imageDescriptor or /runAgent request under the pyinstrument
+sampling profiler (poetry install -E profiling). The token is only read from the header, so that it
+never ends up in access logs. Other requests, and every request when PROFILING_TOKEN is unset, run
+as usual.
+
+Each profile is stored in MongoDB, in PROFILES_COLLECTION, as a gzipped speedscope file (open it at
+https://www.speedscope.app) and a summary of the wall-clock time spent in each module and in the
+hottest functions, so that profiles recorded by the claim workers can be read from the API. Both are
+served by GET /profiles/{profile_id} and GET /profiles/{profile_id}/summary with the same token, and
+expire PROFILE_TTL_SECONDS after they were recorded.
+"""
+
+from bson import Binary
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import Response
+
+from mongo_client import get_collection
+
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from queue import Queue
+import gzip
+import hmac
+import os
+import re
+import sysconfig
+import threading
+import logging
+from dotenv import load_dotenv
+
+try:
+    from pyinstrument import Profiler
+    from pyinstrument.renderers import SpeedscopeRenderer
+    PYINSTRUMENT_AVAILABLE = True
+except ImportError:
+    PYINSTRUMENT_AVAILABLE = False
+
+# Load environment variables from .env file
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+PROFILING_TOKEN = os.getenv("PROFILING_TOKEN")
+PROFILES_COLLECTION = os.getenv("PROFILES_COLLECTION", "profiles")
+PROFILE_TTL_SECONDS = int(os.getenv("PROFILE_TTL_SECONDS", str(7 * 24 * 3600)))
+# Seconds between samples
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.001"))
+TOP_FUNCTIONS = 25
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+STDLIB_DIR = sysconfig.get_paths()["stdlib"]
+PROFILE_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+router = APIRouter()
+
+
+def _check_token(token: str) -> bool:
+    return bool(PROFILING_TOKEN) and hmac.compare_digest(token.encode("utf-8"), PROFILING_TOKEN.encode("utf-8"))
+
+
+def profiling_requested(request: Request) -> bool:
+    """
+    Whether the request asks to be profiled with a valid token.
+
+    Raises:
+        HTTPException: 403 when a profiling token is sent but does not match PROFILING_TOKEN.
+    """
+    token = request.headers.get("X-Profile-Token")
+    if not token or not PROFILING_TOKEN:
+        return False
+    if not _check_token(token):
+        raise HTTPException(status_code=403, detail="Invalid profiling token")
+    if not PYINSTRUMENT_AVAILABLE:
+        logger.warning("Profiling requested but pyinstrument is not installed; running unprofiled")
+        return False
+    return True
+
+
+def _module_of(file_path: str) -> str:
+    """Group a frame's file into a module name: the backend module, the installed package or the stdlib module."""
+    if not file_path or file_path.startswith("<"):
+        return "<builtin>"
+    path = os.path.abspath(file_path)
+    for marker in ("site-packages", "dist-packages"):
+        if marker in path:
+            package = path.split(marker + os.sep, 1)[1].split(os.sep, 1)[0]
+            return package[:-3] if package.endswith(".py") else package
+    if path.startswith(BACKEND_DIR):
+        return os.path.splitext(os.path.relpath(path, BACKEND_DIR))[0].replace(os.sep, ".")
+    if path.startswith(STDLIB_DIR):
+        module = os.path.relpath(path, STDLIB_DIR).split(os.sep, 1)[0]
+        return "stdlib:" + (module[:-3] if module.endswith(".py") else module)
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def module_breakdown(session) -> dict:
+    """
+    Split the wall-clock time of a profile by module and by function.
+
+    Time is attributed to the frame that was executing (self time), so serialisation inside
+    pydantic, pprint formatting or botocore response parsing each show up under their own module
+    rather than under the agent code that called them.
+
+    Returns:
+        dict: Total seconds, seconds per module and the hottest functions, slowest first.
+    """
+    modules = defaultdict(float)
+    functions = defaultdict(float)
+
+    root = session.root_frame()
+    stack = [(root, root)] if root else []
+    while stack:
+        frame, parent = stack.pop()
+        # pyinstrument records self time in synthetic "[self]" children; credit it to their parent
+        if frame.is_synthetic:
+            owner, self_time = parent, frame.time
+        else:
+            owner, self_time = frame, frame.time - sum(child.time for child in frame.children)
+            stack.extend((child, frame) for child in frame.children)
+        if self_time > 0:
+            module = _module_of(owner.file_path)
+            modules[module] += self_time
+            functions[f"{module}:{owner.function}"] += self_time
+
+    return {
+        "duration_s": session.duration,
+        "samples": session.sample_count,
+        "modules": dict(sorted(modules.items(), key=lambda item: -item[1])),
+        "functions": dict(sorted(functions.items(), key=lambda item: -item[1])[:TOP_FUNCTIONS]),
+    }
+
+
+def ensure_profile_indexes():
+    """Create the TTL index that expires old profiles."""
+    get_collection(PROFILES_COLLECTION).create_index("created_at", expireAfterSeconds=PROFILE_TTL_SECONDS)
+
+
+def save_profile(profile_id: str, label: str, session):
+    """Store the speedscope file and the module summary of a finished profile."""
+    created_at = datetime.now(timezone.utc)
+    summary = {
+        "profile_id": profile_id,
+        "label": label,
+        "created_at": created_at.isoformat(),
+        **module_breakdown(session),
+    }
+    speedscope = gzip.compress(SpeedscopeRenderer().render(session).encode("utf-8"))
+    get_collection(PROFILES_COLLECTION).replace_one(
+        {"_id": profile_id},
+        {"label": label, "created_at": created_at, "summary": summary, "speedscope": Binary(speedscope)},
+        upsert=True,
+    )
+
+    top = ", ".join(f"{module} {seconds:.3f}s" for module, seconds in list(summary["modules"].items())[:5])
+    logger.info(f"Profile {profile_id} ({label}) took {summary['duration_s']:.3f}s: {top}")
+
+
+@contextmanager
+def profiled(profile_id: str, label: str):
+    """
+    Context manager that profiles its body and saves the result under profile_id.
+
+    Only the calling thread is sampled.
+    """
+    if not PYINSTRUMENT_AVAILABLE:
+        logger.warning(f"pyinstrument is not installed; profile {profile_id} not recorded")
+        yield
+        return
+
+    profiler = Profiler(interval=PROFILE_INTERVAL)
+    profiler.start()
+    try:
+        yield
+    finally:
+        profiler.stop()
+        try:
+            save_profile(profile_id, label, profiler.last_session)
+        except Exception as e:
+            logger.warning(f"Could not save profile {profile_id}: {str(e)}")
+
+
+_DONE = object()
+
+
+def profiled_stream(chunks, profile_id: str, label: str):
+    """
+    Profile a streaming generator while its chunks are still passed on as they arrive.
+
+    A streaming response pulls each chunk from whichever threadpool thread is free, but the
+    profiler samples a single thread, so the generator is drained by one producer thread under the
+    profiler and its chunks are handed over through a queue.
+    """
+    queue = Queue()
+
+    def produce():
+        try:
+            with profiled(profile_id, label):
+                for chunk in chunks:
+                    queue.put(chunk)
+        except Exception as e:
+            queue.put(e)
+        finally:
+            # Sent once the profile is saved, so it can be fetched as soon as the response ends
+            queue.put(_DONE)
+
+    threading.Thread(target=produce, name=f"profile-{profile_id}", daemon=True).start()
+
+    while True:
+        item = queue.get()
+        if item is _DONE:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+
+def _require_token(request: Request):
+    token = request.headers.get("X-Profile-Token") or ""
+    # Profiles stay hidden unless profiling is enabled and the caller knows the token
+    if not PROFILING_TOKEN:
+        raise HTTPException(status_code=404, detail="Profiling is disabled")
+    if not _check_token(token):
+        raise HTTPException(status_code=403, detail="Invalid profiling token")
+
+
+def _existing_profile(profile_id: str, field: str) -> dict:
+    document = None
+    if PROFILE_ID_PATTERN.match(profile_id):
+        document = get_collection(PROFILES_COLLECTION).find_one({"_id": profile_id}, {field: 1})
+    if not document:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return document[field]
+
+
+@router.get("/profiles/{profile_id}")
+def get_profile(profile_id: str, request: Request):
+    """Speedscope file of a profiled request."""
+    _require_token(request)
+    speedscope = gzip.decompress(_existing_profile(profile_id, "speedscope"))
+    return Response(speedscope, media_type="application/json",
+                    headers={"Content-Disposition": f'attachment; filename="{profile_id}.speedscope.json"'})
+
+
+@router.get("/profiles/{profile_id}/summary")
+def get_profile_summary(profile_id: str, request: Request):
+    """Wall-clock time per module and hottest functions of a profiled request."""
+    _require_token(request)
+    return _existing_profile(profile_id, "summary")
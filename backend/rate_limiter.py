@@ -0,0 +1,447 @@
+"""
+Shared rate limiting of the Bedrock runtime calls.
+
+The vision stream, the Cohere embeddings and the agent's ChatBedrock all call Bedrock through the
+client returned by backends.get_bedrock_runtime, which is wrapped in a RateLimitedBedrockRuntime.
+For each model id and region, every invocation, retries included:
+
+1. takes one of this process's concurrency slots. The number of slots adapts to throttling (AIMD):
+   it grows by one per round of successful calls, up to BEDROCK_MAX_CONCURRENCY, and is halved
+   when Bedrock answers with a ThrottlingException. Streams hold their slot until consumed.
+2. takes a token from a bucket refilled at an adaptive rate: halved on throttling, then recovering
+   linearly to BEDROCK_REQUESTS_PER_SECOND over RATE_RECOVERY_SECONDS. With
+   BEDROCK_RATE_LIMITER=mongo the bucket is a document shared by the API and every claim worker;
+   "local" (the default) keeps one bucket per process and "off" disables the limiter.
+
+botocore's own retries are turned off while the limiter is on. Throttled and transient failures are
+retried here with jittered exponential backoff, so every retry waits for a token like any other
+call instead of adding to the burst that caused the throttling. Within a request deadline (see
+deadline.py) no wait, call or retry is started that would end after it.
+"""
+
+from metrics import (BEDROCK_CONCURRENCY_LIMIT, BEDROCK_IN_FLIGHT, BEDROCK_LIMITER_WAIT, BEDROCK_RETRIES,
+                     THROTTLING_CODES)
+from deadline import DeadlineExceeded, check_deadline, claim_deadline, remaining
+
+from botocore.exceptions import ClientError, ConnectionClosedError, EndpointConnectionError, ReadTimeoutError
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+from functools import lru_cache, partial
+import json
+import os
+import random
+import threading
+import time
+import logging
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# "local", "mongo" or "off"
+BEDROCK_RATE_LIMITER = os.getenv("BEDROCK_RATE_LIMITER", "local").lower()
+REQUESTS_PER_SECOND = float(os.getenv("BEDROCK_REQUESTS_PER_SECOND", "10"))
+# Per-model overrides, e.g. {"cohere.embed-english-v3": 30}
+MODEL_REQUESTS_PER_SECOND = json.loads(os.getenv("BEDROCK_MODEL_REQUESTS_PER_SECOND", "{}"))
+MAX_CONCURRENCY = int(os.getenv("BEDROCK_MAX_CONCURRENCY", "16"))
+MAX_ATTEMPTS = int(os.getenv("BEDROCK_MAX_ATTEMPTS", "4"))
+RATE_LIMIT_COLLECTION = os.getenv("BEDROCK_RATE_LIMIT_COLLECTION", "bedrock_rate_limits")
+
+DECREASE_FACTOR = 0.5
+# Throttles within this many seconds of a decrease come from the same burst and only count once
+DECREASE_COOLDOWN_SECONDS = 1.0
+# The adaptive rate never drops below this fraction of the configured rate
+MIN_RATE_FRACTION = 0.05
+# Seconds for the rate to grow from zero back to the configured rate
+RATE_RECOVERY_SECONDS = 30.0
+BACKOFF_BASE_SECONDS = 0.25
+BACKOFF_MAX_SECONDS = 10.0
+# Compare-and-set attempts on a shared bucket before falling back to the local one, and their backoff
+BUCKET_UPDATE_ATTEMPTS = int(os.getenv("BEDROCK_RATE_LIMIT_UPDATE_ATTEMPTS", "8"))
+BUCKET_BACKOFF_BASE_SECONDS = 0.005
+BUCKET_BACKOFF_MAX_SECONDS = 0.2
+
+RETRYABLE_CODES = THROTTLING_CODES + ("ServiceUnavailableException", "ModelNotReadyException",
+                                      "InternalServerException")
+CONNECTION_ERRORS = (ConnectionClosedError, EndpointConnectionError, ReadTimeoutError)
+
+
+def rate_limiter_enabled() -> bool:
+    """Whether Bedrock calls go through the rate limiter."""
+    return BEDROCK_RATE_LIMITER != "off"
+
+
+def error_code(error: Exception) -> str:
+    if isinstance(error, ClientError):
+        return error.response.get("Error", {}).get("Code", "ClientError")
+    return type(error).__name__
+
+
+def _is_throttle(error: Exception) -> bool:
+    return error_code(error) in THROTTLING_CODES
+
+
+def is_retryable_error(error: Exception) -> bool:
+    return isinstance(error, CONNECTION_ERRORS) or error_code(error) in RETRYABLE_CODES
+
+
+def _refill(tokens: float, rate: float, elapsed: float, max_rate: float) -> tuple:
+    """
+    State of a bucket after elapsed seconds.
+
+    Tokens accrue at the current rate, up to one second's worth, and the rate recovers linearly
+    towards max_rate.
+
+    Returns:
+        tuple: The tokens and the rate.
+    """
+    elapsed = max(0.0, elapsed)
+    rate = min(max_rate, rate + max_rate * elapsed / RATE_RECOVERY_SECONDS)
+    return min(max(1.0, rate), tokens + elapsed * rate), rate
+
+
+class AdaptiveConcurrency:
+    """ Limit of concurrent calls of one model in this process, adjusted by AIMD. """
+
+    def __init__(self, model_id: str, max_limit: int = MAX_CONCURRENCY) -> None:
+        self.model_id = model_id
+        self.max_limit = max_limit
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self._decreased_at = float("-inf")
+        self._condition = threading.Condition()
+        BEDROCK_CONCURRENCY_LIMIT.labels(model_id=model_id).set(self.limit)
+
+    def acquire(self, timeout: float = None) -> bool:
+        """
+        Wait for a free slot and take it.
+
+        Args:
+            timeout (float): Seconds to wait at most, or None to wait as long as it takes.
+
+        Returns:
+            bool: Whether a slot was taken before the timeout.
+        """
+        with self._condition:
+            if not self._condition.wait_for(lambda: self.in_flight < int(self.limit), timeout):
+                return False
+            self.in_flight += 1
+        BEDROCK_IN_FLIGHT.labels(model_id=self.model_id).inc()
+        return True
+
+    def release(self, throttled: bool = False):
+        """Free a slot, halving the limit after a throttled call and growing it after a successful one."""
+        with self._condition:
+            self.in_flight -= 1
+            if throttled:
+                now = time.monotonic()
+                if now - self._decreased_at >= DECREASE_COOLDOWN_SECONDS:
+                    self.limit = max(1.0, self.limit * DECREASE_FACTOR)
+                    self._decreased_at = now
+                    logger.warning(f"Bedrock throttled {self.model_id}; concurrency limit lowered to {int(self.limit)}")
+            else:
+                # +1 per `limit` successful calls, i.e. one per round of calls
+                self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+            self._condition.notify_all()
+            limit = self.limit
+        BEDROCK_IN_FLIGHT.labels(model_id=self.model_id).dec()
+        BEDROCK_CONCURRENCY_LIMIT.labels(model_id=self.model_id).set(limit)
+
+
+class LocalTokenBucket:
+    """ Token bucket of one model in this process. """
+
+    def __init__(self, key: str, max_rate: float) -> None:
+        self.key = key
+        self.max_rate = max_rate
+        self.rate = max_rate
+        self.tokens = max(1.0, max_rate)
+        self._updated_at = time.monotonic()
+        self._decreased_at = float("-inf")
+        self._lock = threading.Lock()
+
+    def _advance(self, now: float):
+        self.tokens, self.rate = _refill(self.tokens, self.rate, now - self._updated_at, self.max_rate)
+        self._updated_at = now
+
+    def reserve(self) -> float:
+        """
+        Take a token, possibly one that has not accrued yet.
+
+        Returns:
+            float: Seconds to wait before the call may be made.
+        """
+        with self._lock:
+            self._advance(time.monotonic())
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def throttled(self):
+        """Halve the rate after a throttled call."""
+        with self._lock:
+            now = time.monotonic()
+            if now - self._decreased_at < DECREASE_COOLDOWN_SECONDS:
+                return
+            self._advance(now)
+            self.rate = max(self.max_rate * MIN_RATE_FRACTION, self.rate * DECREASE_FACTOR)
+            self._decreased_at = now
+
+
+class MongoTokenBucket:
+    """
+    Token bucket of one model shared through MongoDB by every process using the same collection.
+
+    Each bucket is one document updated by compare-and-set on its version: a read and a conditional
+    update, two round trips per call when uncontended. A process that loses the race retries after
+    a jittered backoff, at most BUCKET_UPDATE_ATTEMPTS times. Timestamps are the callers' wall
+    clocks, so workers should run with NTP. When MongoDB is unreachable, or the bucket stays
+    contended, calls fall back to a bucket of this process.
+    """
+
+    def __init__(self, key: str, max_rate: float) -> None:
+        self.key = key
+        self.max_rate = max_rate
+        self._fallback = LocalTokenBucket(key, max_rate)
+
+    @staticmethod
+    def _collection():
+        # Imported here: mongo_client imports backends, which wraps its Bedrock client with this module
+        from mongo_client import get_collection
+        return get_collection(RATE_LIMIT_COLLECTION)
+
+    def _state(self, collection, now: float) -> dict:
+        state = collection.find_one({"_id": self.key})
+        if state is None:
+            try:
+                collection.insert_one({"_id": self.key, "tokens": max(1.0, self.max_rate), "rate": self.max_rate,
+                                       "updated_at": now, "decreased_at": 0.0, "version": 0})
+            except DuplicateKeyError:
+                pass
+            state = collection.find_one({"_id": self.key})
+        return state
+
+    def _update(self, change):
+        """
+        Apply change(state, now) to the bucket document, provided no other process updated it in between.
+
+        change returns the fields to set, or None to leave the document unchanged.
+
+        Returns:
+            True if the document was updated, False if change left it unchanged, or None if every
+            attempt lost the race to another process.
+        """
+        collection = self._collection()
+        for attempt in range(BUCKET_UPDATE_ATTEMPTS):
+            if attempt:
+                # Full jitter, so that the processes that lost the race do not collide again
+                time.sleep(random.uniform(0, min(BUCKET_BACKOFF_MAX_SECONDS, BUCKET_BACKOFF_BASE_SECONDS * 2 ** attempt)))
+            now = time.time()
+            state = self._state(collection, now)
+            fields = change(state, now)
+            if fields is None:
+                return False
+            result = collection.update_one({"_id": self.key, "version": state["version"]},
+                                           {"$set": {**fields, "updated_at": now}, "$inc": {"version": 1}})
+            if result.modified_count == 1:
+                return True
+        return None
+
+    def reserve(self) -> float:
+        """
+        Take a token, possibly one that has not accrued yet.
+
+        Returns:
+            float: Seconds to wait before the call may be made.
+        """
+        reserved = {}
+
+        def take(state, now):
+            tokens, rate = _refill(state["tokens"], state["rate"], now - state["updated_at"], self.max_rate)
+            reserved.update(tokens=tokens - 1, rate=rate)
+            return reserved
+
+        try:
+            updated = self._update(take)
+        except PyMongoError as e:
+            logger.warning(f"Shared Bedrock rate limit unavailable, using the local bucket: {str(e)}")
+            return self._fallback.reserve()
+        if updated is None:
+            logger.warning(f"Shared Bedrock rate limit {self.key} contended, using the local bucket")
+            return self._fallback.reserve()
+        return 0.0 if reserved["tokens"] >= 0 else -reserved["tokens"] / reserved["rate"]
+
+    def throttled(self):
+        """Halve the shared rate after a throttled call, once per burst of throttles across processes."""
+        def halve(state, now):
+            if now - state["decreased_at"] < DECREASE_COOLDOWN_SECONDS:
+                return None
+            tokens, rate = _refill(state["tokens"], state["rate"], now - state["updated_at"], self.max_rate)
+            return {"tokens": tokens, "rate": max(self.max_rate * MIN_RATE_FRACTION, rate * DECREASE_FACTOR),
+                    "decreased_at": now}
+
+        try:
+            updated = self._update(halve)
+        except PyMongoError as e:
+            logger.warning(f"Shared Bedrock rate limit unavailable, using the local bucket: {str(e)}")
+            updated = None
+        if updated is None:
+            self._fallback.throttled()
+
+
+class BedrockRateLimiter:
+    """ Concurrency limits and token buckets of the Bedrock models called by this process. """
+
+    def __init__(self, backend: str = BEDROCK_RATE_LIMITER) -> None:
+        """
+        Initialize the BedrockRateLimiter class.
+
+        Args:
+            backend (str): "mongo" to share the token buckets across processes, "local" otherwise.
+        """
+        self.backend = backend
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def _limits(self, region: str, model_id: str) -> tuple:
+        # Bedrock quotas apply per model and region
+        key = f"{region}:{model_id}"
+        with self._lock:
+            if key not in self._models:
+                rate = float(MODEL_REQUESTS_PER_SECOND.get(model_id, REQUESTS_PER_SECOND))
+                bucket_class = MongoTokenBucket if self.backend == "mongo" else LocalTokenBucket
+                self._models[key] = (AdaptiveConcurrency(model_id), bucket_class(key, rate))
+            return self._models[key]
+
+    def acquire(self, region: str, model_id: str):
+        """Wait for a concurrency slot and a token of the model."""
+        concurrency, bucket = self._limits(region, model_id)
+        start = time.perf_counter()
+        left = remaining()
+        if not concurrency.acquire(None if left is None else max(left, 0)):
+            raise DeadlineExceeded(f"Deadline exceeded waiting for a Bedrock slot for {model_id}")
+        try:
+            wait = bucket.reserve()
+            left = remaining()
+            if left is not None and wait >= left:
+                raise DeadlineExceeded(f"Deadline exceeded waiting {wait:.1f}s for a Bedrock token for {model_id}")
+        except Exception:
+            concurrency.release()
+            raise
+        if wait > 0:
+            time.sleep(wait)
+        BEDROCK_LIMITER_WAIT.labels(model_id=model_id).observe(time.perf_counter() - start)
+
+    def release(self, region: str, model_id: str, throttled: bool = False):
+        """Free the slot taken by acquire, lowering the limits when the call was throttled."""
+        concurrency, bucket = self._limits(region, model_id)
+        concurrency.release(throttled)
+        if throttled:
+            bucket.throttled()
+
+
+class _ReleasingStream:
+    """ Response stream that frees its concurrency slot once consumed, failed or dropped. """
+
+    def __init__(self, stream, release, deadline: float = None) -> None:
+        self._stream = stream
+        self._release = release
+        self._released = False
+        # Captured now: a streaming response may be read from other threads than the caller's
+        self._deadline = deadline
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+    def __iter__(self):
+        throttled = False
+        try:
+            for event in self._stream:
+                if self._deadline is not None and time.time() > self._deadline:
+                    raise DeadlineExceeded("Deadline exceeded while reading a Bedrock response stream")
+                yield event
+        except ClientError as e:
+            # Throttling can also interrupt a stream that has started
+            throttled = _is_throttle(e)
+            raise
+        finally:
+            self._done(throttled)
+
+    def close(self):
+        """Drop the stream unread, e.g. the losing response of a hedged call."""
+        try:
+            self._stream.close()
+        finally:
+            self._done()
+
+    def _done(self, throttled: bool = False):
+        if not self._released:
+            self._released = True
+            self._release(throttled=throttled)
+
+    def __del__(self):
+        self._done()
+
+
+class RateLimitedBedrockRuntime:
+    """ Bedrock runtime client proxy that passes every model invocation through the rate limiter. """
+
+    def __init__(self, client, limiter: BedrockRateLimiter) -> None:
+        self._client = client
+        self._limiter = limiter
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def invoke_model(self, **kwargs) -> dict:
+        return self._call(self._client.invoke_model, kwargs)
+
+    def converse(self, **kwargs) -> dict:
+        return self._call(self._client.converse, kwargs)
+
+    def invoke_model_with_response_stream(self, **kwargs) -> dict:
+        return self._call(self._client.invoke_model_with_response_stream, kwargs, stream_key="body")
+
+    def converse_stream(self, **kwargs) -> dict:
+        return self._call(self._client.converse_stream, kwargs, stream_key="stream")
+
+    def _call(self, method, kwargs: dict, stream_key: str = None) -> dict:
+        region = self._client.meta.region_name
+        model_id = kwargs.get("modelId", "unknown")
+
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            check_deadline(f"calling {model_id}")
+            self._limiter.acquire(region, model_id)
+            try:
+                response = method(**kwargs)
+            except Exception as e:
+                self._limiter.release(region, model_id, throttled=_is_throttle(e))
+                if attempt == MAX_ATTEMPTS or not is_retryable_error(e):
+                    raise
+                delay = random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+                left = remaining()
+                if left is not None and delay >= left:
+                    raise DeadlineExceeded(f"No time left to retry {model_id} after {error_code(e)}") from e
+                BEDROCK_RETRIES.labels(model_id=model_id, reason=error_code(e)).inc()
+                logger.warning(f"Bedrock call to {model_id} failed with {error_code(e)}, retry {attempt} in {delay:.2f}s")
+                time.sleep(delay)
+                continue
+
+            if stream_key is None:
+                self._limiter.release(region, model_id)
+                return response
+            # Streams keep their slot until the caller has read them
+            release = partial(self._limiter.release, region, model_id)
+            return {**response, stream_key: _ReleasingStream(response[stream_key], release, claim_deadline.get())}
+
+
+@lru_cache(maxsize=None)
+def get_rate_limiter() -> BedrockRateLimiter:
+    """Get the process-wide BedrockRateLimiter shared by every Bedrock runtime client."""
+    return BedrockRateLimiter(BEDROCK_RATE_LIMITER)
+
+
+def rate_limited_bedrock_runtime(client):
+    """Wrap a Bedrock runtime client in a RateLimitedBedrockRuntime unless BEDROCK_RATE_LIMITER=off."""
+    return RateLimitedBedrockRuntime(client, get_rate_limiter()) if rate_limiter_enabled() else client
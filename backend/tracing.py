@@ -0,0 +1,281 @@
+"""
+OpenTelemetry tracing of the claim pipeline.
+
+Tracing is optional: it is enabled by OTEL_TRACES_EXPORTER ("console" or "otlp") and needs the
+packages of the "tracing" extra (poetry install -E tracing). Without them every helper here is a
+no-op, so the rest of the backend can call them unconditionally.
+
+Spans cover the FastAPI handlers, each LangGraph node, each agent tool, each Bedrock
+invoke_model / invoke_model_with_response_stream call and each MongoDB command.
+"""
+
+from pymongo import monitoring
+
+from contextlib import contextmanager
+from functools import wraps
+import inspect
+import json
+import os
+import logging
+from dotenv import load_dotenv
+
+try:
+    from opentelemetry import trace
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+    from opentelemetry.trace import SpanKind, Status, StatusCode
+    OTEL_AVAILABLE = True
+except ImportError:
+    OTEL_AVAILABLE = False
+
+# Load environment variables from .env file
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Standard OpenTelemetry variables: "console", "otlp" or "none"
+TRACES_EXPORTER = os.getenv("OTEL_TRACES_EXPORTER", "none").lower()
+SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "insurance-claim-agent")
+
+_configured = False
+
+
+def tracing_enabled() -> bool:
+    """Whether spans are recorded and exported."""
+    return OTEL_AVAILABLE and TRACES_EXPORTER not in ("", "none")
+
+
+def setup_tracing(app=None):
+    """
+    Configure the tracer provider and exporter once per process, and instrument the FastAPI app.
+
+    Args:
+        app (FastAPI): The app whose handlers get server spans. Optional, e.g. for claim workers.
+    """
+    global _configured
+
+    if not tracing_enabled():
+        if TRACES_EXPORTER not in ("", "none"):
+            logger.warning("OTEL_TRACES_EXPORTER is set but OpenTelemetry is not installed; tracing disabled")
+        return
+
+    if not _configured:
+        provider = TracerProvider(resource=Resource.create({"service.name": SERVICE_NAME}))
+        if TRACES_EXPORTER == "otlp":
+            # Endpoint and headers come from OTEL_EXPORTER_OTLP_* variables
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+            exporter = OTLPSpanExporter()
+        else:
+            exporter = ConsoleSpanExporter()
+        provider.add_span_processor(BatchSpanProcessor(exporter))
+        trace.set_tracer_provider(provider)
+        _configured = True
+        logger.info(f"Tracing enabled with the {TRACES_EXPORTER} exporter")
+
+    if app is not None:
+        try:
+            from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
+            # One span per request; per-chunk send/receive spans would swamp the streaming endpoints
+            FastAPIInstrumentor.instrument_app(app, exclude_spans=["receive", "send"])
+        except ImportError:
+            logger.warning("opentelemetry-instrumentation-fastapi is not installed; no HTTP server spans")
+
+
+class _NoopSpan:
+    """ Stands in for a span when tracing is disabled. """
+
+    def set_attribute(self, key, value):
+        pass
+
+    def set_attributes(self, attributes):
+        pass
+
+    def record_exception(self, exception):
+        pass
+
+    def is_recording(self) -> bool:
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def _clean(attributes: dict) -> dict:
+    # Span attributes must be primitives; None values are dropped
+    return {key: value if isinstance(value, (str, bool, int, float)) else str(value)
+            for key, value in attributes.items() if value is not None}
+
+
+@contextmanager
+def start_span(name: str, **attributes):
+    """
+    Context manager that runs its body in a child span of the current one.
+
+    Args:
+        name (str): The span name.
+        **attributes: Span attributes, e.g. k=5 or model_id="...".
+
+    Yields:
+        The span, to add attributes once they are known.
+    """
+    if not tracing_enabled():
+        yield _NOOP_SPAN
+        return
+
+    with trace.get_tracer(__name__).start_as_current_span(name, attributes=_clean(attributes)) as span:
+        yield span
+
+
+def traced(name: str = None, **attributes):
+    """
+    Decorator that runs every call of the function in a span.
+
+    Works on sync and async functions and keeps the signature and docstring, so it can sit
+    under @tool.
+
+    Args:
+        name (str): The span name. Defaults to the function's qualified name.
+        **attributes: Static span attributes.
+    """
+    def decorator(func):
+        span_name = name or func.__qualname__
+
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with start_span(span_name, **attributes):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with start_span(span_name, **attributes):
+                return func(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+def set_attributes(**attributes):
+    """Add attributes to the current span, if any."""
+    if tracing_enabled():
+        trace.get_current_span().set_attributes(_clean(attributes))
+
+
+# -- Bedrock ----------------------------------------------------------------------------------
+
+class TracedBedrockRuntime:
+    """ Bedrock runtime client proxy that records a span for every model invocation. """
+
+    def __init__(self, client) -> None:
+        self._client = client
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    @staticmethod
+    def _token_counts(response: dict) -> dict:
+        headers = response.get("ResponseMetadata", {}).get("HTTPHeaders", {})
+        return {
+            "gen_ai.usage.input_tokens": headers.get("x-amzn-bedrock-input-token-count"),
+            "gen_ai.usage.output_tokens": headers.get("x-amzn-bedrock-output-token-count"),
+        }
+
+    def invoke_model(self, **kwargs) -> dict:
+        with start_span("bedrock.invoke_model", **{
+            "gen_ai.system": "aws.bedrock",
+            "gen_ai.request.model": kwargs.get("modelId"),
+            "bedrock.request_bytes": len(kwargs.get("body") or b""),
+            "cloud.region": self._client.meta.region_name,
+        }) as span:
+            response = self._client.invoke_model(**kwargs)
+            span.set_attributes(_clean(self._token_counts(response)))
+            return response
+
+    def invoke_model_with_response_stream(self, **kwargs) -> dict:
+        tracer = trace.get_tracer(__name__)
+        # The span outlives this call: it ends when the caller has consumed the stream
+        span = tracer.start_span("bedrock.invoke_model_with_response_stream", kind=SpanKind.CLIENT, attributes=_clean({
+            "gen_ai.system": "aws.bedrock",
+            "gen_ai.request.model": kwargs.get("modelId"),
+            "bedrock.request_bytes": len(kwargs.get("body") or b""),
+            "cloud.region": self._client.meta.region_name,
+        }))
+        try:
+            response = self._client.invoke_model_with_response_stream(**kwargs)
+        except Exception as e:
+            span.record_exception(e)
+            span.set_status(Status(StatusCode.ERROR, str(e)))
+            span.end()
+            raise
+        return {**response, "body": self._traced_stream(response["body"], span)}
+
+    @staticmethod
+    def _traced_stream(body, span):
+        events = 0
+        try:
+            for event in body:
+                if events == 0:
+                    span.add_event("first_chunk")
+                events += 1
+                chunk = event.get("chunk")
+                # Only the final event carries the invocation metrics; skip parsing the others
+                if chunk and b"invocationMetrics" in chunk["bytes"]:
+                    metrics = json.loads(chunk["bytes"]).get("amazon-bedrock-invocationMetrics")
+                    if metrics:
+                        span.set_attributes(_clean({
+                            "gen_ai.usage.input_tokens": metrics.get("inputTokenCount"),
+                            "gen_ai.usage.output_tokens": metrics.get("outputTokenCount"),
+                            "bedrock.first_byte_latency_ms": metrics.get("firstByteLatency"),
+                        }))
+                yield event
+        finally:
+            span.set_attribute("bedrock.stream_events", events)
+            span.end()
+
+
+def traced_bedrock_runtime(client):
+    """Wrap a Bedrock runtime client in a TracedBedrockRuntime when tracing is enabled."""
+    return TracedBedrockRuntime(client) if tracing_enabled() else client
+
+
+# -- MongoDB ----------------------------------------------------------------------------------
+
+class MongoCommandTracer(monitoring.CommandListener):
+    """ pymongo command listener that records a client span per command. """
+
+    def __init__(self) -> None:
+        self._spans = {}
+
+    @staticmethod
+    def _key(event):
+        return event.connection_id, event.request_id
+
+    def started(self, event):
+        command = event.command
+        span = trace.get_tracer(__name__).start_span(f"mongodb.{event.command_name}", kind=SpanKind.CLIENT, attributes=_clean({
+            "db.system": "mongodb",
+            "db.name": event.database_name,
+            "db.operation": event.command_name,
+            "db.mongodb.collection": command.get(event.command_name) if isinstance(command.get(event.command_name), str) else None,
+        }))
+        self._spans[self._key(event)] = span
+
+    def succeeded(self, event):
+        span = self._spans.pop(self._key(event), None)
+        if span is None:
+            return
+        span.end()
+
+    def failed(self, event):
+        span = self._spans.pop(self._key(event), None)
+        if span is None:
+            return
+        span.set_status(Status(StatusCode.ERROR, str(event.failure)))
+        span.end()
+
+
+def mongo_event_listeners() -> list:
+    """Command listeners to pass to MongoClient: a MongoCommandTracer when tracing is enabled."""
+    return [MongoCommandTracer()] if tracing_enabled() else []
@@ -0,0 +1,113 @@
+"""
+Routing of the vision step between a fast and a strong Claude model.
+
+Most accident photos are simple, one or two vehicles with visible damage, and the fast model
+(Claude 3 Haiku) describes them about as well as the strong one (Claude 3 Sonnet) in less time
+and at a fraction of the cost. An image is routed by cheap signals, in this order:
+
+1. the caller's hint, "simple" or "complex";
+2. the image size: photos over VISION_FAST_MAX_BYTES carry detail the fast model may miss.
+
+With VISION_ROUTING=size, the default, the chosen model's description is streamed as it is written.
+VISION_ROUTING=adaptive adds a third signal, the fast model's own description, which serves as the
+first-pass classification: it is held back until complete and escalated to the strong model when it
+was cut off, hedges ("unclear", "difficult to determine") or describes a complex scene (several
+vehicles, people injured). Adaptive routing is therefore not streamed: nothing is sent before the
+fast description is complete, which adds its whole duration to the time to first token.
+
+VISION_ROUTING=fast or strong sends every image to that model. An explicit model id bypasses routing.
+"""
+
+from metrics import VISION_ESCALATIONS, VISION_ROUTES
+
+import os
+import re
+import logging
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# "size", "adaptive", "fast" or "strong"
+VISION_ROUTING = os.getenv("VISION_ROUTING", "size").lower()
+VISION_FAST_MODEL_ID = os.getenv("VISION_FAST_MODEL_ID", "anthropic.claude-3-haiku-20240307-v1:0")
+VISION_STRONG_MODEL_ID = os.getenv("VISION_STRONG_MODEL_ID", "anthropic.claude-3-sonnet-20240229-v1:0")
+VISION_FAST_MAX_BYTES = int(os.getenv("VISION_FAST_MAX_BYTES", str(512 * 1024)))
+# A fast description ends well within this; hitting it means the scene needed more
+VISION_FAST_MAX_TOKENS = int(os.getenv("VISION_FAST_MAX_TOKENS", "600"))
+VISION_STRONG_MAX_TOKENS = int(os.getenv("VISION_STRONG_MAX_TOKENS", "1000"))
+
+FAST = "fast"
+STRONG = "strong"
+# A fast description that was replaced by the strong model's
+ESCALATED = "escalated"
+HINTS = {"simple": FAST, "complex": STRONG}
+
+# Descriptions shorter than this say too little to file a claim on
+MIN_DESCRIPTION_CHARS = 80
+UNCERTAIN = re.compile(
+    r"\b(unclear|uncertain|difficult to (?:tell|determine|see)|hard to (?:tell|say|see)|cannot (?:tell|determine|see)"
+    r"|can't (?:tell|determine|see)|not (?:possible|clear) to|blurry|obscured)\b", re.IGNORECASE)
+COMPLEX_SCENE = re.compile(
+    r"\b(multi-vehicle|multiple (?:vehicles|cars)|several (?:vehicles|cars)|pile-?up|pedestrians?|cyclists?"
+    r"|injur(?:y|ies|ed)|ambulance|casualt(?:y|ies)|school bus)\b", re.IGNORECASE)
+
+
+def model_for(route: str) -> tuple:
+    """Get the model id and max_tokens of a route."""
+    if route == FAST:
+        return VISION_FAST_MODEL_ID, VISION_FAST_MAX_TOKENS
+    return VISION_STRONG_MODEL_ID, VISION_STRONG_MAX_TOKENS
+
+
+def choose_route(image_bytes: int, hint: str = None) -> tuple:
+    """
+    Pick the route of an image before any model has seen it.
+
+    Args:
+        image_bytes (int): Size of the image file.
+        hint (str): The caller's hint, "simple" or "complex". Unknown hints are ignored.
+
+    Returns:
+        tuple: The route, FAST or STRONG, and the signal that decided it.
+    """
+    if VISION_ROUTING in (FAST, STRONG):
+        route, reason = VISION_ROUTING, "fixed"
+    elif hint and hint.lower() in HINTS:
+        route, reason = HINTS[hint.lower()], "hint"
+    elif image_bytes > VISION_FAST_MAX_BYTES:
+        route, reason = STRONG, "size"
+    else:
+        route, reason = FAST, "size"
+    VISION_ROUTES.labels(route=route, reason=reason).inc()
+    return route, reason
+
+
+def escalation_cause(description: str, stop_reason: str = None) -> str:
+    """
+    Check a description of the fast model.
+
+    Args:
+        description (str): The complete description.
+        stop_reason (str): The stop reason of the call; "max_tokens" means it was cut off.
+
+    Returns:
+        str: Why the image should go to the strong model, or None if the description will do.
+    """
+    if VISION_ROUTING == FAST:
+        return None
+    if stop_reason == "max_tokens":
+        cause = "truncated"
+    elif len(description.strip()) < MIN_DESCRIPTION_CHARS:
+        cause = "too_short"
+    elif UNCERTAIN.search(description):
+        cause = "uncertain"
+    elif COMPLEX_SCENE.search(description):
+        cause = "complex_scene"
+    else:
+        return None
+    VISION_ESCALATIONS.labels(cause=cause).inc()
+    logger.info(f"Escalating image description to {VISION_STRONG_MODEL_ID}: {cause}")
+    return cause
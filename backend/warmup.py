@@ -0,0 +1,120 @@
+"""
+Warm-up of the API and claim worker processes.
+
+Clients, models and the agent graph are created on first use, so importing the backend opens no
+connection and cannot fail on an unreachable dependency. warm_up() makes that first use happen
+before traffic arrives: it connects to MongoDB, applies the indexes, creates the Bedrock client
+and the agent, compiles the graph and embeds one query. The API runs it in the background from
+its lifespan and reports progress on GET /ready; failed steps are retried until they succeed.
+"""
+
+from mongo_client import get_mongo_client
+from backends import get_bedrock_runtime
+
+import asyncio
+import os
+import time
+import logging
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+WARMUP_RETRY_SECONDS = float(os.getenv("WARMUP_RETRY_SECONDS", "5"))
+
+_status = {"ready": False, "steps": {}, "error": None}
+
+
+def _ping_mongo():
+    get_mongo_client().admin.command("ping")
+
+
+def _apply_indexes():
+    from claim_schema import ensure_claims_validator
+    from claim_queue import ensure_job_indexes
+    from claims_api import ensure_claim_indexes
+    from image_descriptions import ensure_description_indexes
+    from profiling import ensure_profile_indexes
+
+    ensure_claims_validator()
+    ensure_job_indexes()
+    ensure_claim_indexes()
+    ensure_description_indexes()
+    ensure_profile_indexes()
+
+
+def _create_bedrock_client():
+    get_bedrock_runtime()
+
+
+def _compile_agent():
+    from agent_definition import get_chatbot_agent
+    from insurance_agent import get_graph
+
+    get_chatbot_agent()
+    get_graph()
+
+
+def _embed_query():
+    # Opens the pooled HTTPS connection to Bedrock and loads the embedding model
+    from agent_tools import get_query_embedding_model
+
+    get_query_embedding_model().embed_query("warm-up")
+
+
+# Steps run in order; each one is skipped once it has succeeded
+API_WARMUP_STEPS = [
+    ("mongo", _ping_mongo),
+    ("indexes", _apply_indexes),
+    ("bedrock", _create_bedrock_client),
+    ("agent", _compile_agent),
+    ("embedding", _embed_query),
+]
+WORKER_WARMUP_STEPS = [step for step in API_WARMUP_STEPS if step[0] != "indexes"]
+
+
+def warm_up(steps: list = API_WARMUP_STEPS) -> bool:
+    """
+    Run the warm-up steps that have not succeeded yet.
+
+    Args:
+        steps (list): (name, function) pairs to run in order.
+
+    Returns:
+        bool: Whether every step has succeeded, i.e. the process is ready.
+    """
+    for name, step in steps:
+        if name in _status["steps"]:
+            continue
+        start = time.perf_counter()
+        try:
+            step()
+        except Exception as e:
+            _status["error"] = f"{name}: {str(e)}"
+            logger.warning(f"Warm-up step {name} failed: {str(e)}")
+            return False
+        _status["steps"][name] = round((time.perf_counter() - start) * 1000, 1)
+        logger.info(f"Warm-up step {name} done in {_status['steps'][name]} ms")
+
+    _status["ready"] = True
+    _status["error"] = None
+    return True
+
+
+def warm_up_until_ready(steps: list = API_WARMUP_STEPS):
+    """Run warm_up, retrying every WARMUP_RETRY_SECONDS until it succeeds."""
+    while not warm_up(steps):
+        time.sleep(WARMUP_RETRY_SECONDS)
+
+
+async def warm_up_in_background(steps: list = API_WARMUP_STEPS):
+    """Async warm_up_until_ready for the FastAPI lifespan; the blocking steps run in a thread."""
+    while not await asyncio.to_thread(warm_up, steps):
+        await asyncio.sleep(WARMUP_RETRY_SECONDS)
+
+
+def readiness() -> dict:
+    """Whether the process is warm, the duration of each finished step in ms and the last error."""
+    return {"ready": _status["ready"], "steps": dict(_status["steps"]), "error": _status["error"]}
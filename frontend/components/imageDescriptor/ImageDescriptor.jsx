@@ -87,6 +87,9 @@ const ImageDescriptor = () => {
 
       if (!response.body) throw new Error("ReadableStream not supported.");
 
+      // The stored description is queued by its id once the stream is complete
+      const descriptionId = response.headers.get("X-Description-Id");
+
       const reader = response.body.getReader();
       const decoder = new TextDecoder();
       let done = false;
@@ -112,7 +115,7 @@ const ImageDescriptor = () => {
       }, 4000);
 
       // After description is complete, call the agent
-      await runAgent();
+      await runAgent(descriptionId);
 
     } catch (error) {
       console.error("Error while streaming response:", error);
@@ -127,9 +130,11 @@ const ImageDescriptor = () => {
     }
   }, [claimDetails]);
 
-  const runAgent = async () => {
+  const runAgent = async (descriptionId) => {
     try {
-      const response = await fetch(process.env.NEXT_PUBLIC_RUN_AGENT_API_URL, {
+      const runAgentUrl = new URL(process.env.NEXT_PUBLIC_RUN_AGENT_API_URL);
+      runAgentUrl.searchParams.set("description_id", descriptionId);
+      const response = await fetch(runAgentUrl, {
         method: "POST",
         headers: {
           'Content-Type': 'application/json',
@@ -140,7 +145,23 @@ const ImageDescriptor = () => {
         throw new Error(`Server error: ${response.status}`);
       }
 
-      const result = await response.json();
+      // The agent runs in a background worker; poll the job until the claim is ready
+      const { job_id } = await response.json();
+      const claimUrl = new URL(`/claims/${job_id}`, process.env.NEXT_PUBLIC_RUN_AGENT_API_URL);
+      let result = { status: "queued" };
+
+      while (result.status === "queued" || result.status === "running") {
+        await new Promise((resolve) => setTimeout(resolve, 2000));
+        const claimResponse = await fetch(claimUrl);
+        if (!claimResponse.ok) {
+          throw new Error(`Server error: ${claimResponse.status}`);
+        }
+        result = await claimResponse.json();
+      }
+
+      if (result.status === "failed") {
+        throw new Error(`Agent run failed: ${result.error}`);
+      }
       console.log("Agent result recommendation:", result.recommendation);
 
       // The backend now sends the proper nested structure
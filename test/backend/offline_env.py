@@ -0,0 +1,26 @@
+"""
+Environment of the offline tests: the fake Bedrock and MongoDB backends and a throwaway namespace.
+
+Import it before any backend module. Needs no AWS credentials and no Atlas cluster.
+"""
+
+import os
+import sys
+
+os.environ["BACKEND_MODE"] = "fake"
+for key, value in {
+    "AWS_REGION": "us-east-1",
+    "MONGODB_URI": "mongodb://localhost",
+    "DATABASE_NAME": "insurance_offline",
+    "COLLECTION_NAME": "policies",
+    "COLLECTION_NAME_2": "claims",
+    "CHAT_HISTORY_COLLECTION": "chat_history",
+}.items():
+    os.environ.setdefault(key, value)
+
+# Add backend directory to Python path (relative to project root)
+script_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.dirname(os.path.dirname(script_dir))
+backend_path = os.path.join(project_root, "backend")
+if backend_path not in sys.path:
+    sys.path.append(backend_path)
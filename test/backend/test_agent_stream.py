@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Tests of /runAgent/stream: Server-Sent Events framing and deduplication of repeated requests.
+
+Runs against the fake Bedrock and MongoDB backends.
+"""
+
+import json
+import threading
+import time
+from unittest.mock import patch
+
+from offline_env import backend_path  # noqa: F401  (sets up the fake backends)
+
+from fastapi.testclient import TestClient
+
+from claim_queue import DONE, complete_job, get_job, start_job
+from image_descriptions import new_description_id, save_description
+from main import app
+
+# Not used as a context manager, so the lifespan's warm-up does not run
+client = TestClient(app)
+
+DESCRIPTION = "A silver sedan rear-ended a delivery van at a red light. The sedan's bonnet is crumpled."
+
+
+def parse_events(body: str) -> list:
+    """Split a text/event-stream body into (event, data) pairs, checking the framing of each event"""
+    assert body.endswith("\n\n"), body[-80:]
+    events = []
+    for frame in body[:-2].split("\n\n"):
+        lines = frame.split("\n")
+        assert len(lines) == 2 and lines[0].startswith("event: ") and lines[1].startswith("data: "), frame
+        name, data = lines[0][len("event: "):], json.loads(lines[1][len("data: "):])
+        assert data["event"] == name, frame
+        events.append((name, data))
+    return events
+
+
+def stored_description() -> str:
+    description_id = new_description_id()
+    save_description(description_id, DESCRIPTION)
+    return description_id
+
+
+def stream(description_id: str) -> list:
+    response = client.post("/runAgent/stream", params={"description_id": description_id})
+    assert response.status_code == 200, response.text
+    assert response.headers["content-type"].startswith("text/event-stream")
+    assert response.headers["cache-control"] == "no-cache"
+    return parse_events(response.text)
+
+
+def test_stream_framing():
+    """Each agent event is one event/data pair; the claim is sent once and the stream ends with done"""
+    events = stream(stored_description())
+    names = [name for name, _ in events]
+    assert {"token", "tool_start", "tool_end"} <= set(names), names
+    assert names.count("claim") == 1 and names[-1] == "done", names
+    claim = next(data for name, data in events if name == "claim")
+    assert events[-1][1]["object_id"] == claim["object_id"]
+    print(f"✅ SSE framing: {len(events)} events, claim {events[-1][1]['object_id']}")
+
+
+def test_repeated_stream_replays_claim():
+    """A repeated request replays the claim of the first one instead of running the agent again"""
+    description_id = stored_description()
+    first = stream(description_id)
+    with patch("main.stream_insurance_agent") as agent:
+        second = stream(description_id)
+        agent.assert_not_called()
+    assert [name for name, _ in second] == ["deduplicated", "claim", "done"]
+    assert second[-1][1]["object_id"] == first[-1][1]["object_id"]
+
+    # /runAgent shares the job of the streamed run
+    queued = client.post("/runAgent", params={"description_id": description_id}).json()
+    assert queued["deduplicated"] and queued["status"] == DONE
+    print("✅ SSE dedupe: the repeated request replays the first claim")
+
+
+def test_stream_follows_running_job():
+    """A request whose run is in flight elsewhere follows that job until its claim is stored"""
+    description_id = stored_description()
+    key = f"description:{description_id}"
+    job, created = start_job(DESCRIPTION, key, "api-elsewhere")
+    assert created
+
+    def finish():
+        time.sleep(0.3)
+        complete_job(job, "6601f0c2a1b2c3d4e5f60718")
+
+    threading.Thread(target=finish).start()
+    with patch("main.STREAM_FOLLOW_POLL_SECONDS", 0.05):
+        events = stream(description_id)
+    assert [name for name, _ in events] == ["deduplicated", "claim", "done"], events
+    assert events[0][1]["job_id"] == str(job["_id"])
+    assert events[-1][1]["object_id"] == "6601f0c2a1b2c3d4e5f60718"
+    assert get_job(str(job["_id"]))["status"] == DONE
+    print("✅ SSE follow: the in-flight run is followed to its claim")
+
+
+def test_unknown_description():
+    """An unknown or expired description id is a 404, before any event is sent"""
+    response = client.post("/runAgent/stream", params={"description_id": new_description_id()})
+    assert response.status_code == 404
+    print("✅ SSE unknown description: 404")
+
+
+if __name__ == "__main__":
+    test_stream_framing()
+    test_repeated_stream_replays_claim()
+    test_stream_follows_running_job()
+    test_unknown_description()
+    print("✅ Agent stream tests passed")
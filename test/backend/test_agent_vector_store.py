@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+"""
+Tests of the incident type inferred from an accident description to pre-filter the policy vector search.
+"""
+
+from offline_env import backend_path  # noqa: F401  (sets up the fake backends)
+
+from agent_vector_store import infer_incident_type
+
+
+def test_clear_keyword_match():
+    """Descriptions whose keywords point at one policy type are pre-filtered on it"""
+    assert infer_incident_type("A yellow school bus collided with a sedan") == "vehicle_collision"
+    assert infer_incident_type("A multi-vehicle pile-up on a foggy highway") == "complex_accident"
+    assert infer_incident_type("A pedestrian was struck at a crosswalk") == "personal_injury"
+    assert infer_incident_type("A car slid off an icy road in heavy snow") == "environmental_damage"
+    print("✅ Incident type: clear matches inferred")
+
+
+def test_no_prefilter_without_a_clear_lead():
+    """Generic words, no match and ties leave the vector search unfiltered"""
+    # "bus" alone says nothing about the policy type
+    assert infer_incident_type("A city bus scraped a parked van") is None
+    assert infer_incident_type("Two cars touched bumpers in a car park") is None
+    # One hit each for personal injury and technical failure
+    assert infer_incident_type("A cyclist fell after hitting a pothole") is None
+    # Two hits against one
+    assert infer_incident_type("A cyclist fell on a patch of ice in the snow") == "environmental_damage"
+    print("✅ Incident type: no pre-filter without a clear lead")
+
+
+if __name__ == "__main__":
+    test_clear_keyword_match()
+    test_no_prefilter_without_a_clear_lead()
+    print("✅ Incident type tests passed")
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+Tests of the claim job queue: deduplication, leases and their expiry, the heartbeat and the fail paths.
+
+Runs against the fake MongoDB backend.
+"""
+
+import time
+from datetime import datetime, timedelta, timezone
+
+from offline_env import backend_path  # noqa: F401  (sets up the fake backends)
+
+from claim_queue import (DONE, FAILED, MAX_ATTEMPTS, QUEUED, RUNNING, LeaseHeartbeat, claim_next_job, complete_job,
+                         enqueue_claim, fail_job, get_job, get_jobs_collection, reap_expired_jobs, renew_lease,
+                         start_job)
+from claim_usage import ClaimUsage
+
+
+def empty_queue():
+    """Start from an empty queue: claim_next_job takes the oldest runnable job of the whole collection"""
+    get_jobs_collection().delete_many({})
+
+
+def expire_lease(job: dict):
+    """Move the lease of a job into the past, as if its worker had died"""
+    get_jobs_collection().update_one(
+        {"_id": job["_id"]}, {"$set": {"lease_expires_at": datetime.now(timezone.utc) - timedelta(seconds=1)}})
+
+
+def test_enqueue_dedupes_and_requeues_failed():
+    """Requests with the same key share one job; only a job that failed for good is queued again"""
+    empty_queue()
+    usage = ClaimUsage()
+    job, created = enqueue_claim("A car hit a lamp post", "queue:dedupe", usage=usage)
+    again, created_again = enqueue_claim("A car hit a lamp post", "queue:dedupe")
+    assert created and not created_again and again["_id"] == job["_id"]
+    assert job["status"] == QUEUED and job["attempts"] == 0
+
+    get_jobs_collection().update_one({"_id": job["_id"]}, {"$set": {"status": FAILED, "attempts": MAX_ATTEMPTS,
+                                                                    "error": "boom"}})
+    requeued, created = enqueue_claim("A car hit a lamp post", "queue:dedupe")
+    assert created and requeued["_id"] == job["_id"]
+    assert requeued["status"] == QUEUED and requeued["attempts"] == 0 and "error" not in requeued
+
+    # A second request in the same race finds the job already back on the queue
+    _, created = enqueue_claim("A car hit a lamp post", "queue:dedupe")
+    assert not created
+    print("✅ Enqueue: one job per idempotency key, failed jobs requeued once")
+
+
+def test_expired_lease_is_reclaimed():
+    """A job whose lease expired is leased again, and the first worker can no longer complete it"""
+    empty_queue()
+    enqueue_claim("A van reversed into a bollard", "queue:expiry")
+    first = claim_next_job("worker-a")
+    assert first["status"] == RUNNING and first["worker_id"] == "worker-a" and first["attempts"] == 1
+
+    # Still leased: nobody else gets it
+    assert claim_next_job("worker-b") is None
+
+    expire_lease(first)
+    second = claim_next_job("worker-b")
+    assert second["_id"] == first["_id"] and second["attempts"] == 2
+    assert second["lease_id"] != first["lease_id"]
+
+    # The lease moved on: the first worker's renewal, completion and failure are all refused
+    assert not renew_lease(first)
+    assert not complete_job(first, "claim-a")
+    assert not fail_job(first, "late failure")
+    assert get_job(str(first["_id"]))["status"] == RUNNING
+
+    assert complete_job(second, "claim-b")
+    done = get_job(str(first["_id"]))
+    assert done["status"] == DONE and done["claim_id"] == "claim-b"
+    assert "lease_id" not in done and "lease_expires_at" not in done
+    print("✅ Lease expiry: the job is reclaimed and only the current lease holder completes it")
+
+
+def test_heartbeat_keeps_lease():
+    """A heartbeat keeps a short lease alive for longer than the lease, and notices when it is lost"""
+    empty_queue()
+    enqueue_claim("A lorry clipped a parked car", "queue:heartbeat")
+    job = claim_next_job("worker-a", lease_seconds=1)
+
+    with LeaseHeartbeat(job, interval=0.2, lease_seconds=1) as heartbeat:
+        time.sleep(1.5)
+        assert claim_next_job("worker-b") is None
+    assert not heartbeat.lost
+
+    # Once the heartbeat has stopped, the lease runs out and the job is reclaimed
+    time.sleep(1.2)
+    reclaimed = claim_next_job("worker-b")
+    assert reclaimed["_id"] == job["_id"]
+
+    with LeaseHeartbeat(job, interval=0.1, lease_seconds=1) as heartbeat:
+        time.sleep(0.4)
+    assert heartbeat.lost
+    print("✅ Heartbeat: the lease is renewed while the job runs, and its loss is detected")
+
+
+def test_fail_paths():
+    """A failed attempt requeues the job until MAX_ATTEMPTS; expired final attempts are reaped"""
+    empty_queue()
+    enqueue_claim("A scooter skidded on gravel", "queue:fail")
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        job = claim_next_job("worker-a")
+        assert job["attempts"] == attempt
+        assert fail_job(job, f"attempt {attempt} failed")
+        expected = FAILED if attempt == MAX_ATTEMPTS else QUEUED
+        stored = get_job(str(job["_id"]))
+        assert stored["status"] == expected and stored["error"] == f"attempt {attempt} failed"
+    assert claim_next_job("worker-a") is None
+
+    # A worker that dies on the final attempt leaves a running job that only the reaper fails
+    empty_queue()
+    enqueue_claim("A bus scraped a wall", "queue:reap")
+    get_jobs_collection().update_one({"idempotency_key": "queue:reap"}, {"$set": {"attempts": MAX_ATTEMPTS - 1}})
+    last = claim_next_job("worker-a")
+    assert last["attempts"] == MAX_ATTEMPTS
+    expire_lease(last)
+    assert claim_next_job("worker-b") is None
+    assert reap_expired_jobs() == 1
+    reaped = get_job(str(last["_id"]))
+    assert reaped["status"] == FAILED and "lease_id" not in reaped
+    assert not fail_job(last, "too late")
+    print("✅ Fail paths: requeued until MAX_ATTEMPTS, then failed; expired final attempts reaped")
+
+
+
+def test_start_job():
+    """The streaming endpoint's jobs are created leased to the caller, once per key, and take over failed jobs"""
+    empty_queue()
+    job, created = start_job("A taxi hit a cyclist", "queue:stream", "api-1")
+    assert created and job["status"] == RUNNING and job["worker_id"] == "api-1" and job["attempts"] == 1
+
+    again, created = start_job("A taxi hit a cyclist", "queue:stream", "api-2")
+    assert not created and again["_id"] == job["_id"] and again["worker_id"] == "api-1"
+    # /runAgent with the same key shares the job
+    queued, created = enqueue_claim("A taxi hit a cyclist", "queue:stream")
+    assert not created and queued["_id"] == job["_id"]
+
+    assert fail_job({**job, "attempts": MAX_ATTEMPTS}, "stream failed")
+    taken_over, created = start_job("A taxi hit a cyclist", "queue:stream", "api-2")
+    assert created and taken_over["worker_id"] == "api-2" and taken_over["status"] == RUNNING
+    assert "error" not in taken_over
+    print("✅ Streamed jobs: leased to the caller, deduplicated, failed jobs taken over")
+
+
+if __name__ == "__main__":
+    test_enqueue_dedupes_and_requeues_failed()
+    test_expired_lease_is_reclaimed()
+    test_heartbeat_keeps_lease()
+    test_fail_paths()
+    test_start_job()
+    print("✅ Claim queue tests passed")
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Tests of the claims listing: filters, keyset cursor paging, legacy string dates and reads by claim id.
+
+Runs against the fake MongoDB backend.
+"""
+
+import uuid
+from datetime import datetime, timedelta
+
+from offline_env import backend_path  # noqa: F401  (sets up the fake backends)
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from bson import ObjectId
+
+from claims_api import decode_cursor, encode_cursor, get_claims_collection, router
+
+app = FastAPI()
+app.include_router(router)
+client = TestClient(app)
+
+
+def insert_claims() -> tuple:
+    """Insert claims of a handler of their own, three of them on the same date, and one with a string date"""
+    handler = f"Handler {uuid.uuid4().hex[:8]}"
+    day = datetime(2024, 3, 1, 12, 0)
+    claims = [
+        {"date": day + timedelta(days=offset), "priority": priority, "approval_level": "Level 1",
+         "claim_handler": handler, "description": f"Claim {index}", "estimated_reserves": "$1,000"}
+        for index, (offset, priority) in enumerate([(0, "High"), (0, "Low"), (0, "High"), (1, "Low"), (2, "High"),
+                                                    (3, "Low"), (4, "High")])
+    ]
+    # Claims stored before the schema kept the date as a string
+    legacy = {"date": "2024-03-02", "priority": "High", "claim_handler": handler, "description": "Legacy claim"}
+    get_claims_collection().insert_many(claims + [legacy])
+    return handler, claims, legacy
+
+
+def list_all(params: dict, limit: int) -> list:
+    """Follow next_cursor to the last page and return every listed claim"""
+    claims, cursor = [], None
+    while True:
+        page = client.get("/claims", params={**params, "limit": limit, **({"cursor": cursor} if cursor else {})})
+        assert page.status_code == 200, page.text
+        body = page.json()
+        assert len(body["claims"]) <= limit
+        claims += body["claims"]
+        cursor = body["next_cursor"]
+        if cursor is None:
+            return claims
+
+
+def test_cursor_paging():
+    """Paging returns every claim once, newest first, with ties on the date broken by _id"""
+    handler, claims, _ = insert_claims()
+    expected = sorted(claims, key=lambda claim: (claim["date"], claim["_id"]), reverse=True)
+    for limit in (1, 2, 3, 7, 100):
+        listed = list_all({"claim_handler": handler}, limit)
+        assert [claim["_id"] for claim in listed] == [str(claim["_id"]) for claim in expected], limit
+
+    # A page that ends exactly at the last claim has no next cursor
+    assert client.get("/claims", params={"claim_handler": handler, "limit": 7}).json()["next_cursor"] is None
+    print("✅ Cursor paging: every claim listed once, ties on the date included")
+
+
+def test_string_dates_are_skipped():
+    """Claims with a legacy string date are left out of the listing instead of breaking the cursor"""
+    handler, claims, legacy = insert_claims()
+    listed = list_all({"claim_handler": handler, "priority": "High"}, 1)
+    assert str(legacy["_id"]) not in [claim["_id"] for claim in listed]
+    assert len(listed) == sum(claim["priority"] == "High" for claim in claims)
+
+    # The string date is still served by id
+    response = client.get(f"/claims/by-id/{legacy['_id']}")
+    assert response.status_code == 200 and response.json()["date"] == "2024-03-02"
+    print("✅ String dates: legacy claims skipped by the listing, still readable by id")
+
+
+def test_filters_and_fields():
+    """Equality and date range filters combine, and fields selects the projected claim fields"""
+    handler, claims, _ = insert_claims()
+    date_from, date_to = claims[0]["date"] + timedelta(days=1), claims[0]["date"] + timedelta(days=4)
+    listed = list_all({"claim_handler": handler, "priority": "Low", "date_from": date_from.isoformat(),
+                       "date_to": date_to.isoformat()}, 1)
+    expected = [claim for claim in claims if claim["priority"] == "Low" and date_from <= claim["date"] < date_to]
+    assert sorted(claim["_id"] for claim in listed) == sorted(str(claim["_id"]) for claim in expected)
+
+    page = client.get("/claims", params={"claim_handler": handler, "fields": "priority"}).json()
+    assert all(set(claim) == {"_id", "date", "priority"} for claim in page["claims"]), page["claims"][0]
+
+    assert client.get("/claims", params={"fields": "priority,password"}).status_code == 400
+    assert client.get("/claims", params={"limit": 0}).status_code == 422
+    print("✅ Filters: priority, handler and date range combined; fields projected")
+
+
+def test_cursor_edge_cases():
+    """Cursors round-trip their sort key; tampered cursors are rejected with 400"""
+    document = {"_id": ObjectId(), "date": datetime(2024, 3, 1, 12, 0, 0, 123000)}
+    assert decode_cursor(encode_cursor(document)) == (document["date"], document["_id"])
+
+    # Not base64, a truncated ObjectId, and "||" with no date or id
+    for cursor in ("not-a-cursor!", encode_cursor(document)[:-4] + "AAAA", "fHw="):
+        assert client.get("/claims", params={"cursor": cursor}).status_code == 400, cursor
+    print("✅ Cursor edge cases: round trip, malformed cursors rejected")
+
+
+def test_claim_by_id():
+    """The ids returned by the listing are served by /claims/by-id/{claim_id}; unknown ids are 404"""
+    handler, claims, _ = insert_claims()
+    listed = client.get("/claims", params={"claim_handler": handler, "limit": 1}).json()["claims"][0]
+    claim = client.get(f"/claims/by-id/{listed['_id']}")
+    assert claim.status_code == 200 and claim.json()["_id"] == listed["_id"] and claim.json()["status"] == "done"
+
+    assert client.get(f"/claims/by-id/{ObjectId()}").status_code == 404
+    assert client.get("/claims/by-id/not-an-object-id").status_code == 404
+    print("✅ Claim by id: listed claims readable, unknown ids 404")
+
+
+if __name__ == "__main__":
+    test_cursor_paging()
+    test_string_dates_are_skipped()
+    test_filters_and_fields()
+    test_cursor_edge_cases()
+    test_claim_by_id()
+    print("✅ Claims API tests passed")
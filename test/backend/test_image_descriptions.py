@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Tests of the descriptions stored by /imageDescriptor and read back by id by /runAgent and /runAgent/stream.
+
+Runs against the fake MongoDB backend; the vision call is replaced.
+"""
+
+import os
+import time
+from unittest.mock import patch
+
+from offline_env import backend_path  # noqa: F401  (sets up the fake backends)
+
+from fastapi.testclient import TestClient
+
+from claim_queue import QUEUED, get_job
+from deadline import deadline_timestamp
+from main import app
+
+# Not used as a context manager, so the lifespan's warm-up does not run
+client = TestClient(app)
+
+PHOTO = os.path.join(backend_path, "test_photos", "school_bus.jpeg")
+
+
+def describe(chunks):
+    """POST a photo to /imageDescriptor, with a vision call that streams chunks, which may hold an exception"""
+    def vision(*args, **kwargs):
+        for chunk in chunks:
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+
+    with patch("main.stream_image_to_bedrock", vision), open(PHOTO, "rb") as photo:
+        response = client.post("/imageDescriptor", files={"file": ("school_bus.jpeg", photo, "image/jpeg")})
+    assert response.status_code == 200, response.text
+    return response.headers["X-Description-Id"], response.text
+
+
+def test_description_is_queued_by_id():
+    """A complete description is stored under the X-Description-Id, which /runAgent queues the claim with"""
+    description_id, text = describe(["A school bus ", "hit a sedan."])
+    assert text == "A school bus hit a sedan."
+
+    queued = client.post("/runAgent", params={"description_id": description_id})
+    assert queued.status_code == 202, queued.text
+    job = get_job(queued.json()["job_id"])
+    assert job["status"] == QUEUED and job["image_description"] == text
+    print(f"✅ Description {description_id} queued as job {job['_id']}")
+
+
+def test_failed_description_is_not_queued():
+    """A vision call that fails is reported to the user, and no claim can be queued for its description"""
+    description_id, text = describe(["A school bus ", ConnectionError("Bedrock unreachable")])
+    assert text == "A school bus Error: Bedrock unreachable"
+
+    for endpoint in ("/runAgent", "/runAgent/stream"):
+        response = client.post(endpoint, params={"description_id": description_id})
+        assert response.status_code == 409 and "Bedrock unreachable" in response.json()["detail"], response.text
+    print("✅ Failed description: shown to the user, refused with 409")
+
+
+def test_queued_deadline_comes_from_the_client():
+    """A queued job keeps the client's X-Request-Timeout; without one its budget starts when a worker leases it"""
+    description_id, _ = describe(["A school bus reversed into a bollard."])
+    job = get_job(client.post("/runAgent", params={"description_id": description_id}).json()["job_id"])
+    assert job["deadline"] is None
+
+    description_id, _ = describe(["A school bus clipped a cyclist."])
+    response = client.post("/runAgent", params={"description_id": description_id}, headers={"X-Request-Timeout": "30"})
+    deadline = deadline_timestamp(get_job(response.json()["job_id"])["deadline"])
+    assert 0 < deadline - time.time() <= 30
+    print("✅ Queued deadline: only set by the client")
+
+
+def test_unknown_description():
+    """Unknown and malformed description ids are a 404"""
+    for description_id in ("6601f0c2a1b2c3d4e5f60718", "not-an-id"):
+        assert client.post("/runAgent", params={"description_id": description_id}).status_code == 404
+    print("✅ Unknown description: 404")
+
+
+if __name__ == "__main__":
+    test_description_is_queued_by_id()
+    test_failed_description_is_not_queued()
+    test_queued_deadline_comes_from_the_client()
+    test_unknown_description()
+    print("✅ Image description tests passed")
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Tests of the orjson encoder shared by the API responses, the agent event stream and the logs.
+"""
+
+import json
+import logging
+from datetime import datetime, timezone
+from decimal import Decimal
+
+from offline_env import backend_path  # noqa: F401  (sets up the fake backends)
+
+import numpy as np
+from bson import Binary, Decimal128, ObjectId
+from langchain_core.messages import AIMessage
+
+from claim_usage import ClaimUsage
+from json_encoder import BSONJSONResponse, LazyJSON, dumps, to_jsonable
+
+
+def test_bson_types():
+    """ObjectIds, dates, Decimal128, binary data and sets are encoded as plain JSON"""
+    object_id = ObjectId()
+    document = {
+        "_id": object_id,
+        "date": datetime(2024, 3, 1, 12, 30, tzinfo=timezone.utc),
+        "reserve": Decimal128("1250.50"),
+        "vector": Binary(b"\x01\x02\x03"),
+        "tags": {"urgent"},
+        "nested": [{"claim_id": object_id}],
+        1: "non-string key",
+    }
+    encoded = json.loads(dumps(document))
+    assert encoded == {
+        "_id": str(object_id),
+        "date": "2024-03-01T12:30:00+00:00",
+        "reserve": "1250.50",
+        "vector": "AQID",
+        "tags": ["urgent"],
+        "nested": [{"claim_id": str(object_id)}],
+        "1": "non-string key",
+    }, encoded
+    print("✅ BSON types: ObjectId, date, Decimal128, Binary and sets encoded")
+
+
+def test_models_and_arrays():
+    """Pydantic models, LangChain messages included, and numpy arrays are encoded by value"""
+    usage = ClaimUsage()
+    usage.add_call("vision", "model", latency_ms=12.5, input_tokens=10, output_tokens=5)
+    encoded = json.loads(dumps({"usage": usage, "message": AIMessage(content="Done"),
+                                "embedding": np.array([0.5, 0.25], dtype=np.float32)}))
+    assert encoded["usage"]["calls"][0]["input_tokens"] == 10
+    assert encoded["message"]["content"] == "Done" and encoded["message"]["type"] == "ai"
+    assert encoded["embedding"] == [0.5, 0.25]
+
+    # Unknown types fall back to their string form instead of failing the request
+    assert json.loads(dumps({"amount": Decimal("3.10")})) == {"amount": "3.10"}
+    assert to_jsonable({"_id": ObjectId("6601f0c2a1b2c3d4e5f60718")}) == {"_id": "6601f0c2a1b2c3d4e5f60718"}
+    print("✅ Models and arrays: pydantic, LangChain messages and numpy encoded")
+
+
+def test_lazy_json_and_response():
+    """LazyJSON encodes only when formatted; BSONJSONResponse renders BSON documents directly"""
+    class Probe:
+        """Encoded through its string form, which counts how often it was encoded"""
+        encoded = 0
+
+        def __str__(self):
+            Probe.encoded += 1
+            return "probe"
+
+    logger = logging.getLogger("test_json_encoder")
+    logger.setLevel(logging.INFO)
+    logger.debug("Agent event: %s", LazyJSON({"probe": Probe()}))
+    assert Probe.encoded == 0
+    assert str(LazyJSON({"probe": Probe(), "_id": ObjectId("6601f0c2a1b2c3d4e5f60718")})) == \
+        '{"probe":"probe","_id":"6601f0c2a1b2c3d4e5f60718"}'
+    assert Probe.encoded == 1
+
+    response = BSONJSONResponse({"claims": [{"_id": ObjectId("6601f0c2a1b2c3d4e5f60718")}], "next_cursor": None})
+    assert response.media_type == "application/json"
+    assert json.loads(response.body) == {"claims": [{"_id": "6601f0c2a1b2c3d4e5f60718"}], "next_cursor": None}
+    print("✅ LazyJSON and BSONJSONResponse")
+
+
+if __name__ == "__main__":
+    test_bson_types()
+    test_models_and_arrays()
+    test_lazy_json_and_response()
+    print("✅ JSON encoder tests passed")
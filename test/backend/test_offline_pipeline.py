@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+"""
+Offline end-to-end test of the claim pipeline against the fake Bedrock and MongoDB backends.
+
+Needs no AWS credentials and no Atlas cluster.
+"""
+
+import glob
+import os
+
+# Fake backends and a throwaway namespace; set before any backend module is imported
+from offline_env import backend_path
+
+from mongo_client import get_collection
+from pic2textApi import stream_image_to_bedrock, stream_images_to_bedrock
+from image_batch import pack_images, preprocess_images
+from bulk_ingest import run_bulk_ingest
+from agent_tools import fetch_guidelines, summarize_policy
+from policy_reevaluation import DETERMINISTIC, LLM, approval_tier, reevaluate_policy, reserve_amount
+from claim_schema import ClaimRecord
+from policy_version import policy_reference
+from insurance_agent import insurance_agent
+from claim_usage import ClaimUsage
+from fakes.bedrock import FakeBedrockRuntime
+from rate_limiter import BedrockRateLimiter, RateLimitedBedrockRuntime, RATE_LIMIT_COLLECTION
+from bedrock_router import BedrockRouter, OPEN
+from vision_routing import VISION_FAST_MODEL_ID, VISION_STRONG_MODEL_ID, escalation_cause
+import json
+import tempfile
+import time
+from contextlib import ExitStack
+from types import SimpleNamespace
+from unittest.mock import patch
+from bson import ObjectId
+
+
+def test_vision_stream():
+    """Every bundled photo gets a non-empty description"""
+    for photo in sorted(glob.glob(os.path.join(backend_path, "test_photos", "*"))):
+        description = "".join(stream_image_to_bedrock(photo))
+        assert description and not description.startswith("Error"), description
+        print(f"✅ {os.path.basename(photo)}: {description[:60]}...")
+
+
+def routing_mode(mode: str) -> ExitStack:
+    """Set VISION_ROUTING in the modules that read it at import"""
+    stack = ExitStack()
+    for module in ("vision_routing", "pic2textApi"):
+        stack.enter_context(patch(f"{module}.VISION_ROUTING", mode))
+    return stack
+
+
+def test_vision_routing():
+    """Adaptive routing: small photos go to the fast model, complex scenes are escalated, large photos to the strong one"""
+    with routing_mode("adaptive"):
+        routes = {}
+        for photo in sorted(glob.glob(os.path.join(backend_path, "test_photos", "*"))):
+            usage = ClaimUsage()
+            description = "".join(stream_image_to_bedrock(photo, usage=usage))
+            routes[os.path.basename(photo)] = usage.vision_route
+            models = [call.model_id for call in usage.calls]
+            assert models == {"fast": [VISION_FAST_MODEL_ID], "strong": [VISION_STRONG_MODEL_ID],
+                              "escalated": [VISION_FAST_MODEL_ID, VISION_STRONG_MODEL_ID]}[usage.vision_route], models
+            assert (usage.vision_route == "escalated") == bool(escalation_cause(description)), description
+
+        assert routes["school_bus.jpeg"] == "strong"
+        assert {"fast", "escalated"} <= set(routes.values()), routes
+        usage = ClaimUsage()
+        "".join(stream_image_to_bedrock(os.path.join(backend_path, "test_photos", "tyre_blowout.jpeg"), usage=usage, hint="complex"))
+        assert usage.vision_route == "strong"
+    print(f"✅ Vision routing: {routes}")
+
+
+def test_vision_routing_streams_by_default():
+    """With the default size routing, the chosen model's description is streamed without escalation"""
+    usage = ClaimUsage()
+    chunks = list(stream_image_to_bedrock(os.path.join(backend_path, "test_photos", "pile_up.jpg"), usage=usage))
+    assert usage.vision_route in ("fast", "strong") and len(usage.calls) == 1, usage
+    assert len(chunks) > 1, chunks
+    print(f"✅ Size routing: {usage.vision_route} description streamed in {len(chunks)} chunks")
+
+
+def test_vision_escalation_signals():
+    """Hedging and truncated fast descriptions are escalated however long they are; clear ones are not"""
+    clear = ("A grey hatchback has rear-ended a stationary van at a junction. The hatchback's bonnet is "
+             "crumpled and its headlights are broken; the van's rear doors are dented.")
+    hedging = ("A grey hatchback is stopped behind a van at a junction in the rain. It is difficult to determine "
+               "from this angle whether the two vehicles touched, as the front of the hatchback is obscured.")
+    assert len(hedging) >= len(clear)
+    assert escalation_cause(clear) is None
+    assert escalation_cause(clear, stop_reason="max_tokens") == "truncated"
+    assert escalation_cause(hedging) == "uncertain"
+
+    # End to end: the same photo escalates only when the fast model hedges
+    photo = os.path.join(backend_path, "test_photos", "tyre_blowout.jpeg")
+    for description, route in ((clear, "fast"), (hedging, "escalated")):
+        usage = ClaimUsage()
+        with routing_mode("adaptive"), patch("fakes.bedrock.VISION_DESCRIPTIONS", [description]), \
+                patch("pic2textApi.choose_route", return_value=("fast", "size")):
+            assert "".join(stream_image_to_bedrock(photo, usage=usage)) == description
+        assert usage.vision_route == route, (route, usage.vision_route)
+    print("✅ Vision escalation: hedging and truncated descriptions go to the strong model")
+
+
+def test_multi_photo_claim():
+    """The photos of a claim are described together in one request, as one consolidated description"""
+    photos = sorted(glob.glob(os.path.join(backend_path, "test_photos", "*")))
+    usage = ClaimUsage()
+    description = "".join(stream_images_to_bedrock(photos, usage=usage))
+    assert not description.startswith("Error"), description
+    assert len(usage.calls) == 1 and usage.vision_route == "strong"
+
+    images = preprocess_images(photos * 5)
+    assert [len(batch) for batch in pack_images(images[:1] * 25)] == [20, 5]
+    assert [image["name"] for image in images[:len(photos)]] == [os.path.basename(photo) for photo in photos]
+    print(f"✅ Multi-photo claim: {len(photos)} photos in {len(usage.calls)} request, {len(description)} characters")
+
+
+def test_hybrid_search():
+    """Each incident type retrieves the matching policy"""
+    queries = {
+        "A yellow school bus collided with a sedan": "Collision with School Bus",
+        "A car slid off an icy road in heavy snow": "Adverse Weather",
+        "A multi-vehicle pile-up on a foggy highway": "Multi-Vehicle Pile-Up",
+        "A pedestrian was struck at a crosswalk": "Pedestrian Accident",
+        "A tyre blowout sent the car into the barrier": "Mechanical Failure",
+    }
+    for query, expected in queries.items():
+        policy = fetch_guidelines.invoke({"query": query})
+        assert expected in policy, f"{query!r} retrieved {policy[:80]}"
+        print(f"✅ {query} -> {expected}")
+
+
+def test_agent_persists_claim():
+    """A full agent run persists exactly one claim, also when retried with the same idempotency key"""
+    description = "A yellow school bus collided with a sedan at an intersection."
+    claims = get_collection(os.environ["COLLECTION_NAME_2"])
+
+    object_id = insurance_agent(description, idempotency_key="offline-test")
+    retried_id = insurance_agent(description, idempotency_key="offline-test")
+
+    claim = claims.find_one({"_id": ObjectId(object_id)})
+    assert claim is not None
+    assert retried_id == object_id
+    assert claims.count_documents({"idempotency_key": "offline-test"}) == 1
+    print(f"✅ Claim {object_id} persisted with handler {claim['claim_handler']}")
+
+
+def test_claim_usage():
+    """Vision and agent token counts and graph iterations are stored with the claim"""
+    photo = sorted(glob.glob(os.path.join(backend_path, "test_photos", "*")))[0]
+    usage = ClaimUsage()
+    description = "".join(stream_image_to_bedrock(photo, usage=usage))
+    assert usage.calls[0].stage == "vision" and usage.calls[0].output_tokens > 0
+
+    object_id = insurance_agent(description, usage=usage)
+
+    stored = get_collection(os.environ["COLLECTION_NAME_2"]).find_one({"_id": ObjectId(object_id)})["usage"]
+    agent_calls = [call for call in stored["calls"] if call["stage"] == "agent"]
+    assert stored["llm_turns"] == len(agent_calls) >= 2
+    assert stored["graph_iterations"] == stored["llm_turns"] + stored["tool_rounds"]
+    assert stored["input_tokens"] == sum(call["input_tokens"] for call in stored["calls"]) > 0
+    assert stored["cost_usd"] > 0 and stored["prompt_version"]
+    print(f"✅ Claim usage: {stored['input_tokens']} in, {stored['output_tokens']} out, "
+          f"{stored['graph_iterations']} iterations, ${stored['cost_usd']:.4f}")
+
+
+def test_rate_limiter():
+    """Throttled calls are retried through the shared bucket, which lowers its rate and concurrency"""
+    limiter = BedrockRateLimiter("mongo")
+    client = RateLimitedBedrockRuntime(FakeBedrockRuntime(throttle_rate=0.2, seed=3), limiter)
+    model_id = "cohere.embed-english-v3"
+
+    for i in range(10):
+        response = client.invoke_model(modelId=model_id, body=json.dumps({"texts": [f"claim {i}"], "input_type": "search_query"}))
+        assert json.loads(response["body"].read())["embeddings"]
+
+    stream = client.invoke_model_with_response_stream(modelId="anthropic.claude-3-haiku-20240307-v1:0", body=json.dumps(
+        {"messages": [{"role": "user", "content": [{"type": "image", "source": {"data": "AAAA"}}]}]}))
+    assert list(stream["body"])
+
+    concurrency, bucket = limiter._limits("us-east-1", model_id)
+    shared = get_collection(RATE_LIMIT_COLLECTION).find_one({"_id": bucket.key})
+    assert concurrency.in_flight == 0 and concurrency.limit < concurrency.max_limit
+    assert shared["rate"] < bucket.max_rate
+    print(f"✅ Rate limiter: concurrency limit {concurrency.limit:.1f}, shared rate {shared['rate']:.1f}/s")
+
+
+def test_bedrock_router():
+    """Calls fail over from a throttling region, whose circuit opens, and slow calls are hedged"""
+    model_id = "cohere.embed-english-v3"
+    body = json.dumps({"texts": ["rear-end collision"], "input_type": "search_query"})
+    router = BedrockRouter([("us-east-1", FakeBedrockRuntime(region_name="us-east-1", throttle_rate=1.0)),
+                            ("us-west-2", FakeBedrockRuntime(region_name="us-west-2"))])
+
+    for _ in range(10):
+        assert json.loads(router.invoke_model(modelId=model_id, body=body)["body"].read())["embeddings"]
+    assert router.breaker("us-east-1", model_id).state == OPEN
+
+    slow = FakeBedrockRuntime(region_name="us-east-1", latency_ms=500)
+    router = BedrockRouter([("us-east-1", slow), ("us-west-2", FakeBedrockRuntime(region_name="us-west-2"))])
+    router._latencies[model_id].extend([0.01] * 50)
+    start = time.perf_counter()
+    with patch("bedrock_router.HEDGED_MODELS", {model_id}):
+        assert json.loads(router.invoke_model(modelId=model_id, body=body)["body"].read())["embeddings"]
+    elapsed = time.perf_counter() - start
+    assert elapsed < 0.4
+    print(f"✅ Bedrock router: failed over to us-west-2, hedged call answered in {elapsed * 1000:.0f} ms")
+
+
+def test_bulk_ingest():
+    """A manifest is ingested with insert_many, a rerun resumes from the checkpoint and never duplicates claims"""
+    photos = os.path.join(backend_path, "test_photos")
+    with tempfile.TemporaryDirectory() as directory:
+        manifest = os.path.join(directory, "claims.jsonl")
+        checkpoint = os.path.join(directory, "claims.checkpoint.jsonl")
+        with open(manifest, "w") as file:
+            file.write(json.dumps({"id": "hail-1", "photos": [os.path.join(photos, "pile_up.jpg"),
+                                                              os.path.join(photos, "school_bus.jpeg")]}) + "\n")
+            file.write(json.dumps({"id": "hail-2", "photo": os.path.join(photos, "tyre_blowout.jpeg"), "hint": "simple"}) + "\n")
+            file.write(json.dumps({"id": "hail-3", "photo": "missing.jpg"}) + "\n")
+
+        summary = run_bulk_ingest(manifest, checkpoint, concurrency=2, batch_size=2)
+        assert (summary["written"], summary["failed"]) == (2, 1), summary
+        resumed = run_bulk_ingest(manifest, checkpoint)
+        assert (resumed["written"], resumed["failed"], resumed["skipped"]) == (0, 1, 2), resumed
+        # Without the checkpoint every claim runs again, but the stored claims are kept
+        rerun = run_bulk_ingest(manifest)
+        assert rerun["written"] == 2
+
+    claims = get_collection(os.environ["COLLECTION_NAME_2"])
+    stored = list(claims.find({"idempotency_key": {"$in": ["bulk:hail-1", "bulk:hail-2"]}}))
+    assert len(stored) == 2 and all(claim["usage"]["calls"] for claim in stored)
+    print(f"✅ Bulk ingestion: {summary['written']} claims in {summary['seconds']:.2f}s, resumed and rerun without duplicates")
+
+
+def test_policy_reevaluation():
+    """Editing a policy re-evaluates only its claims: new thresholds without the LLM, a new decision tree with the agent"""
+    claims = get_collection(os.environ["COLLECTION_NAME_2"])
+    policies = get_collection(os.environ["COLLECTION_NAME"])
+    object_id = ObjectId(insurance_agent("A yellow school bus collided with a sedan at an intersection."))
+    policy = policies.find_one({"_id": claims.find_one({"_id": object_id})["policy"]["id"]})
+    stored = claims.count_documents({})
+
+    try:
+        thresholds = dict(policy["approvalThresholds"], autoApprove={"maxAmount": 20000, "conditions": ["minor damage"]})
+        policies.update_one({"_id": policy["_id"]}, {"$set": {"approvalThresholds": thresholds}})
+        counts = reevaluate_policy(policies.find_one({"_id": policy["_id"]}))
+        claim = claims.find_one({"_id": object_id})
+        assert counts[DETERMINISTIC] >= 1 and counts[LLM] == 0, counts
+        assert claim["approval_level"] == "Auto Approve"
+        assert claim["recommendation"]["approval_guidance"]["autoApprove"]["maxAmount"] == 20000
+        assert claim["reevaluation"]["sections"] == ["approvalThresholds"]
+        assert not any(reevaluate_policy(policies.find_one({"_id": policy["_id"]})).values())
+
+        policies.update_one({"_id": policy["_id"]}, {"$set": {"decisionTree.injuries.none.priority": "critical"}})
+        edited = policies.find_one({"_id": policy["_id"]})
+        counts = reevaluate_policy(edited, concurrency=2)
+        claim = claims.find_one({"_id": object_id})
+        assert counts[LLM] >= 1 and claim["reevaluation"]["mode"] == LLM, counts
+        assert claim["policy"]["hash"] == policy_reference(policy["_id"], summarize_policy(edited))["hash"]
+        assert claims.count_documents({}) == stored
+        assert not claim["usage"]["degraded"]
+
+        # A rerun that falls back to the policy defaults marks the claim degraded
+        policies.update_one({"_id": policy["_id"]}, {"$set": {"decisionTree.injuries.none.priority": "high"}})
+        no_claim = SimpleNamespace(stream=lambda state, config: iter([]))
+        with patch("insurance_agent.bounded_graph", return_value=no_claim):
+            counts = reevaluate_policy(policies.find_one({"_id": policy["_id"]}))
+        assert counts[LLM] >= 1 and claims.find_one({"_id": object_id})["usage"]["degraded"], counts
+    finally:
+        policies.replace_one({"_id": policy["_id"]}, policy)
+    print(f"✅ Policy re-evaluation: {counts[LLM]} claims rerun by the agent after a decision tree edit")
+
+
+def test_reevaluated_approval_level_matches_agent():
+    """The approval level read off the thresholds without the LLM is the one the agent's claims carry"""
+    claims = get_collection(os.environ["COLLECTION_NAME_2"])
+    claim = claims.find_one({"_id": ObjectId(insurance_agent("A pedestrian was struck at a crosswalk."))})
+    policy = summarize_policy(get_collection(os.environ["COLLECTION_NAME"]).find_one({"_id": claim["policy"]["id"]}))
+    tier = approval_tier(policy["approvalThresholds"], reserve_amount(claim["estimated_reserves"]))
+    assert claim["approval_level"] == tier, (claim["approval_level"], tier)
+
+    for spelling in ("supervisorApproval", "supervisor approval", "Supervisor Approval"):
+        record = ClaimRecord(description="A pedestrian was struck at a crosswalk.", approval_level=spelling)
+        assert record.approval_level == approval_tier({"supervisorApproval": {"maxAmount": 25000}}, 100)
+    print(f"✅ Approval levels: the agent and the re-evaluation job both write {tier!r}")
+
+
+def test_deadline_falls_back_to_policy_defaults():
+    """A run whose deadline has passed persists the policy's default handler actions instead of waiting for the LLM"""
+    usage = ClaimUsage()
+    object_id = insurance_agent("A car slid off an icy road in heavy snow", usage=usage, deadline=time.time() - 1)
+
+    claim = get_collection(os.environ["COLLECTION_NAME_2"]).find_one({"_id": ObjectId(object_id)})
+    policy = fetch_guidelines.invoke({"query": "A car slid off an icy road in heavy snow"})
+    assert usage.degraded and usage.llm_turns == 0 and claim["usage"]["degraded"]
+    assert claim["recommendation"]["immediate_actions"][0] in policy
+    print(f"✅ Deadline fallback: claim {object_id} from the policy defaults")
+
+
+def test_run_without_claim_falls_back_to_policy_defaults():
+    """A run whose graph ends without calling persist_data still persists a claim from the policy defaults"""
+    class NoClaimGraph:
+        def stream(self, state, config):
+            yield {"chatbot": {"messages": []}}
+
+    usage = ClaimUsage()
+    with patch("insurance_agent.bounded_graph", return_value=NoClaimGraph()):
+        object_id = insurance_agent("A van reversed into a parked car", usage=usage)
+
+    claim = get_collection(os.environ["COLLECTION_NAME_2"]).find_one({"_id": ObjectId(object_id)})
+    assert usage.degraded and claim["usage"]["degraded"]
+    print(f"✅ No-claim fallback: claim {object_id} from the policy defaults")
+
+
+if __name__ == "__main__":
+    test_vision_stream()
+    test_vision_routing()
+    test_vision_routing_streams_by_default()
+    test_vision_escalation_signals()
+    test_multi_photo_claim()
+    test_hybrid_search()
+    test_agent_persists_claim()
+    test_claim_usage()
+    test_rate_limiter()
+    test_bedrock_router()
+    test_bulk_ingest()
+    test_policy_reevaluation()
+    test_reevaluated_approval_level_matches_agent()
+    test_deadline_falls_back_to_policy_defaults()
+    test_run_without_claim_falls_back_to_policy_defaults()
+    print("\n✅ Offline pipeline test passed")
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Tests of on-demand request profiling: the token check, the stored profiles and their endpoints.
+
+Runs against the fake MongoDB backend. Needs pyinstrument (poetry install -E profiling).
+"""
+
+import gzip
+import json
+import uuid
+from unittest.mock import patch
+
+from offline_env import backend_path  # noqa: F401  (sets up the fake backends)
+
+from fastapi import FastAPI, HTTPException
+from fastapi.testclient import TestClient
+from starlette.requests import Request
+
+import profiling
+from profiling import PROFILES_COLLECTION, _module_of, profiled, profiled_stream, profiling_requested, router
+from mongo_client import get_collection
+
+TOKEN = "offline-secret"
+
+app = FastAPI()
+app.include_router(router)
+client = TestClient(app)
+
+
+def request_with(headers: dict = None, query: str = "") -> Request:
+    scope = {"type": "http", "method": "GET", "path": "/", "query_string": query.encode(),
+             "headers": [(key.lower().encode(), value.encode()) for key, value in (headers or {}).items()]}
+    return Request(scope)
+
+
+def work(n: int = 20000) -> int:
+    return sum(i * i for i in range(n))
+
+
+def test_token_is_read_from_the_header_only():
+    """Profiling needs the X-Profile-Token header; the query parameter is ignored, a wrong token is a 403"""
+    with patch("profiling.PROFILING_TOKEN", TOKEN):
+        assert profiling_requested(request_with({"X-Profile-Token": TOKEN}))
+        assert not profiling_requested(request_with())
+        assert not profiling_requested(request_with(query=f"profile={TOKEN}"))
+        try:
+            profiling_requested(request_with({"X-Profile-Token": "wrong"}))
+            raise AssertionError("a wrong token must be rejected")
+        except HTTPException as e:
+            assert e.status_code == 403
+
+    # Without PROFILING_TOKEN, nothing is profiled whatever the request sends
+    with patch("profiling.PROFILING_TOKEN", None):
+        assert not profiling_requested(request_with({"X-Profile-Token": TOKEN}))
+    print("✅ Profiling token: header only, wrong tokens rejected")
+
+
+def test_profiles_are_stored_and_served():
+    """A profiled block is stored in MongoDB and served, token required, as speedscope and summary"""
+    profile_id = uuid.uuid4().hex
+    with profiled(profile_id, "test"):
+        work()
+
+    stored = get_collection(PROFILES_COLLECTION).find_one({"_id": profile_id})
+    assert stored["label"] == "test" and stored["summary"]["samples"] > 0
+
+    with patch("profiling.PROFILING_TOKEN", TOKEN):
+        headers = {"X-Profile-Token": TOKEN}
+        summary = client.get(f"/profiles/{profile_id}/summary", headers=headers)
+        assert summary.status_code == 200 and summary.json()["profile_id"] == profile_id
+        assert summary.json()["modules"], summary.json()
+
+        speedscope = client.get(f"/profiles/{profile_id}", headers=headers)
+        assert speedscope.status_code == 200
+        assert json.loads(speedscope.content)["$schema"].startswith("https://www.speedscope.app")
+        assert speedscope.content == gzip.decompress(stored["speedscope"])
+
+        assert client.get(f"/profiles/{profile_id}", params={"profile": TOKEN}).status_code == 403
+        assert client.get(f"/profiles/{profile_id}", headers={"X-Profile-Token": "wrong"}).status_code == 403
+        assert client.get(f"/profiles/{uuid.uuid4().hex}", headers=headers).status_code == 404
+        assert client.get("/profiles/..%2Fetc", headers=headers).status_code == 404
+
+    with patch("profiling.PROFILING_TOKEN", None):
+        assert client.get(f"/profiles/{profile_id}", headers={"X-Profile-Token": TOKEN}).status_code == 404
+    print(f"✅ Stored profiles: {profile_id} served as speedscope and summary")
+
+
+def test_profiled_stream():
+    """A profiled stream passes its chunks on unchanged and in order, and re-raises the generator's errors"""
+    def chunks():
+        for index in range(5):
+            work(2000)
+            yield f"chunk {index}"
+
+    profile_id = uuid.uuid4().hex
+    assert list(profiled_stream(chunks(), profile_id, "stream")) == [f"chunk {index}" for index in range(5)]
+    # The profile is saved before the stream ends
+    assert get_collection(PROFILES_COLLECTION).find_one({"_id": profile_id}) is not None
+
+    def failing():
+        yield "first"
+        raise ValueError("vision call failed")
+
+    received = []
+    try:
+        for chunk in profiled_stream(failing(), uuid.uuid4().hex, "stream"):
+            received.append(chunk)
+        raise AssertionError("the generator's error must reach the caller")
+    except ValueError as e:
+        assert str(e) == "vision call failed" and received == ["first"]
+    print("✅ Profiled stream: chunks passed through, errors re-raised")
+
+
+def test_module_breakdown_groups_frames():
+    """Frames are grouped by backend module, installed package and stdlib module"""
+    assert _module_of(profiling.__file__) == "profiling"
+    assert _module_of(json.__file__) == "stdlib:json"
+    assert _module_of("/venv/lib/python3.10/site-packages/pydantic/main.py") == "pydantic"
+    assert _module_of("<frozen importlib._bootstrap>") == "<builtin>"
+    print("✅ Module breakdown: backend, package and stdlib frames grouped")
+
+
+if __name__ == "__main__":
+    test_token_is_read_from_the_header_only()
+    test_profiles_are_stored_and_served()
+    test_profiled_stream()
+    test_module_breakdown_groups_frames()
+    print("✅ Profiling tests passed")
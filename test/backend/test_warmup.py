@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Tests of the warm-up of the API and claim workers, and of the /ready probe that reports it.
+
+Runs against the fake Bedrock and MongoDB backends.
+"""
+
+import asyncio
+from unittest.mock import patch
+
+from offline_env import backend_path  # noqa: F401  (sets up the fake backends)
+
+from fastapi.testclient import TestClient
+
+import warmup
+from warmup import API_WARMUP_STEPS, WORKER_WARMUP_STEPS, readiness, warm_up, warm_up_in_background
+from image_descriptions import DESCRIPTIONS_COLLECTION
+from profiling import PROFILES_COLLECTION
+from mongo_client import get_collection
+from main import app
+
+# Not used as a context manager, so the lifespan's warm-up does not run
+client = TestClient(app)
+
+
+def reset():
+    """Forget the steps run so far, as in a freshly started process"""
+    warmup._status.update(ready=False, steps={}, error=None)
+
+
+def flaky_steps(failures: int) -> tuple:
+    """Warm-up steps whose second one fails the first `failures` times, and the number of calls of each"""
+    calls = {"first": 0, "second": 0}
+
+    def first():
+        calls["first"] += 1
+
+    def second():
+        calls["second"] += 1
+        if calls["second"] <= failures:
+            raise ConnectionError("cluster unreachable")
+
+    return [("first", first), ("second", second)], calls
+
+
+def test_failed_step_is_retried_alone():
+    """A failed step is reported and retried on the next run; steps that succeeded are not run again"""
+    reset()
+    steps, calls = flaky_steps(failures=1)
+    assert not warm_up(steps)
+    status = readiness()
+    assert not status["ready"] and status["error"] == "second: cluster unreachable" and list(status["steps"]) == ["first"]
+
+    assert warm_up(steps)
+    status = readiness()
+    assert status["ready"] and status["error"] is None and list(status["steps"]) == ["first", "second"]
+    assert calls == {"first": 1, "second": 2}
+    print("✅ Warm-up retry: only the failed step is run again")
+
+
+def test_ready_probe():
+    """GET /ready is 503 with the failing step until the warm-up succeeds, then 200"""
+    reset()
+    steps, _ = flaky_steps(failures=1)
+    warm_up(steps)
+    response = client.get("/ready")
+    assert response.status_code == 503 and response.json()["error"] == "second: cluster unreachable"
+
+    warm_up(steps)
+    response = client.get("/ready")
+    assert response.status_code == 200 and response.json()["ready"]
+    print("✅ Readiness probe: 503 while warming up, 200 once ready")
+
+
+def test_background_warm_up_retries_until_ready():
+    """The lifespan's background warm-up keeps retrying until every step has succeeded"""
+    reset()
+    steps, calls = flaky_steps(failures=3)
+    with patch("warmup.WARMUP_RETRY_SECONDS", 0.01):
+        asyncio.run(asyncio.wait_for(warm_up_in_background(steps), timeout=5))
+    assert readiness()["ready"] and calls == {"first": 1, "second": 4}
+    print("✅ Background warm-up: retried until ready")
+
+
+def test_real_steps():
+    """Every API warm-up step succeeds against the fake backends and applies the TTL indexes"""
+    reset()
+    assert warm_up(API_WARMUP_STEPS), readiness()
+    assert [name for name, _ in API_WARMUP_STEPS] == list(readiness()["steps"])
+    assert "indexes" not in [name for name, _ in WORKER_WARMUP_STEPS]
+
+    for collection in (DESCRIPTIONS_COLLECTION, PROFILES_COLLECTION):
+        ttl = [index for index in get_collection(collection).index_information().values() if "expireAfterSeconds" in index]
+        assert ttl and ttl[0]["key"] == [("created_at", 1)], (collection, ttl)
+    print(f"✅ Real warm-up steps: {readiness()['steps']}")
+
+
+if __name__ == "__main__":
+    test_failed_step_is_retried_alone()
+    test_ready_probe()
+    test_background_warm_up_retries_until_ready()
+    test_real_steps()
+    print("✅ Warm-up tests passed")